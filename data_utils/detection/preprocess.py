@@ -1,10 +1,12 @@
 import os
+import ast
 import glob
 import math
 import json
 import shutil
 import random
 from functools import reduce
+from multiprocessing import Pool
 from collections import defaultdict
 
 import fire
@@ -39,7 +41,7 @@ def split_anno_json(anno_json, output_dir, val_ratio=0.05):
         json.dump(annos[train_size:], f)
 
 
-def gqa_dataset_mmdet(scence_graph, output_path):
+def legacy_gqa_dataset_mmdet(scence_graph, output_path):
     with open(scence_graph, mode='r') as j:
         gqa_graph = json.load(j)
     
@@ -89,6 +91,187 @@ def gqa_dataset_mmdet(scence_graph, output_path):
         json.dump(all_anno, f)
 
 
+GQA_CLASS_ID = {name: i for i, name in reversed(list(enumerate(gqa.CLASSES)))}
+GQA_ATTR_ID = {name: i for i, name in reversed(list(enumerate(gqa.ATTRS)))}
+
+
+def load_fuzzy_classes(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vg_fuzzy_classes.py')):
+    """
+    Object names of vg_fuzzy_classes.py (a bare list of (name, count), commented entries excluded).
+    """
+    with open(path, mode='r') as f:
+        return set(name for name, _ in ast.literal_eval(f.read()))
+
+
+def _gqa_graph_annos(img_id, graph, skip_names=frozenset()):
+    img_annos = {
+        'image_name': f"{img_id}.jpg",
+        'height': graph['height'],
+        'width': graph['width'],
+        'boxes': [],
+        'classes': [],
+        'class_id': [],
+        'attributes': [],
+        'attribute_idx': [],
+        'scores': None,
+        'attr_scores': None
+    }
+    for obj_anno in graph['objects'].values():
+        if obj_anno['w'] <= 8 or obj_anno['h'] <= 8:
+            continue
+        class_id = GQA_CLASS_ID.get(obj_anno['name'])
+        if class_id is None or obj_anno['name'] in skip_names:
+            continue
+        obj_box = [
+            max(min(obj_anno['x'], graph['width']), 0),
+            max(min(obj_anno['y'], graph['height']), 0),
+            max(min(obj_anno['x'] + obj_anno['w'], graph['width']), 0),
+            max(min(obj_anno['y'] + obj_anno['h'], graph['height']), 0)
+        ]
+        if (obj_box[2] - obj_box[0]) <= 8 or (obj_box[3] - obj_box[1]) <= 8:
+            continue
+        img_annos['boxes'].append(obj_box)
+        img_annos['classes'].append(obj_anno['name'])
+        img_annos['class_id'].append(class_id)
+        img_annos['attributes'].append(obj_anno['attributes'])
+        # NOTE: unknown attribute raise KeyError, like the ValueError of `gqa.ATTRS.index`
+        img_annos['attribute_idx'].append([GQA_ATTR_ID[attr] for attr in obj_anno['attributes']])
+    return img_annos
+
+
+def json_object_chunks(path, chunk_bytes, block_bytes=8 << 20):
+    """
+    Split a file holding one JSON object into byte ranges of about chunk_bytes, every range
+    is a run of whole top level `"key": value` entries, `'{' + range + '}'` is valid JSON.
+    The file is scanned block by block: a byte is inside a string after an odd number of
+    unescaped quotes, and entries end at the commas outside strings at depth 1.
+    """
+    ranges = []
+    start = None
+    depth, in_str, bs_run, offset = 0, 0, 0, 0
+    next_cut = None
+    with open(path, mode='rb') as f:
+        while True:
+            buf = f.read(block_bytes)
+            if not buf:
+                break
+            b = np.frombuffer(buf, dtype=np.uint8)
+            idx = np.arange(len(b))
+            last_plain = np.maximum.accumulate(np.where(b == ord('\\'), -1, idx))
+            prev_plain = np.concatenate([[-1], last_plain[:-1]])
+            bs_before = idx - 1 - prev_plain + np.where(prev_plain < 0, bs_run, 0)
+            quote = (b == ord('"')) & (bs_before % 2 == 0)
+            inside = (in_str + np.cumsum(quote)) % 2 == 1
+            opens = ~inside & ((b == ord('{')) | (b == ord('[')))
+            closes = ~inside & ((b == ord('}')) | (b == ord(']')))
+            depth_after = depth + np.cumsum(opens.astype(np.int64) - closes)
+
+            if start is None:
+                first = np.flatnonzero(opens & (depth_after == 1))
+                if len(first):
+                    start = offset + int(first[0]) + 1
+                    next_cut = start + chunk_bytes
+            if start is not None:
+                commas = offset + np.flatnonzero(~inside & (b == ord(',')) & (depth_after == 1))
+                while True:
+                    k = np.searchsorted(commas, next_cut)
+                    if k == len(commas):
+                        break
+                    cut = int(commas[k])
+                    ranges.append((start, cut))
+                    start = cut + 1
+                    next_cut = start + chunk_bytes
+                end = np.flatnonzero(closes & (depth_after == 0))
+                if len(end):
+                    ranges.append((start, offset + int(end[0])))
+                    return ranges
+
+            in_str = (in_str + int(quote.sum())) % 2
+            depth = int(depth_after[-1])
+            bs_run = len(b) - 1 - int(last_plain[-1]) + (bs_run if last_plain[-1] < 0 else 0)
+            offset += len(b)
+    raise ValueError(f"{path} is not a complete JSON object")
+
+
+def _gqa_chunk_mmdet(args):
+    path, start, end, shard_path, skip_names = args
+    with open(path, mode='rb') as f:
+        f.seek(start)
+        graphs = json.loads(b'{' + f.read(end - start) + b'}')
+    annos = [_gqa_graph_annos(img_id, graph, skip_names) for img_id, graph in graphs.items()]
+    with open(shard_path + '.tmp', mode='w') as f:
+        json.dump(annos, f)
+    os.replace(shard_path + '.tmp', shard_path)
+    return len(annos)
+
+
+def merge_json_lists(json_paths, output_path):
+    """
+    Concatenate json list files into one list, shard by shard.
+    """
+    with open(output_path + '.tmp', mode='w') as out:
+        out.write('[')
+        sep = ''
+        for path in json_paths:
+            with open(path, mode='r') as f:
+                body = f.read().strip()[1:-1]
+            if body:
+                out.write(sep + body)
+                sep = ', '
+        out.write(']')
+    os.replace(output_path + '.tmp', output_path)
+
+
+def gqa_dataset_mmdet(scence_graph, output_path, num_workers=8, chunk_mb=32, skip_fuzzy=False, merge=True):
+    """
+    scence_graph: GQA scene graph json, or a glob of several.
+    output_path: mmdetection annotation list, same as the legacy single process version.
+        The annotations of every chunk are streamed to `<output_path>.shards/` first,
+        with merge=False the shards are the output (each one a json list).
+    skip_fuzzy: leave out objects named one of vg_fuzzy_classes.py.
+    """
+    graph_paths = sorted(glob.glob(scence_graph))
+    assert graph_paths, f"{scence_graph} not found"
+    skip_names = frozenset(load_fuzzy_classes()) if skip_fuzzy else frozenset()
+    shard_dir = output_path + '.shards'
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+
+    tasks = []
+    for path in graph_paths:
+        for start, end in json_object_chunks(path, chunk_mb << 20):
+            shard_path = os.path.join(shard_dir, f"part-{len(tasks):05d}.json")
+            tasks.append((path, start, end, shard_path, skip_names))
+    logger.info(f"{len(graph_paths)} scene graph files, {len(tasks)} chunks")
+
+    if num_workers > 1 and len(tasks) > 1:
+        with Pool(min(num_workers, len(tasks))) as pool:
+            counts = pool.map(_gqa_chunk_mmdet, tasks, chunksize=1)
+    else:
+        counts = [_gqa_chunk_mmdet(t) for t in tasks]
+    logger.info(f"{sum(counts)} images converted")
+
+    if merge:
+        merge_json_lists([t[3] for t in tasks], output_path)
+        shutil.rmtree(shard_dir)
+
+
+def check_gqa_dataset_mmdet(scence_graph, output_path):
+    """
+    Compare the output of gqa_dataset_mmdet with the legacy version.
+    """
+    legacy_path = output_path + '.legacy.json'
+    legacy_gqa_dataset_mmdet(scence_graph, legacy_path)
+    with open(output_path, mode='r') as f:
+        annos = json.load(f)
+    with open(legacy_path, mode='r') as f:
+        legacy_annos = json.load(f)
+    os.remove(legacy_path)
+    assert annos == legacy_annos
+    logger.info(f"OK: {len(annos)} images")
+
+
 def generate_cliping_dataset(img_dir, output_dir, target_number=10000):
 
     def rand_layout(num):
@@ -206,5 +389,7 @@ if __name__ == "__main__":
         fire.Fire({
             'split_anno_json': split_anno_json,
             'gqa_dataset_mmdet': gqa_dataset_mmdet,
+            'legacy_gqa_dataset_mmdet': legacy_gqa_dataset_mmdet,
+            'check_gqa_dataset_mmdet': check_gqa_dataset_mmdet,
             'generate_cliping_dataset': generate_cliping_dataset,
         })
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Persistent parse-once cache of spaCy `Doc`.
+
+    cache = DocCache('/data/doc_cache')
+    docs = cache.docs(nlp, titles, disable=['ner'])
+
+Each unique text is parsed once with `nlp.pipe`, and the result is stored in
+`DocBin` shards, looked up by a hash of the text. The cache is split into one
+namespace per pipeline (model name, version and enabled components), so docs
+produced by a different pipeline are never mixed up. Shards are append-only,
+written atomically (`shard_XXXXX.spacy` first, then its key list
+`shard_XXXXX.keys.json`), and a shard without key list is ignored. A shard id
+is claimed first (`shard_XXXXX.claim`, created exclusively), so processes
+sharing a cache directory never write the same shard.
+
+Only the token attributes and `doc.user_data` are stored: extension attributes
+with a getter (eg. `doc._.language` of spacy_langdetect) are computed on access
+and lost. Pass `annotate`, a function called on every newly parsed doc, to save
+such values in `doc.user_data`; its name is part of the namespace.
+
+Loaded shards stay in memory, so a cache filled in the parent process is
+shared with `fork`ed pool workers.
+"""
+import os
+import glob
+import json
+import hashlib
+
+from spacy.tokens import DocBin
+
+
+DOC_ATTRS = ('TAG', 'POS', 'LEMMA', 'HEAD', 'DEP', 'ENT_IOB', 'ENT_TYPE')
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def pipeline_signature(nlp, disable=(), annotate=None):
+    meta = nlp.meta
+    pipes = [p for p in nlp.pipe_names if p not in disable]
+    desc = f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}:{','.join(pipes)}"
+    if annotate is not None:
+        desc += f"+{annotate.__name__}"
+    return f"{meta.get('lang')}_{meta.get('name')}-" + hashlib.sha1(desc.encode('utf-8')).hexdigest()[:12]
+
+
+class _Namespace:
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.index = {}  # text key -> (shard id, position)
+        self.shards = {}  # shard id -> list of Doc
+        for keys_file in sorted(glob.glob(os.path.join(root, 'shard_*.keys.json'))):
+            shard_id = int(os.path.basename(keys_file)[len('shard_'):].split('.')[0])
+            with open(keys_file, 'r') as f:
+                for pos, key in enumerate(json.load(f)):
+                    self.index.setdefault(key, (shard_id, pos))
+        claimed = [
+            int(os.path.basename(p)[len('shard_'):].split('.')[0])
+            for p in glob.glob(os.path.join(root, 'shard_*.claim'))
+        ]
+        self.next_shard = max(claimed + [s for s, _ in self.index.values()], default=-1) + 1
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.root, f"shard_{shard_id:05d}")
+
+    def _claim_shard(self):
+        while True:
+            shard_id = self.next_shard
+            self.next_shard += 1
+            try:
+                os.close(os.open(self._shard_path(shard_id) + '.claim', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return shard_id
+            except FileExistsError:
+                continue
+
+    def load(self, shard_id, vocab):
+        if shard_id not in self.shards:
+            with open(self._shard_path(shard_id) + '.spacy', 'rb') as f:
+                doc_bin = DocBin().from_bytes(f.read())
+            self.shards[shard_id] = list(doc_bin.get_docs(vocab))
+        return self.shards[shard_id]
+
+    def get(self, key, vocab):
+        shard_id, pos = self.index[key]
+        return self.load(shard_id, vocab)[pos]
+
+    def write(self, keys, docs, attrs):
+        shard_id = self._claim_shard()
+        path = self._shard_path(shard_id)
+
+        doc_bin = DocBin(attrs=list(attrs), store_user_data=True)
+        for doc in docs:
+            doc_bin.add(doc)
+        with open(path + '.spacy.tmp', 'wb') as f:
+            f.write(doc_bin.to_bytes())
+        os.replace(path + '.spacy.tmp', path + '.spacy')
+        with open(path + '.keys.json.tmp', 'w') as f:
+            json.dump(keys, f)
+        os.replace(path + '.keys.json.tmp', path + '.keys.json')
+
+        self.shards[shard_id] = list(docs)
+        for pos, key in enumerate(keys):
+            self.index.setdefault(key, (shard_id, pos))
+
+
+class DocCache:
+    """
+    cache_dir: root directory of the cache, None to disable persistence (memory only).
+    shard_size: number of docs per DocBin shard.
+    """
+
+    def __init__(self, cache_dir=None, shard_size=5000, attrs=DOC_ATTRS):
+        self.cache_dir = cache_dir
+        self.shard_size = shard_size
+        self.attrs = attrs
+        self._namespaces = {}
+        self._memory = {}
+
+    def _namespace(self, signature):
+        if signature not in self._namespaces:
+            self._namespaces[signature] = _Namespace(os.path.join(self.cache_dir, signature))
+        return self._namespaces[signature]
+
+    def docs(self, nlp, texts, batch_size=1000, disable=(), annotate=None):
+        """
+        Return one Doc per text, only texts not in the cache yet are parsed.
+
+        annotate: called on every newly parsed doc before it is stored, to keep
+            values of getter extensions in `doc.user_data`.
+        """
+        disable = [p for p in disable if p in nlp.pipe_names]
+        signature = pipeline_signature(nlp, disable, annotate)
+        keys = [text_key(t) for t in texts]
+
+        if self.cache_dir is None:
+            memory = self._memory.setdefault(signature, {})
+            lookup = memory.__contains__
+        else:
+            namespace = self._namespace(signature)
+            lookup = namespace.index.__contains__
+
+        todo = {}
+        for key, text in zip(keys, texts):
+            if not lookup(key) and key not in todo:
+                todo[key] = text
+        print(f"[doc_cache] {signature}: {len(set(keys)) - len(todo)} cached, {len(todo)} to parse")
+
+        todo_keys = list(todo.keys())
+        parsed = nlp.pipe(todo.values(), batch_size=batch_size, disable=disable)
+        for start in range(0, len(todo_keys), self.shard_size):
+            chunk_keys = todo_keys[start: start + self.shard_size]
+            chunk_docs = [doc for _, doc in zip(chunk_keys, parsed)]
+            if annotate is not None:
+                for doc in chunk_docs:
+                    annotate(doc)
+            if self.cache_dir is None:
+                memory.update(zip(chunk_keys, chunk_docs))
+            else:
+                namespace.write(chunk_keys, chunk_docs, self.attrs)
+
+        if self.cache_dir is None:
+            return [memory[k] for k in keys]
+        return [namespace.get(k, nlp.vocab) for k in keys]
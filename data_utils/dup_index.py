@@ -0,0 +1,242 @@
+"""
+Near duplicate image index, for running the expensive per image models once per group of duplicates.
+
+Many memes reuse the same base image with a different text (confounders),
+after the text is removed by inpainting (img_clean) they are near identical.
+Every image get a 64 bit perceptual hash (DCT hash of the 32x32 grayscale
+image, computed in a process pool and cached by sha1 of the file), images are
+near when their hashes differ in at most `threshold` bits (and have the same
+size by default, so pixel coordinates stay valid). In file name order, every
+image not grouped yet becomes a canonical image, and takes all its near images
+not grouped yet as members: a member is always within `threshold` bits of its
+canonical image, near pairs are not chained (A ~ B ~ C doesn't make A ~ C).
+
+Pairs are found by multi-index hashing: the hash is cut into `threshold + 1`
+chunks, two hashes within the threshold must have at least one identical chunk
+(pigeonhole), so only images sharing a chunk value are compared.
+
+    python3 dup_index.py build /meme_data/img_clean --threshold 6
+
+The result is saved next to the image directory (`<img_dir>.dups.json`):
+
+    {'images': {'01235.png': {'phash': '...', 'sha1': '...', 'canonical': '01235.png', 'canonical_sha1': '...'}, ...}}
+
+`canonical_map(path)` gives `{file name: canonical file name}`, used by
+gen_bbox.py (`--dup_map`) and the staged steps of pipeline.py to run the model
+on canonical images only and copy the results to the other members.
+"""
+import os
+import json
+import time
+from multiprocessing import Pool
+
+import fire
+import numpy as np
+from PIL import Image
+
+from image_index import ImageIndex
+
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    mat = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    mat[0] /= np.sqrt(2)
+    return mat
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def phash(img):
+    """
+    img: PIL image, return 64 bit perceptual hash as python int.
+    """
+    gray = img.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _phash_file(path):
+    try:
+        with Image.open(path) as img:
+            return format(phash(img), '016x')
+    except Exception as e:
+        print(f"[dup_index] can't hash {path}: {e}")
+        return None
+
+
+def popcount(x):
+    """
+    Number of set bits of every uint64 in x.
+    """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+def near_pairs(hashes, threshold, groups=None):
+    """
+    hashes: uint64 array, return (i, j) index arrays (i < j) of every pair within
+    `threshold` bits, and in the same group if `groups` (int array) is given.
+    """
+    n = len(hashes)
+    num_chunks = threshold + 1
+    bounds = np.linspace(0, 64, num_chunks + 1).astype(np.int64)
+    found_i, found_j = [], []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(hi - lo)) - 1)
+        chunk = (hashes >> np.uint64(lo)) & mask
+        group = np.zeros([n], np.int64) if groups is None else groups
+        order = np.lexsort((chunk, group))
+        sorted_chunk, sorted_group = chunk[order], group[order]
+        new_bucket = (sorted_chunk[1:] != sorted_chunk[:-1]) | (sorted_group[1:] != sorted_group[:-1])
+        starts = np.flatnonzero(np.r_[True, new_bucket])
+        ends = np.r_[starts[1:], n]
+        for s, e in zip(starts, ends):
+            if e - s < 2:
+                continue
+            members = order[s:e]
+            a, b = np.triu_indices(len(members), k=1)
+            a, b = members[a], members[b]
+            close = popcount(hashes[a] ^ hashes[b]) <= threshold
+            found_i.append(np.minimum(a[close], b[close]))
+            found_j.append(np.maximum(a[close], b[close]))
+    if not found_i:
+        return np.zeros([0], np.int64), np.zeros([0], np.int64)
+    pairs = np.unique(np.stack([np.concatenate(found_i), np.concatenate(found_j)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def canonical_groups(n, pair_i, pair_j):
+    """
+    Return the canonical index of every image, given the (i, j) near pairs:
+    the first image not grouped yet is canonical, its near images not grouped
+    yet are its members.
+    """
+    pair_i, pair_j = np.r_[pair_i, pair_j], np.r_[pair_j, pair_i]
+    order = np.argsort(pair_i, kind='stable')
+    neighbors = pair_j[order]
+    bounds = np.searchsorted(pair_i[order], np.arange(n + 1))
+
+    canonical = np.full([n], -1, np.int64)
+    for i in range(n):
+        if canonical[i] >= 0:
+            continue
+        canonical[i] = i
+        near = neighbors[bounds[i]: bounds[i + 1]]
+        near = near[canonical[near] < 0]
+        canonical[near] = i
+    return canonical
+
+
+class DupIndex:
+
+    def __init__(self, img_dir, index_path=None, threshold=6, same_size=True):
+        self.img_dir = os.path.abspath(img_dir)
+        self.index_path = index_path or self.img_dir.rstrip('/') + '.dups.json'
+        self.threshold = threshold
+        self.same_size = same_size
+        self.entries = {}  # relative path -> {phash, sha1, canonical, canonical_sha1}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.entries = json.load(f)['images']
+
+    def refresh(self, num_workers=8, max_depth=0, image_index=None):
+        """
+        image_index: up to date ImageIndex of img_dir refreshed with sha1, refreshed here if not given.
+        """
+        start = time.time()
+        if image_index is None:
+            image_index = ImageIndex(self.img_dir).refresh(num_workers=num_workers, sha1=True)
+        assert image_index.hashed, f"image index of {self.img_dir} must be refreshed with sha1"
+
+        images = {
+            os.path.relpath(p, self.img_dir): image_index.get(os.path.relpath(p, self.img_dir))
+            for p in image_index.paths(max_depth=max_depth)
+        }
+        todo = [p for p, e in images.items() if self.entries.get(p, {}).get('sha1') != e['sha1']]
+        if todo:
+            paths = [os.path.join(self.img_dir, p) for p in todo]
+            if num_workers > 1 and len(todo) > 1:
+                with Pool(num_workers) as pool:
+                    hashes = pool.map(_phash_file, paths, chunksize=64)
+            else:
+                hashes = [_phash_file(p) for p in paths]
+            for p, h in zip(todo, hashes):
+                self.entries[p] = {'phash': h, 'sha1': images[p]['sha1']}
+        self.entries = {p: e for p, e in self.entries.items() if p in images and e['phash'] is not None}
+
+        names = sorted(self.entries)
+        hashes = np.asarray([int(self.entries[p]['phash'], 16) for p in names], dtype=np.uint64)
+        groups = None
+        if self.same_size:
+            sizes = [(images[p]['w'], images[p]['h']) for p in names]
+            size_id = {s: i for i, s in enumerate(sorted(set(sizes)))}
+            groups = np.asarray([size_id[s] for s in sizes], dtype=np.int64)
+        pair_i, pair_j = near_pairs(hashes, self.threshold, groups)
+        roots = canonical_groups(len(names), pair_i, pair_j)
+        for p, root in zip(names, roots):
+            canonical = names[root]
+            self.entries[p]['canonical'] = canonical
+            self.entries[p]['canonical_sha1'] = self.entries[canonical]['sha1']
+
+        self.save()
+        num_canonical = len(set(roots.tolist()))
+        print(
+            f"[dup_index] {self.img_dir}: {len(names)} images, {len(todo)} hashed, {len(pair_i)} near pairs, "
+            f"{num_canonical} canonical images ({1 - num_canonical / max(len(names), 1):.1%} less) "
+            f"in {time.time() - start:.1f}s")
+        return self
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'img_dir': self.img_dir,
+                'threshold': self.threshold,
+                'same_size': self.same_size,
+                'images': self.entries,
+            }, f)
+        os.replace(tmp_path, self.index_path)
+
+    def canonical_map(self):
+        return {p: e['canonical'] for p, e in self.entries.items()}
+
+    def clusters(self):
+        result = {}
+        for p, e in sorted(self.entries.items()):
+            result.setdefault(e['canonical'], []).append(p)
+        return result
+
+
+def canonical_map(index_path):
+    """
+    Return {file name: canonical file name} of a saved dup index.
+    """
+    with open(index_path, 'r') as f:
+        entries = json.load(f)['images']
+    return {p: e['canonical'] for p, e in entries.items()}
+
+
+def build(img_dir, index_path=None, threshold=6, same_size=True, num_workers=8):
+    index = DupIndex(img_dir, index_path=index_path, threshold=threshold, same_size=same_size)
+    index.refresh(num_workers=num_workers)
+    clusters = [c for c in index.clusters().values() if len(c) > 1]
+    clusters = sorted(clusters, key=len, reverse=True)
+    for members in clusters[:10]:
+        print(f"{len(members):>4} {', '.join(members[:8])}{' ...' if len(members) > 8 else ''}")
+    print(f"Saved: {index.index_path}")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'build': build,
+    })
@@ -0,0 +1,168 @@
+"""
+Per meme annotation logic of `insert_anno_jsonl`: split image boxes, the image
+box of every character of the meme text, and the partition descriptions.
+
+Same results as the original nested functions of `insert_anno_jsonl`, with
+the OCR box / image box coverage computed as one matrix and the per character
+arrays filled with numpy slices instead of python loops.
+"""
+import numpy as np
+
+import fuzzy_match
+
+
+def refine_split_box(boxes, w, h):
+    if len(boxes) > 1:
+        if w > h:
+            boxes = sorted(boxes, key=lambda x: x[0])
+            for j in range(len(boxes) - 1):
+                boxes[j + 1][0] = boxes[j][2] = (boxes[j][2] + boxes[j + 1][0]) / 2
+
+            boxes[0][0] = 0
+            boxes[-1][2] = w
+            for j in range(len((boxes))):
+                boxes[j][1] = 0
+                boxes[j][3] = h
+        else:
+            boxes = sorted(boxes, key=lambda x: x[1])
+            for j in range(len(boxes) - 1):
+                boxes[j][3] = boxes[j + 1][1] = (boxes[j][3] + boxes[j + 1][1]) / 2
+
+            boxes[0][1] = 0
+            boxes[-1][3] = h
+            for j in range(len((boxes))):
+                boxes[j][0] = 0
+                boxes[j][2] = w
+        return boxes
+    else:
+        return [[0, 0, w, h, 1.0]]
+
+
+def box_coverage(img_boxes, ocr_boxes):
+    """
+    Return (num_ocr, num_img) matrix, fraction of every OCR box area covered by every image box.
+    """
+    img = np.asarray([b[:4] for b in img_boxes], dtype=np.float64)[None, :, :]
+    ocr = np.asarray([b[:4] for b in ocr_boxes], dtype=np.float64)[:, None, :]
+    w = ocr[..., 2] - ocr[..., 0]
+    h = ocr[..., 3] - ocr[..., 1]
+    cover_w = np.minimum(
+        np.maximum(np.minimum(img[..., 2] - ocr[..., 0], w), 0),
+        np.maximum(np.minimum(ocr[..., 2] - img[..., 0], w), 0))
+    cover_h = np.minimum(
+        np.maximum(np.minimum(img[..., 3] - ocr[..., 1], h), 0),
+        np.maximum(np.minimum(ocr[..., 3] - img[..., 1], h), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (cover_h * cover_w) / (w * h)
+
+
+def _fill_unmatched_(char_box):
+    """
+    In-place: give every character without image box (-1) the box of its
+    neighbours, run by run, same rules as the original per character loop.
+    """
+    n = len(char_box)
+    i = 0
+    while i < n:
+        if char_box[i] >= 0:
+            i += 1
+            continue
+        matched = np.flatnonzero(char_box[i:] >= 0)
+        if len(matched):
+            next_match = i + int(matched[0])
+            next_img_id = int(char_box[next_match])
+        else:
+            next_match = n
+            next_img_id = int(char_box.max())
+        prev_img_id = int(char_box[:i].max()) if i > 0 else -1
+
+        if prev_img_id == next_img_id:
+            char_box[i: next_match] = prev_img_id
+        elif prev_img_id < next_img_id:
+            char_box[i: next_match] = prev_img_id + 1
+        else:
+            # NOTE: happend when ocr's detected text not matching actual anno text.
+            mid = (i + next_match) // 2
+            char_box[i: next_match] = prev_img_id
+            char_box[max(mid + 1, i): next_match] = next_img_id
+        i = next_match
+    return char_box
+
+
+def _assign_(char_box, start, stop, value):
+    # NOTE: python list assignment semantic, negative index wrap around, out of range raise.
+    n = len(char_box)
+    if start >= stop:
+        return
+    if start < -n or stop - 1 >= n:
+        raise IndexError('list assignment index out of range')
+    if start < 0 <= stop - 1:
+        char_box[start:] = value
+        char_box[:stop] = value
+    else:
+        char_box[start % n: (stop - 1) % n + 1] = value
+
+
+def find_appearence(meme_txt, ocr_boxes, img_boxes, logger=None):
+    """
+    Return list, index of the image box of every character of meme_txt.
+    """
+    box_by_x = sorted(ocr_boxes, key=lambda box_info: box_info[0][0])
+    box_by_xy = sorted(box_by_x, key=lambda box_info: box_info[0][1])
+    if box_by_xy:
+        cover = box_coverage(img_boxes, [box_info[0] for box_info in box_by_xy])
+        ocr_to_img_box = np.argmax(cover, axis=1).tolist()
+    else:
+        ocr_to_img_box = []
+
+    matches = []
+    for box, txt, score in box_by_xy:
+        match_slice, match_score = fuzzy_match.best_match(txt, meme_txt, step=2, flex=4)
+        matches.append((match_slice, match_score))
+        if match_score < 0.75 and logger is not None:
+            logger.warning(f"Low match score! {match_score}")
+
+    char_box = np.full([len(meme_txt)], -1, dtype=np.int64)
+    for i, (match_slice, match_score) in enumerate(matches):
+        match_len = match_slice.stop - match_slice.start
+        if match_len < 6 and match_score < 0.75:
+            continue
+        elif match_score < 0.6:
+            continue
+
+        _assign_(char_box, match_slice.start, min(match_slice.stop, len(meme_txt)), ocr_to_img_box[i])
+        if i < len(matches) - 1:
+            # NOTE: the original code use the slice of the previous box here, kept as is.
+            next_slice = matches[i - 1][0]
+            _assign_(char_box, match_slice.stop, next_slice.start, ocr_to_img_box[i])
+
+    if len(char_box):
+        _fill_unmatched_(char_box)
+    return char_box.tolist()
+
+
+def partition_description(img_id, num_boxes, entity_map, title_summaries):
+    if img_id in entity_map:
+        img_entitys_splits = entity_map[img_id]
+        summaries_splits = title_summaries[img_id]
+    else:
+        if img_id in title_summaries:
+            summaries_splits = title_summaries[img_id]
+            img_entitys_splits = {k: [] for k in summaries_splits.keys()}
+        else:
+            summaries_splits = {}
+            img_entitys_splits = {}
+
+    descriptions = []
+    for sn in range(num_boxes):
+        if sn in img_entitys_splits:
+            entitys = list(img_entitys_splits[sn])
+        else:
+            entitys = []
+        use_title = len(entitys) <= 2
+        if use_title:
+            if sn in summaries_splits:
+                web_page_summaries = summaries_splits[sn]
+                entitys += [' '.join(s) for s in web_page_summaries]
+        descriptions.append(entitys)
+    return descriptions
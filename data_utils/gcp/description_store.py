@@ -0,0 +1,135 @@
+"""
+Sharded store of parsed web detection results, one row per detection json file:
+
+    file, id, split, has_pages, entities, titles, raw
+
+`split` is -1 for the detection of the whole image (`<id>.json`) and n for the
+n-th split (`<id>.<n>.json`), `raw` is the original json text. Shards are
+Parquet files (`desc_XXXXX.parquet`) if pyarrow is installed, json lines
+(`desc_XXXXX.jsonl`) otherwise, and are only ever added: `append` writes the
+rows of newly detected files into a new shard, atomically.
+
+Only the `file` and `id` columns are read to build the index, full shards are
+loaded on demand by `lookup`, and `entity_title_maps` rebuilds the
+`entity_map` / `title_map` layout of the original pickle.
+"""
+import os
+import glob
+import json
+
+import pandas as pd
+
+
+COLUMNS = ['file', 'id', 'split', 'has_pages', 'entities', 'titles', 'raw']
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class DescriptionStore:
+
+    def __init__(self, root, backend=None):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        existing = sorted(glob.glob(os.path.join(root, 'desc_*.*')))
+        existing = [p for p in existing if not p.endswith('.tmp')]
+        if backend is None:
+            if existing:
+                backend = 'parquet' if existing[0].endswith('.parquet') else 'jsonl'
+            else:
+                backend = 'parquet' if _has_pyarrow() else 'jsonl'
+        self.backend = backend
+        self.ext = '.parquet' if backend == 'parquet' else '.jsonl'
+
+        self.shards = [p for p in existing if p.endswith(self.ext)]
+        self._loaded = {}
+        self.file_index = {}  # json file name -> (shard, row)
+        self.id_index = {}  # image id -> [(shard, row), ...]
+        for s, path in enumerate(self.shards):
+            self._index_shard(s, self._read(path, columns=['file', 'id']))
+
+    def __len__(self):
+        return len(self.file_index)
+
+    def _read(self, path, columns=None):
+        if self.backend == 'parquet':
+            return pd.read_parquet(path, columns=columns)
+        df = pd.read_json(path, lines=True, dtype={'id': str})
+        return df if columns is None else df[columns]
+
+    def _index_shard(self, s, df):
+        for row, (file, img_id) in enumerate(zip(df['file'], df['id'])):
+            self.file_index[file] = (s, row)
+            self.id_index.setdefault(img_id, []).append((s, row))
+
+    def has_file(self, file):
+        return file in self.file_index
+
+    def append(self, rows):
+        if not rows:
+            return None
+        df = pd.DataFrame(rows, columns=COLUMNS)
+        s = len(self.shards)
+        path = os.path.join(self.root, f"desc_{s:05d}{self.ext}")
+        tmp_path = path + '.tmp'
+        if self.backend == 'parquet':
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_json(tmp_path, orient='records', lines=True, force_ascii=False)
+        os.replace(tmp_path, path)
+
+        self.shards.append(path)
+        self._loaded[s] = df
+        self._index_shard(s, df)
+        return path
+
+    def _shard(self, s):
+        if s not in self._loaded:
+            self._loaded[s] = self._read(self.shards[s])
+        return self._loaded[s]
+
+    def lookup(self, img_id, raw=False):
+        """
+        Return list of row dict (without the raw json unless `raw`) of an image id.
+        """
+        result = []
+        for s, row in self.id_index.get(str(img_id), []):
+            rec = self._shard(s).iloc[row].to_dict()
+            rec['entities'] = list(rec['entities'])
+            rec['titles'] = list(rec['titles'])
+            if raw:
+                rec['raw'] = json.loads(rec['raw'])
+            else:
+                rec.pop('raw')
+            result.append(rec)
+        return result
+
+    def entity_title_maps(self):
+        """
+        Same `entity_map`, `title_map` as the original create_description: detection
+        of the splits if the image has any, otherwise the one of the whole image (as split 0).
+        """
+        frames = []
+        for path in self.shards:
+            cols = ['id', 'split', 'has_pages', 'entities', 'titles']
+            frames.append(self._read(path, columns=cols))
+        if not frames:
+            return {}, {}
+        df = pd.concat(frames, ignore_index=True)
+        df = df.drop_duplicates(['id', 'split'], keep='last')
+
+        has_split = set(df.loc[df['split'] >= 0, 'id'])
+        use = (df['split'] >= 0) | ~df['id'].isin(has_split)
+        df = df[use & df['has_pages']]
+
+        entity_map, title_map = {}, {}
+        for img_id, split, entities, titles in zip(df['id'], df['split'], df['entities'], df['titles']):
+            split_n = max(int(split), 0)
+            entity_map.setdefault(img_id, {})[split_n] = list(entities)
+            title_map.setdefault(img_id, {})[split_n] = list(titles)
+        return entity_map, title_map
@@ -0,0 +1,423 @@
+"""
+Batched page title cleaning for `titles_cleanup`.
+
+Blacklist: entries are regex patterns removed one after the other, and a later
+entry can match text joined by an earlier removal, so a single alternation
+applied once is NOT equivalent (it changes ~9% of typical stock photo titles).
+`BlacklistCleaner` keeps the sequential result but:
+    * all patterns are compiled once into one alternation, a title it doesn't
+      match in one pass is returned untouched;
+    * every pattern without alternation has a required literal (longest
+      run between `.`), patterns whose literal isn't in the title are skipped.
+
+Language: `LanguageFilter` decides most titles without spaCy,
+    * titles with letters but no latin letter are not english;
+    * latin titles scored english by `NgramLanguageId` are english: a built-in
+      profile (`lang_profile.json.gz`) of character trigram log likelihood
+      ratios (english / other latin languages), english words and stop words;
+    * or, if given, a fastText language id model (eg. lid.176.ftz, needs the
+      optional `fasttext` package), predictions under `threshold` are ambiguous;
+and only ambiguous titles go through the spaCy `LanguageDetector` pipeline.
+The built-in profile never calls a latin title non english (names and short
+titles are too easy to get wrong), those are left to spaCy.
+
+    python3 title_cleaner.py benchmark
+    python3 title_cleaner.py benchmark --fasttext_model lid.176.ftz
+    python3 title_cleaner.py check_doc_cache
+"""
+import os
+import re
+import gzip
+import json
+import math
+import time
+from collections import Counter
+
+import fire
+
+
+LATIN_END = '\u0250'  # end of the latin extended blocks
+WORD_PAT = re.compile(r"[^\W\d_]+")
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lang_profile.json.gz')
+
+
+class BlacklistCleaner:
+
+    _NON_LITERAL = set('|()[]?*+{}\\^$')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.gate = re.compile('|'.join(f'(?:{p})' for p in self.patterns))
+        self.compiled = [(re.compile(p), self._required_literal(p)) for p in self.patterns]
+
+    @classmethod
+    def _required_literal(cls, pattern):
+        if any(c in cls._NON_LITERAL for c in pattern):
+            return None
+        return max(pattern.split('.'), key=len) or None
+
+    def clean(self, text):
+        if self.gate.search(text) is None:
+            return text
+        for regex, literal in self.compiled:
+            if literal is not None and literal not in text:
+                continue
+            text = regex.sub('', text)
+        return text
+
+    def clean_batch(self, texts):
+        return [self.clean(t) for t in texts]
+
+
+def _trigrams(word):
+    word = f" {word} "
+    return [word[i: i + 3] for i in range(len(word) - 2)]
+
+
+class NgramLanguageId:
+    """
+    predict() return 'en' or None (undecided) for each text.
+
+    Every word of two or more letters gets a score: english stop word +2,
+    stop word of another latin language only -4, english word +1.5, otherwise
+    the mean trigram log likelihood ratio of the word. Text with a mean word
+    score over `threshold` is english.
+    """
+
+    def __init__(self, profile_path=DEFAULT_PROFILE, threshold=1.0):
+        with gzip.open(profile_path, 'rt', encoding='utf-8') as f:
+            profile = json.load(f)
+        self.trigram_llr = profile['trigram_llr']
+        self.en_words = set(profile['en_words'])
+        self.en_stop_words = set(profile['en_stop_words'])
+        self.other_stop_words = set(profile['other_stop_words'])
+        self.threshold = threshold
+        self._word_scores = {}
+
+    def word_score(self, word):
+        score = self._word_scores.get(word)
+        if score is None:
+            if word in self.en_stop_words:
+                score = 2.0
+            elif word in self.other_stop_words:
+                score = -4.0
+            elif word in self.en_words:
+                score = 1.5
+            else:
+                grams = _trigrams(word)
+                score = sum(self.trigram_llr.get(g, 0.0) for g in grams) / len(grams)
+            self._word_scores[word] = score
+        return score
+
+    def score(self, text):
+        words = [w for w in WORD_PAT.findall(text.lower()) if len(w) > 1]
+        if not words:
+            return None
+        return sum(self.word_score(w) for w in words) / len(words)
+
+    def predict(self, texts):
+        result = []
+        for t in texts:
+            score = self.score(t)
+            result.append('en' if score is not None and score > self.threshold else None)
+        return result
+
+
+class LanguageFilter:
+    """
+    detect() return 'en', 'other' or None (ambiguous, let spaCy decide) for each text.
+
+    fasttext_model: path of a fastText language id model, used instead of the built-in profile.
+    ngram_profile: built-in profile of NgramLanguageId, None to leave every latin title to spaCy.
+    """
+
+    def __init__(self, fasttext_model=None, threshold=0.9, ngram_profile=DEFAULT_PROFILE, ngram_threshold=1.0):
+        self.threshold = threshold
+        self.model = None
+        self.ngram = None
+        if fasttext_model is not None:
+            import fasttext
+            self.model = fasttext.load_model(fasttext_model)
+        elif ngram_profile is not None:
+            self.ngram = NgramLanguageId(ngram_profile, threshold=ngram_threshold)
+
+    @staticmethod
+    def _script(text):
+        letters = [c for c in text if c.isalpha()]
+        if not letters:
+            return None
+        if all(c >= LATIN_END for c in letters):
+            return 'other'
+        return 'latin'
+
+    def detect(self, texts):
+        result = [None] * len(texts)
+        latin_idx = []
+        for i, t in enumerate(texts):
+            script = self._script(t)
+            if script == 'other':
+                result[i] = 'other'
+            elif script == 'latin':
+                latin_idx.append(i)
+
+        if self.model is not None and latin_idx:
+            labels, probs = self.model.predict([texts[i].replace('\n', ' ') for i in latin_idx], k=1)
+            for i, label, prob in zip(latin_idx, labels, probs):
+                if prob[0] < self.threshold:
+                    continue
+                result[i] = 'en' if label[0] == '__label__en' else 'other'
+        elif self.ngram is not None and latin_idx:
+            for i, lang in zip(latin_idx, self.ngram.predict([texts[i] for i in latin_idx])):
+                result[i] = lang
+        return result
+
+
+def pos_filtered_text(doc):
+    senten = ''
+    for token in doc:
+        if token.pos_ != 'NUM' and token.pos_ != 'X':
+            senten += token.text.lower() + ' '
+    return senten
+
+
+def store_language(doc):
+    """
+    Keep the `LanguageDetector` result in user_data: `doc._.language` is a getter
+    registered by the detector when it runs, neither saved by DocBin nor available
+    when every doc comes from the cache.
+    """
+    doc.user_data['language'] = doc._.language['language']
+
+
+def doc_language(doc):
+    return doc.user_data['language']
+
+
+def _annotated(docs, annotate):
+    for doc in docs:
+        if annotate is not None:
+            annotate(doc)
+        yield doc
+
+
+def _parse(nlp, texts, batch_size, disable, doc_cache, annotate=None):
+    if doc_cache is not None:
+        return doc_cache.docs(nlp, texts, batch_size=batch_size, disable=disable, annotate=annotate)
+    return _annotated(nlp.pipe(texts, batch_size=batch_size, disable=disable), annotate)
+
+
+def clean_titles(titles, nlp, cleaner, lang_filter=None, batch_size=1000, lang_pipe='language_detector',
+                 doc_cache=None):
+    """
+    Return one cleaned title per input title, None for non english titles.
+
+    nlp: pipeline with a `LanguageDetector` named `lang_pipe`, only run on ambiguous titles.
+    doc_cache: optional `doc_cache.DocCache`, titles parsed by a previous run are not parsed again.
+    """
+    langs = lang_filter.detect(titles) if lang_filter is not None else [None] * len(titles)
+    result = [None] * len(titles)
+
+    known_en = [i for i, lang in enumerate(langs) if lang == 'en']
+    ambiguous = [i for i, lang in enumerate(langs) if lang is None]
+    print(
+        f"[title_cleaner] {len(known_en)} english, {len(titles) - len(known_en) - len(ambiguous)} other, "
+        f"{len(ambiguous)} ambiguous titles")
+
+    # NOTE: only POS is needed for english titles, the language detector and parser are disabled.
+    disable = [p for p in [lang_pipe, 'parser', 'ner'] if p in nlp.pipe_names]
+    docs = _parse(nlp, [titles[i] for i in known_en], batch_size, disable, doc_cache)
+    for i, doc in zip(known_en, docs):
+        result[i] = cleaner.clean(pos_filtered_text(doc))
+
+    docs = _parse(nlp, [titles[i] for i in ambiguous], batch_size, [], doc_cache, annotate=store_language)
+    for i, doc in zip(ambiguous, docs):
+        if doc_language(doc) == 'en':
+            result[i] = cleaner.clean(pos_filtered_text(doc))
+    return result
+
+
+def _legacy_clean(text, patterns):
+    for b in patterns:
+        text = re.sub(b, '', text)
+    return text
+
+
+def build_lang_profile(out_path=DEFAULT_PROFILE, vocab_txt=None, eps=1e-5):
+    """
+    Build the NgramLanguageId profile.
+
+    english: whole words of the (frequency ordered) uncased BERT vocab shipped with
+        ERNIE-Vil, weighted by 1 / sqrt(rank), and spaCy's english stop words.
+    other: stop words and number words of every latin language of spaCy.
+    """
+    import importlib
+    import spacy.lang
+
+    if vocab_txt is None:
+        vocab_txt = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ERNIE-Vil', 'model_config', 'vocab.txt')
+
+    def is_latin(word):
+        return all(c < LATIN_END for c in word)
+
+    with open(vocab_txt, 'r', encoding='utf-8') as f:
+        en_words = [w for w in (line.strip() for line in f) if w.isalpha() and len(w) > 1 and is_latin(w)]
+    en_stop_words = set(importlib.import_module('spacy.lang.en.stop_words').STOP_WORDS)
+
+    other_words = Counter()
+    lang_dir = os.path.dirname(spacy.lang.__file__)
+    for lang in sorted(os.listdir(lang_dir)):
+        if lang in ('en', 'xx'):
+            continue
+        try:
+            stop_words = importlib.import_module(f'spacy.lang.{lang}.stop_words').STOP_WORDS
+        except ImportError:
+            continue
+        words = [w.lower() for w in stop_words if w.isalpha()]
+        if len(words) < 50 or sum(map(is_latin, words)) < 0.8 * len(words):
+            continue
+        other_words.update(words)
+        try:
+            lex_attrs = importlib.import_module(f'spacy.lang.{lang}.lex_attrs')
+        except ImportError:
+            continue
+        for value in vars(lex_attrs).values():
+            if isinstance(value, (list, set, tuple)) and value and all(isinstance(v, str) for v in value):
+                for v in value:
+                    other_words.update(WORD_PAT.findall(v.lower()))
+
+    def trigram_freq(weighted_words):
+        counts = Counter()
+        for word, weight in weighted_words:
+            for g in _trigrams(word):
+                counts[g] += weight
+        total = sum(counts.values())
+        return {g: c / total for g, c in counts.items()}
+
+    en_freq = trigram_freq((w, 1 / math.sqrt(i + 10)) for i, w in enumerate(en_words))
+    other_freq = trigram_freq(other_words.items())
+    trigram_llr = {}
+    for g in set(en_freq) | set(other_freq):
+        llr = math.log((en_freq.get(g, 0) + eps) / (other_freq.get(g, 0) + eps))
+        if abs(llr) >= 0.05:
+            trigram_llr[g] = round(llr, 2)
+
+    # NOTE: frequent english words (eg. 'man', 'die', 'is') are stop words of some other language too.
+    common_en = set(en_words[:200]) | en_stop_words
+    profile = {
+        'trigram_llr': dict(sorted(trigram_llr.items())),
+        'en_words': en_words,
+        'en_stop_words': sorted(en_stop_words),
+        'other_stop_words': sorted(w for w in other_words if w not in common_en),
+    }
+    with gzip.open(out_path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(out_path + '.tmp', out_path)
+    print(f"{len(trigram_llr)} trigrams, {len(en_words)} english words, "
+          f"{len(profile['other_stop_words'])} other stop words -> {out_path}")
+
+
+def benchmark(num_images=300, seed=1, fasttext_model=None):
+    import title_dedup
+    from web_enetity import noun_chunk_blist, entity_black_list
+
+    patterns = noun_chunk_blist + entity_black_list
+    titles = [t.lower() for ts in title_dedup.title_fixture(num_images=num_images, seed=seed) for t in ts]
+    # NOTE: rough stand-in of the space joined spaCy tokens the cleaner receives.
+    tokenized = [' '.join(re.findall(r"\w+|[^\w\s]", t)) + ' ' for t in titles]
+
+    start = time.time()
+    expect = [_legacy_clean(t, patterns) for t in tokenized]
+    legacy_sec = time.time() - start
+
+    cleaner = BlacklistCleaner(patterns)
+    start = time.time()
+    result = cleaner.clean_batch(tokenized)
+    fast_sec = time.time() - start
+    assert result == expect, "cleaned titles mismatch"
+    print(f"blacklist: legacy {len(titles) / legacy_sec:.0f} titles/s, combined {len(titles) / fast_sec:.0f} titles/s")
+
+    lang_filter = LanguageFilter(fasttext_model)
+    start = time.time()
+    langs = lang_filter.detect(titles)
+    lang_sec = time.time() - start
+    undecided = sum(lang is None for lang in langs)
+    print(f"language: {len(titles) / lang_sec:.0f} titles/s, {undecided}/{len(titles)} left to spaCy")
+
+
+class _StandInDetector:
+    """
+    Registers `doc._.language` as a getter when called, like spacy_langdetect's LanguageDetector.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, doc):
+        from spacy.tokens import Doc
+
+        self.calls += 1
+        Doc.set_extension('language', getter=self._detect, force=True)
+        return doc
+
+    @staticmethod
+    def _detect(doc):
+        return {'language': 'en' if 'the' in doc.text.split() else 'fr', 'score': 1.0}
+
+
+def _stand_in_nlp(detector):
+    import spacy
+    from spacy.language import Language
+
+    nlp = spacy.blank('en')
+    try:
+        nlp.add_pipe(detector, name='language_detector', last=True)
+    except ValueError:
+        # NOTE: spaCy 3 only adds registered factories by name
+        Language.component('language_detector', func=detector)
+        nlp.add_pipe('language_detector', last=True)
+    return nlp
+
+
+def check_doc_cache():
+    """
+    Rerun clean_titles with every ambiguous title in the doc cache (the detector
+    extension not registered, as in a new process), and write one namespace from
+    two caches opened before either wrote (as forked workers do).
+    """
+    import sys
+    import tempfile
+    from spacy.tokens import Doc
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from doc_cache import DocCache
+
+    titles = ['the cat in the hat stock photo', 'le chat', 'the dog', 'un chien', 'le chat']
+    cleaner = BlacklistCleaner(['stock photo'])
+    with tempfile.TemporaryDirectory() as cache_dir:
+        detector = _StandInDetector()
+        first = clean_titles(titles, _stand_in_nlp(detector), cleaner, doc_cache=DocCache(cache_dir))
+        assert detector.calls == 4, detector.calls
+        assert first == ['the cat in the hat  ', None, 'the dog ', None, None], first
+
+        Doc.remove_extension('language')
+        detector = _StandInDetector()
+        second = clean_titles(titles, _stand_in_nlp(detector), cleaner, doc_cache=DocCache(cache_dir))
+        assert detector.calls == 0, detector.calls
+        assert second == first, second
+
+        nlp = _stand_in_nlp(_StandInDetector())
+        cache_a, cache_b = DocCache(cache_dir, shard_size=1), DocCache(cache_dir, shard_size=1)
+        cache_a.docs(nlp, ['a b'], annotate=store_language)
+        cache_b.docs(nlp, ['c d', 'e f'], annotate=store_language)
+        docs = DocCache(cache_dir).docs(nlp, ['a b', 'c d', 'e f'], annotate=store_language)
+        assert [d.text for d in docs] == ['a b', 'c d', 'e f']
+    print("OK")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'benchmark': benchmark,
+        'check_doc_cache': check_doc_cache,
+        'build_lang_profile': build_lang_profile,
+    })
@@ -0,0 +1,397 @@
+"""
+Concurrent Cloud Vision web detection client, and a local stand-in server.
+
+Requests go to the REST endpoint `images:annotate`, whose `webDetection`
+response has the same (camelCase) layout as the `MessageToJson` output of the
+python client, so the per-image json files don't change for later stages.
+
+    * at most `concurrency` requests in flight;
+    * a token bucket keeps the request rate under `qps`;
+    * 429, 5xx and network errors are retried with exponential backoff + jitter;
+    * the OAuth token is refreshed before it expires, and on a 401 (then retried);
+    * every result is written to `<image>.json` atomically (tmp + rename), images
+      that already have one are skipped, so any run can be killed and restarted;
+    * progress (done / failed / retries) is checkpointed to `_progress.ckpt` (json).
+
+Stand-in server, answering with fake web detection, latency and errors:
+
+    python3 web_detect_client.py serve --port 8080 --latency 0.2 --error_rate 0.1
+    python3 web_detect_client.py benchmark
+"""
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+import requests
+from requests.adapters import HTTPAdapter
+
+
+VISION_ENDPOINT = 'https://vision.googleapis.com/v1/images:annotate'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# NOTE: not *.json, the output dir is globbed for detection results.
+PROGRESS_FILE = '_progress.ckpt'
+
+
+def json_name_of(img_path):
+    img_name = os.path.basename(img_path)
+    return img_name.replace('.jpg', '').replace('.png', '') + '.json'
+
+
+def write_json_atomic(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, at most `burst` tokens saved up.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class KeyAuth:
+    """
+    API key (or nothing, for the stand-in server), never expires.
+    """
+
+    def __init__(self, api_key=None):
+        self.params = {'key': api_key} if api_key else {}
+
+    def get(self):
+        return self.params, {}
+
+    def invalidate(self, headers):
+        return False
+
+
+class BearerAuth:
+    """
+    OAuth token of the application default credentials, refreshed when it is
+    (about to be) expired, or when the server rejected it.
+    """
+
+    def __init__(self):
+        import google.auth
+        import google.auth.transport.requests
+
+        self.credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-vision'])
+        self._request = google.auth.transport.requests.Request()
+        self._lock = threading.Lock()
+
+    def _headers(self):
+        return {'Authorization': f"Bearer {self.credentials.token}"}
+
+    def get(self):
+        with self._lock:
+            # NOTE: `valid` is False without token or when it expires in the next few minutes
+            if not self.credentials.valid:
+                self.credentials.refresh(self._request)
+                print(f"[auth] token refreshed, expiry {self.credentials.expiry}")
+            return {}, self._headers()
+
+    def invalidate(self, headers):
+        with self._lock:
+            # NOTE: concurrent 401s with the same token only refresh it once
+            if headers == self._headers():
+                self.credentials.refresh(self._request)
+                print(f"[auth] token rejected, refreshed, expiry {self.credentials.expiry}")
+        return True
+
+
+def make_auth(endpoint, api_key=None):
+    api_key = api_key or os.environ.get('GOOGLE_API_KEY')
+    if endpoint != VISION_ENDPOINT or api_key:
+        return KeyAuth(api_key)
+    return BearerAuth()
+
+
+class WebDetectionClient:
+
+    def __init__(self, endpoint=VISION_ENDPOINT, api_key=None, concurrency=16, qps=10,
+                 max_retries=6, backoff=1.0, max_backoff=60, timeout=60, auth=None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.auth = auth
+        self.concurrency = concurrency
+        self.qps = qps
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.stats = {'done': 0, 'skipped': 0, 'failed': 0, 'retries': 0}
+        self.failures = {}
+        self._local = threading.local()
+        self._sessions = []
+
+    def _session(self):
+        # NOTE: one keep-alive session per executor thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self._local.session = session
+            self._sessions.append(session)
+        return session
+
+    def _post(self, body):
+        params, headers = self.auth.get()
+        try:
+            resp = self._session().post(
+                self.endpoint, params=params, headers=headers, json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            # NOTE: connection reset, timeout, ... are worth a retry
+            raise RetryableError(repr(e))
+        if resp.status_code == 401 and self.auth.invalidate(headers):
+            raise RetryableError("HTTP 401, token refreshed")
+        if resp.status_code in RETRY_STATUS:
+            raise RetryableError(f"HTTP {resp.status_code}")
+        resp.raise_for_status()
+        return resp.json()
+
+    async def _request(self, executor, bucket, content):
+        body = {
+            'requests': [{
+                'image': {'content': base64.b64encode(content).decode('ascii')},
+                'features': [{'type': 'WEB_DETECTION'}],
+            }]
+        }
+        await bucket.acquire()
+        resp = await asyncio.get_event_loop().run_in_executor(executor, self._post, body)
+
+        result = resp['responses'][0]
+        if 'error' in result:
+            raise RuntimeError(result['error'].get('message', result['error']))
+        return result.get('webDetection', {})
+
+    async def detect(self, executor, bucket, img_path):
+        with open(img_path, 'rb') as f:
+            content = f.read()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._request(executor, bucket, content)
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats['retries'] += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                print(f"[retry {attempt + 1}] {os.path.basename(img_path)}: {e}, wait {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def _checkpoint(self, output_dir, total):
+        write_json_atomic(os.path.join(output_dir, PROGRESS_FILE), {
+            'total': total,
+            'stats': self.stats,
+            'failures': self.failures,
+            'time': time.time(),
+        })
+
+    async def run(self, img_paths, output_dir, checkpoint_every=100):
+        os.makedirs(output_dir, exist_ok=True)
+        if self.auth is None:
+            self.auth = make_auth(self.endpoint, self.api_key)
+        bucket = TokenBucket(self.qps)
+        queue = asyncio.Queue()
+        for path in img_paths:
+            queue.put_nowait(path)
+        total = len(img_paths)
+        start = time.time()
+
+        async def worker(executor):
+            while True:
+                try:
+                    img_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                json_path = os.path.join(output_dir, json_name_of(img_path))
+                if os.path.exists(json_path):
+                    self.stats['skipped'] += 1
+                    continue
+                try:
+                    annotations = await self.detect(executor, bucket, img_path)
+                    write_json_atomic(json_path, annotations)
+                    self.stats['done'] += 1
+                    self.failures.pop(img_path, None)
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    self.failures[img_path] = repr(e)
+                    print(f"[failed] {img_path}: {e!r}")
+
+                finished = self.stats['done'] + self.stats['failed']
+                if finished % checkpoint_every == 0:
+                    speed = self.stats['done'] / (time.time() - start)
+                    print(f"[{finished + self.stats['skipped']}/{total}] {self.stats}, {speed:.2f} img/s")
+                    self._checkpoint(output_dir, total)
+
+        # NOTE: blocking `requests` calls run in threads, at most `concurrency` in flight
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            await asyncio.gather(*[worker(executor) for _ in range(self.concurrency)])
+        for session in self._sessions:
+            session.close()
+        self._sessions.clear()
+        self._checkpoint(output_dir, total)
+        return self.stats
+
+
+"""
+Local stand-in of the web detection API
+"""
+
+_PAGE_WORDS = [
+    'obama', 'trump', 'meme', 'dog', 'cat', 'muslim', 'funny', 'black', 'white', 'woman', 'man',
+    'kitchen', 'border', 'wall', 'goat', 'zoo', 'gorilla', 'dishwasher', 'hitler', 'hijab',
+]
+
+
+def fake_web_detection(content):
+    rng = random.Random(hashlib.sha1(content).hexdigest())
+    subject = ' '.join(rng.sample(_PAGE_WORDS, 2)).title()
+    sites = ['Getty Images', 'iStock', 'Pinterest', 'Wikipedia', 'Imgflip']
+    return {
+        'webEntities': [
+            {'entityId': f"/m/{rng.randrange(10 ** 6):06d}", 'score': rng.random(), 'description': w.title()}
+            for w in rng.sample(_PAGE_WORDS, 4)
+        ],
+        'pagesWithMatchingImages': [
+            {
+                'url': f"https://example.com/{i}",
+                'pageTitle': f"{subject} &amp; <b>{w.title()}</b> - {rng.choice(sites)}",
+            }
+            for i, w in enumerate(rng.sample(_PAGE_WORDS, rng.randint(1, 8)))
+        ],
+        'visuallySimilarImages': [{'url': f"https://example.com/img/{i}.jpg"} for i in range(3)],
+        'bestGuessLabels': [{'label': subject.lower(), 'languageCode': 'en'}],
+    }
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    latency = 0.2
+    error_rate = 0.0
+    max_qps = None
+    _lock = threading.Lock()
+    _window = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _over_quota(self):
+        if not self.max_qps:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._window[:] = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.max_qps:
+                return True
+            self._window.append(now)
+            return False
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self._over_quota():
+            return self._send(429, {'error': {'code': 429, 'message': 'Quota exceeded'}})
+        if random.random() < self.error_rate:
+            return self._send(503, {'error': {'code': 503, 'message': 'The service is currently unavailable.'}})
+
+        responses = []
+        for req in body['requests']:
+            content = base64.b64decode(req['image']['content'])
+            responses.append({'webDetection': fake_web_detection(content)})
+        self._send(200, {'responses': responses})
+
+
+def start_stand_in(port=8080, latency=0.2, error_rate=0.0, max_qps=None):
+    handler = type('StandInHandler', (_StandInHandler,), {
+        'latency': latency, 'error_rate': error_rate, 'max_qps': max_qps, '_window': [],
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/images:annotate"
+
+
+def serve(port=8080, latency=0.2, error_rate=0.0, max_qps=None):
+    server, endpoint = start_stand_in(port, latency, error_rate, max_qps)
+    print(f"Stand-in web detection endpoint: {endpoint}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def benchmark(num_images=200, concurrency=32, qps=100, latency=0.2, error_rate=0.1, max_qps=None):
+    server, endpoint = start_stand_in(0, latency, error_rate, max_qps)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        img_dir = os.path.join(tmp_dir, 'img')
+        out_dir = os.path.join(tmp_dir, 'json')
+        os.makedirs(img_dir)
+        img_paths = []
+        for i in range(num_images):
+            img_paths.append(os.path.join(img_dir, f"{i:05d}.png"))
+            with open(img_paths[-1], 'wb') as f:
+                f.write(os.urandom(2048))
+
+        client = WebDetectionClient(
+            endpoint=endpoint, concurrency=concurrency, qps=qps, backoff=0.1, max_backoff=2)
+        start = time.time()
+        stats = asyncio.run(client.run(img_paths, out_dir))
+        sec = time.time() - start
+        num_json = len([p for p in os.listdir(out_dir) if p.endswith('.json')])
+
+        # NOTE: second run must skip everything (idempotent output)
+        rerun = WebDetectionClient(endpoint=endpoint, concurrency=concurrency, qps=qps)
+        rerun_stats = asyncio.run(rerun.run(img_paths, out_dir))
+    server.shutdown()
+
+    print(f"{stats}, {num_json} json written")
+    print(f"{num_images / sec:.1f} img/s, serial estimate {1 / latency:.1f} img/s")
+    print(f"rerun: {rerun_stats}")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'serve': serve,
+        'benchmark': benchmark,
+    })
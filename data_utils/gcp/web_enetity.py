@@ -1,22 +1,33 @@
 import os
 import io
+import sys
 import glob
 import json
 import re
+import html
 import pickle
+import asyncio
 from functools import reduce
 from collections import defaultdict, Counter
 from multiprocessing import Pool
-from difflib import SequenceMatcher
 
 import fire
-import spacy
 import numpy as np
 from bs4 import BeautifulSoup
 from spacy_langdetect import LanguageDetector
 from termcolor import colored
 from google.protobuf.json_format import MessageToJson
-from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from spacy_registry import get_nlp, preload
+from doc_cache import DocCache
+from description_store import DescriptionStore
+from image_index import ImageIndex
+import fuzzy_match
+import title_dedup
+import title_cleaner
+import web_detect_client
+import anno_builder
 
 
 entity_black_list = [
@@ -116,6 +127,7 @@ noun_chunk_blist = [
     '- getty',
 ]
 noun_chunk_blist = sorted(noun_chunk_blist, key=lambda x: len(x), reverse=True)
+title_blacklist = title_cleaner.BlacklistCleaner(noun_chunk_blist + entity_black_list)
 
 
 def get_best_match(query, corpus, step=4, flex=3, case_sensitive=False, verbose=False):
@@ -138,86 +150,14 @@ def get_best_match(query, corpus, step=4, flex=3, case_sensitive=False, verbose=
         Best matching substring.
     output1 : float
         Match ratio of best matching substring. 1 is perfect match.
-    """
-
-    def _match(a, b):
-        """Compact alias for SequenceMatcher."""
-        return SequenceMatcher(None, a, b).ratio()
-
-    def scan_corpus(step):
-        """Return list of match values from corpus-wide scan."""
-        match_values = []
-
-        m = 0
-        while m + qlen - step <= len(corpus):
-            match_values.append(_match(query, corpus[m : m-1+qlen]))
-            if verbose:
-                print(query, "-", corpus[m: m + qlen], _match(query, corpus[m: m + qlen]))
-            m += step
-
-        return match_values
-
-    def index_max(v):
-        """Return index of max value."""
-        return max(range(len(v)), key=v.__getitem__)
-
-    def adjust_left_right_positions():
-        """Return left/right positions for best string match."""
-        # bp_* is synonym for 'Best Position Left/Right' and are adjusted 
-        # to optimize bmv_*
-        p_l, bp_l = [pos] * 2
-        p_r, bp_r = [pos + qlen] * 2
-
-        # bmv_* are declared here in case they are untouched in optimization
-        bmv_l = match_values[p_l // step]
-        bmv_r = match_values[p_l // step]
-
-        for f in range(flex):
-            ll = _match(query, corpus[p_l - f: p_r])
-            if ll > bmv_l:
-                bmv_l = ll
-                bp_l = p_l - f
-
-            lr = _match(query, corpus[p_l + f: p_r])
-            if lr > bmv_l:
-                bmv_l = lr
-                bp_l = p_l + f
-
-            rl = _match(query, corpus[p_l: p_r - f])
-            if rl > bmv_r:
-                bmv_r = rl
-                bp_r = p_r - f
 
-            rr = _match(query, corpus[p_l: p_r + f])
-            if rr > bmv_r:
-                bmv_r = rr
-                bp_r = p_r + f
-
-            if verbose:
-                print("\n" + str(f))
-                print("ll: -- value: %f -- snippet: %s" % (ll, corpus[p_l - f: p_r]))
-                print("lr: -- value: %f -- snippet: %s" % (lr, corpus[p_l + f: p_r]))
-                print("rl: -- value: %f -- snippet: %s" % (rl, corpus[p_l: p_r - f]))
-                print("rr: -- value: %f -- snippet: %s" % (rl, corpus[p_l: p_r + f]))
-
-        return bp_l, bp_r, _match(query, corpus[bp_l : bp_r])
-
-    if not case_sensitive:
-        query = query.lower()
-        corpus = corpus.lower()
-
-    qlen = len(query)
-
-    if flex >= qlen/2:
-        print("Warning: flex exceeds length of query / 2. Setting to default.")
-        flex = 3
-
-    match_values = scan_corpus(step)
-    pos = index_max(match_values) * step
-
-    pos_left, pos_right, match_value = adjust_left_right_positions()
-
-    return slice(pos_left, pos_right), match_value
+    NOTE: Implemented by the indexed matcher in fuzzy_match.py, use
+    `fuzzy_match.best_matches` to match one query against many corpora.
+    """
+    if verbose:
+        return fuzzy_match.legacy_best_match(
+            query, corpus, step=step, flex=flex, case_sensitive=case_sensitive, verbose=True)
+    return fuzzy_match.best_match(query, corpus, step=step, flex=flex, case_sensitive=case_sensitive)
 
 
 
@@ -292,38 +232,38 @@ def detect_image(path, json_path):
         f.write(json_str)
 
 
-def detect_dataset(img_list, output_dir, auto_break=20):
-    os.makedirs(output_dir, exist_ok=True)
-    start_id = -1
+def detect_dataset(img_list, output_dir, auto_break=20, concurrency=16, qps=10, max_retries=6,
+                   endpoint=web_detect_client.VISION_ENDPOINT, api_key=None):
+    """
+    auto_break: only send the first N images without result (`loop.sh` reruns until all are done),
+        None for all of them.
+    endpoint: web detection REST endpoint, eg. a local stand-in started by `web_detect_client.py serve`.
+    api_key: Vision API key, default to $GOOGLE_API_KEY or the application default credentials.
+    """
     with open(img_list, mode='r') as f:
-        for i, line in enumerate(f):
-            line = line.replace('\n', '')
-            assert os.path.exists(line)
-            print(f"[{i}] {line}")
-            
-            img_name = os.path.basename(line)
-            json_name = img_name.replace('.jpg', '').replace('.png', '') + '.json'
-            json_path = os.path.join(output_dir, json_name)
-
-            if os.path.exists(json_path):
-                print(f'Skip {line}, it already exists!')
-            else:
-                if start_id < 0:
-                    start_id = i
-                else:
-                    if i - start_id >= auto_break:
-                        break
-                detect_image(line, json_path)
-                print('-' * 100)
+        img_paths = [line.replace('\n', '') for line in f if line.strip()]
+    for path in img_paths:
+        assert os.path.exists(path), path
+
+    todo = [p for p in img_paths if not os.path.exists(os.path.join(output_dir, web_detect_client.json_name_of(p)))]
+    print(f"{len(img_paths) - len(todo)} images already detected, {len(todo)} to go")
+    if auto_break is not None:
+        todo = todo[:auto_break]
+
+    client = web_detect_client.WebDetectionClient(
+        endpoint=endpoint, api_key=api_key, concurrency=concurrency, qps=qps, max_retries=max_retries)
+    stats = asyncio.run(client.run(todo, output_dir))
+    print(stats)
 
 
 def create_img_list(img_dir, output_dir, split_size=30000, exclude_dir=None):
+    # NOTE: only lists file names, images are not opened and no index is written next to the data.
     if exclude_dir is not None:
         eimg_list = glob.glob(os.path.join(exclude_dir, '*.png'))
         eimg_list += glob.glob(os.path.join(exclude_dir, '**', '*.png'))
-        eimg_list = [os.path.basename(ei).split('.')[0] for ei in eimg_list]
+        eimg_list = {os.path.basename(ei).split('.')[0] for ei in eimg_list}
     else:
-        eimg_list = []
+        eimg_list = set()
 
     img_list = glob.glob(os.path.join(img_dir, '*.png'))
     img_list += glob.glob(os.path.join(img_dir, '**', '*.png'))
@@ -346,71 +286,88 @@ def create_img_list(img_dir, output_dir, split_size=30000, exclude_dir=None):
                 f.write(l + '\n')
 
 
-def create_description(json_dir='/home/ron/Downloads/hateful_meme_data/web_entity_clean_all/', out_pickle=None):
-    assert out_pickle is not None
-    # json_dir = '/home/ron/Downloads/hateful_meme_data/web_entity/'
+DETECTION_NAME_PAT = re.compile(r'(\d+)\.?(\d)?\.json')
+
+
+def _page_title_text(title):
+    # NOTE: fast path, most titles have no markup and only need their html entities decoded.
+    if '<' not in title:
+        return html.unescape(title)
+    return BeautifulSoup(title).text
+
+
+def _parse_detection_json(json_path):
+    file_name = os.path.basename(json_path)
+    m = re.match(DETECTION_NAME_PAT, file_name)
+    assert m is not None, json_path
+    try:
+        with open(json_path, 'r') as f:
+            raw = f.read()
+        search = json.loads(raw)
+    except Exception as e:
+        print(json_path, e)
+        return None
+
+    entity_name, titles = [], []
+    has_pages = 'pagesWithMatchingImages' in search
+    if has_pages:
+        entity_name = [e['description'] for e in search['webEntities'] if 'description' in e]
+        if 'label' in search['bestGuessLabels'][0]:
+            entity_name += [search['bestGuessLabels'][0]['label']]
+        entity_name = [e for e in entity_name if e.lower() not in entity_black_list]
+        titles = [
+            _page_title_text(page['pageTitle'])
+            for page in search['pagesWithMatchingImages']
+            if 'pageTitle' in page
+        ]
+    return {
+        'file': file_name,
+        'id': m.group(1),
+        'split': -1 if m.group(2) is None else int(m.group(2)),
+        'has_pages': has_pages,
+        'entities': entity_name,
+        'titles': titles,
+        'raw': raw,
+    }
+
+
+def create_description(json_dir='/home/ron/Downloads/hateful_meme_data/web_entity_clean_all/', out_pickle=None,
+                       store_dir=None, num_workers=8, shard_size=20000):
+    """
+    Parse the web detection json of json_dir into the description store (see description_store.py),
+    only json files not in the store yet are parsed, then export entity_map / title_map to out_pickle.
+
+    store_dir: default to `<out_pickle without extension>_store`
+    """
+    assert out_pickle is not None or store_dir is not None
+    if store_dir is None:
+        store_dir = os.path.splitext(out_pickle)[0] + '_store'
+    store = DescriptionStore(store_dir)
+
     json_list = glob.glob(os.path.join(json_dir, '*.json'))
     print(len(json_list))
     assert len(json_list) > 0, f"No json file founded in: {json_dir}"
-
-    json_map = defaultdict(lambda: {'main': None, 'split': {}})
-    name_pat = re.compile(r'(\d+)\.?(\d)?\.json')
-
-    for i, j in enumerate(json_list):
-        file_name = os.path.basename(j)
-        m = re.match(name_pat, file_name)
-        assert m is not None, j
-        try:
-            with open(j, 'r') as f:
-                content = json.load(f)
-                if m.group(2) is None:
-                    json_map[m.group(1)]['main'] = content
-                else:
-                    json_map[m.group(1)]['split'][int(m.group(2))] = content
-        except Exception as e:
-            print(i, j, e)
-            continue
-    
-    search_math = [0, 0]
-    entity_map = defaultdict(lambda: {})
-    title_map = defaultdict(lambda: {})
-    count_entity = Counter()
-    num_entity = []
-
-    for k, d in json_map.items():
-        img_serach = {0: d['main']} if len(d['split']) == 0 else d['split']
-        
-        for split_n, search in img_serach.items():
-            if 'pagesWithMatchingImages' in search:
-                search_math[0] += 1
-        #         print(main['webEntities'])
-                entity_name = [e['description'] for e in search['webEntities'] if 'description' in e]
-                if 'label' in search['bestGuessLabels'][0]:
-                    entity_name += [search['bestGuessLabels'][0]['label']]
-                entity_name = [e for e in entity_name if e.lower() not in entity_black_list]
-                titles = [
-                    BeautifulSoup(page['pageTitle']).text
-                    for page in search['pagesWithMatchingImages']
-                    if 'pageTitle' in page
-                ]
-                
-                entity_map[k][split_n] = entity_name
-                title_map[k][split_n] = titles
-                
-                ent_count = Counter(entity_name)
-                count_entity.update(ent_count)
-                num_entity.append(len(entity_name))
-            else:
-                search_math[1] += 1
-
-    num_entity = Counter(num_entity)
-
-    with open(out_pickle, mode='wb') as pf: 
-        pickle.dump({
-            'entity_map': dict(entity_map),
-            'title_map': dict(title_map),
-            'json_map': dict(json_map),
-        }, pf)
+    new_json = sorted(j for j in json_list if not store.has_file(os.path.basename(j)))
+    print(f"{len(store)} json in store {store_dir} ({store.backend}), {len(new_json)} new json to parse")
+
+    rows = []
+    with Pool(num_workers) as pool:
+        for row in pool.imap(_parse_detection_json, new_json, chunksize=64):
+            if row is not None:
+                rows.append(row)
+            if len(rows) >= shard_size:
+                store.append(rows)
+                rows = []
+    store.append(rows)
+
+    if out_pickle is not None:
+        entity_map, title_map = store.entity_title_maps()
+        print(f"{len(title_map)} images with matching pages")
+        with open(out_pickle, mode='wb') as pf:
+            pickle.dump({
+                'entity_map': entity_map,
+                'title_map': title_map,
+            }, pf)
 
 
 def sent_cluster(roberta, embed_titles):
@@ -478,15 +435,18 @@ def link_noun_chunk(token, token_map, direction=None, depth=0, prev_token=None):
     return token_link
 
 
-nlp = spacy.load("en_core_web_lg")
-def extract_subject(titles):
-    # nlp = spacy.load("en_core_web_lg")
-    global nlp
+def extract_subject(titles, doc_cache=None):
+    # NOTE: need pos tag and dependency parse, but not entity.
+    nlp = get_nlp("en_core_web_lg", disable=['ner'])
     entity_cnt = defaultdict(lambda: 0)
     token_maps = []
     
-    for title in titles:
-        doc = nlp(title)
+    if doc_cache is None:
+        docs = nlp.pipe(titles)
+    else:
+        docs = doc_cache.docs(nlp, titles)
+
+    for title, doc in zip(titles, docs):
         entity2chunk = defaultdict(list)
         token_map = {}
         
@@ -555,13 +515,26 @@ def extract_subject(titles):
     return select_subject, result_sent
 
 
-def titles_cleanup(img_entity_pickle, out_pickle=None):
+def _default_doc_cache_dir(out_pickle):
+    return os.path.join(os.path.dirname(os.path.abspath(out_pickle)), 'doc_cache')
+
+
+def titles_cleanup(img_entity_pickle, out_pickle=None, fasttext_model=None, batch_size=1000, doc_cache_dir=None):
+    """
+    fasttext_model: path of a fastText language id model (eg. lid.176.ftz), used instead of
+        the built-in n-gram profile of title_cleaner to skip the spaCy LanguageDetector.
+    doc_cache_dir: spaCy parse cache, default to `doc_cache` next to the output pickle.
+    """
     with open(img_entity_pickle, 'rb') as pf:
         imgs_web_entity = pickle.load(pf)
     title_map = imgs_web_entity['title_map']
+    if out_pickle is None:
+        out_pickle = img_entity_pickle
+    doc_cache = DocCache(doc_cache_dir or _default_doc_cache_dir(out_pickle))
     
-    snlp = spacy.load("en_core_web_lg")
-    snlp.add_pipe(LanguageDetector(), name="language_detector", last=True)
+    snlp = get_nlp("en_core_web_lg", disable=['ner'], variant='language_detector')
+    if 'language_detector' not in snlp.pipe_names:
+        snlp.add_pipe(LanguageDetector(), name="language_detector", last=True)
 
     all_titles = []
     all_title_idx = []
@@ -575,26 +548,19 @@ def titles_cleanup(img_entity_pickle, out_pickle=None):
 
     assert len(all_titles) == len(all_title_idx), f"{len(all_titles)} != {len(all_title_idx)}"
     
-    pipe = snlp.pipe(all_titles)
+    lang_filter = title_cleaner.LanguageFilter(fasttext_model)
+    cleaned = title_cleaner.clean_titles(
+        all_titles, snlp, title_blacklist, lang_filter=lang_filter, batch_size=batch_size, doc_cache=doc_cache)
     clean_title_map = defaultdict(lambda: defaultdict(list))
     all_clean_title = []
     drop_by_lanu = 0
 
-    for i, doc in enumerate(pipe):
-        if doc._.language['language'] != 'en':
+    for i, senten in enumerate(cleaned):
+        if senten is None:
             drop_by_lanu += 1
             continue
         
         id = all_title_idx[i]
-        senten = ''
-        for token in doc:
-            if token.pos_ != 'NUM' and token.pos_ != 'X':
-                senten += token.text.lower() + ' '
-        for b in noun_chunk_blist:
-            senten = re.sub(b, '', senten)
-        for b in entity_black_list:
-            senten = re.sub(b, '', senten)
-        
         n_split = all_split_idx[i]
         # if len(clean_title_map[id]) < n_split + 1:
         #     clean_title_map[id] += [[] for _ in range(n_split + 1 - len(clean_title_map[id]))]
@@ -602,44 +568,55 @@ def titles_cleanup(img_entity_pickle, out_pickle=None):
         all_clean_title.append(senten)
         
     imgs_web_entity['clean_title_map'] = dict(clean_title_map)
-    if out_pickle is None:
-        out_pickle = img_entity_pickle
     with open(out_pickle, mode='wb') as pf: 
         pickle.dump(imgs_web_entity, pf)
 
 
 def remove_duplicate(titles):
-    dup = [False for _ in range(len(titles))]
-    for i, title in enumerate(titles[:-1]):
-        if dup[i]:
-            continue
-        for j, title_b in enumerate(titles[i + 1:]):
-            # print(title, title_b)
-            if len(title) > len(title_b):
-                match_slice, match_score = get_best_match(title_b, title, step=2, flex=4)
-            else:
-                match_slice, match_score = get_best_match(title, title_b, step=2, flex=4)
-            if match_score > 0.85:
-                dup[j + i + 1] = True
-    filtered = [t for d, t in zip(dup, titles) if not d]
-    return filtered
+    """
+    Drop titles that fuzzy match (> 0.85) an earlier kept title, see title_dedup.py.
+    """
+    return title_dedup.remove_duplicate(titles, threshold=0.85)
+
+# NOTE: filled by titles_summary before forking the workers, so they share the parsed docs.
+_summary_doc_cache = None
+
+
+def _summary_titles(titles):
+    return [re.sub('\|', '', e) for e in titles]
+
 
 def _apply_summary(args):
     id, n_split, titles = args
     print(colored(id, color='green'))
-    titles = [re.sub('\|', '', e) for e in titles]
+    titles = _summary_titles(titles)
     titles = remove_duplicate(titles)
-    select_subject, result_noun_chunks = extract_subject(titles)
+    select_subject, result_noun_chunks = extract_subject(titles, doc_cache=_summary_doc_cache)
     # title_summaries[id] = result_noun_chunks
     print('result_sent: ', result_noun_chunks)
     return id, n_split, result_noun_chunks
 
-def titles_summary(img_entity_pickle, out_pickle):
+def titles_summary(img_entity_pickle, out_pickle, doc_cache_dir=None):
+    """
+    doc_cache_dir: spaCy parse cache, default to `doc_cache` next to the output pickle.
+    """
+    global _summary_doc_cache
     with open(img_entity_pickle, 'rb') as pf:
         imgs_web_entity = pickle.load(pf)
     clean_title_map = imgs_web_entity['clean_title_map']
 
     title_summaries = defaultdict(dict)
+    # NOTE: parse every title once in the parent process (or load it from the cache of a previous run).
+    _summary_doc_cache = DocCache(doc_cache_dir or _default_doc_cache_dir(out_pickle))
+    all_titles = {
+        t
+        for split_titles in clean_title_map.values()
+        for titles in split_titles.values()
+        for t in _summary_titles(titles)
+    }
+    _summary_doc_cache.docs(get_nlp("en_core_web_lg", disable=['ner']), sorted(all_titles))
+    # NOTE: load once in parent process, so forked workers share the same model.
+    preload("en_core_web_lg", disable=['ner'])
     with Pool(16) as pool:
         flatten = [
             (id, n_split, titles)
@@ -657,159 +634,47 @@ def titles_summary(img_entity_pickle, out_pickle):
         pickle.dump(imgs_web_entity, pf)
 
 
-def insert_anno_jsonl(img_entity_pickle, anno_json, split_boxes_json, ocr_boxes_json, img_dir='/meme_data/img'):
+# NOTE: inputs shared by every split of insert_anno_jsonl, set before forking the workers.
+_anno_inputs = None
+
+
+def _build_anno(anno):
+    image_split_annos, ocr_anno, entity_map, title_summaries, img_index = _anno_inputs
+    id = anno['id']
+    img_name = os.path.basename(anno['img'])
+
+    w, h = img_index.size(img_name)
+    image_boxes = anno_builder.refine_split_box([list(b) for b in image_split_annos[img_name]], w, h)
+    ocr_boxes = ocr_anno[img_name]
+
+    if len(image_boxes) > 1:
+        logger.info(img_name)
+        char_to_img_box = anno_builder.find_appearence(anno['text'], ocr_boxes, image_boxes, logger=logger)
+    else:
+        char_to_img_box = [0] * len(anno['text'])
+
+    anno['image_partition'] = []
+    anno['partition_description'] = []
+    anno['text_char_partition_id'] = char_to_img_box
+    assert max(char_to_img_box) < len(image_boxes), f"{max(char_to_img_box)} !< {len(image_boxes)}"
+
+    anno['image_partition'] = image_boxes
+    anno['partition_description'] = anno_builder.partition_description(
+        f"{id:05d}", len(image_boxes), entity_map, title_summaries)
+    return anno
+
+
+def insert_anno_jsonl(img_entity_pickle, anno_json, split_boxes_json, ocr_boxes_json, img_dir='/meme_data/img',
+                      num_workers=8):
+    """
+    anno_json: one or more (comma separated) jsonl splits, all processed with the inputs loaded once.
+        Output of every split is written next to it as `*.entity.jsonl`.
+    """
+    global _anno_inputs
+    if isinstance(anno_json, str):
+        anno_json = anno_json.split(',')
+    anno_jsons = list(anno_json)
 
-    def refine_split_box(boxes, img_name):
-        img_path = os.path.join(img_dir, img_name)
-        w, h = Image.open(img_path).size
-        
-        if len(boxes) > 1:
-            direction = None
-
-            if w > h:
-                direction = 'left-right'
-                boxes = sorted(boxes, key=lambda x: x[0])
-                for j in range(len(boxes) - 1):
-                    boxes[j + 1][0] = boxes[j][2] = (boxes[j][2] + boxes[j + 1][0]) / 2
-                
-                boxes[0][0] = 0
-                boxes[-1][2] = w
-                for j in range(len((boxes))):
-                    boxes[j][1] = 0
-                    boxes[j][3] = h
-            else:
-                direction = 'top-down'
-                boxes = sorted(boxes, key=lambda x: x[1])
-                for j in range(len(boxes) - 1):
-                    boxes[j][3] = boxes[j + 1][1] = (boxes[j][3] + boxes[j + 1][1]) / 2
-            
-                boxes[0][1] = 0
-                boxes[-1][3] = h
-                for j in range(len((boxes))):
-                    boxes[j][0] = 0
-                    boxes[j][2] = w
-            return boxes
-        else:
-            return [[0, 0, w, h, 1.0]]
-            
-    
-    def box_coverage(img_box, ocr_box):
-        w = ocr_box[2] - ocr_box[0]
-        h = ocr_box[3] - ocr_box[1]
-        ocr_l_to_img_r = max(min(img_box[2] - ocr_box[0], w), 0)
-        ocr_r_to_img_l = max(min(ocr_box[2] - img_box[0], w), 0)
-        cover_w = min(ocr_l_to_img_r, ocr_r_to_img_l)
-        
-        ocr_t_to_img_b = max(min(img_box[3] - ocr_box[1], h), 0)
-        ocr_b_to_img_t = max(min(ocr_box[3] - img_box[1], h), 0)
-        cover_h = min(ocr_t_to_img_b, ocr_b_to_img_t)
-        return (cover_h * cover_w) / (w * h)
-        
-    def merge_ocr_boxes(ocr_boxes):
-        raise NotImplementedError
-
-        box_id_pair = []
-        font_height = []
-        for i, box_info in enumerate(ocr_boxes):
-            box, txt, score = box_info
-            box_id_pair.append((i, box))
-            font_height.append(box[3] - box[1])
-        font_size = sum(font_height) / len(font_height)
-        
-        box_by_x = sorted(ocr_boxes, lambda box_info: box_info[0][0])
-        box_by_xy = sorted(box_by_x, lambda box_info: box_info[0][1])
-        box_by_y = sorted(ocr_boxes, lambda box_info: box_info[0][1])
-        box_by_yx = sorted(box_by_y, lambda box_info: box_info[0][0])
-        ln = len(box_by_xy)
-
-        for i in range(ln - 1):
-            box_by_xy[i]
-            box_by_xy[i + 1]
-    
-    def find_appearence(meme_txt, ocr_boxes, img_boxes):
-        box_by_x = sorted(ocr_boxes, key=lambda box_info: box_info[0][0])
-        box_by_xy = sorted(box_by_x, key=lambda box_info: box_info[0][1])
-        ocr_to_img_box = []
-        
-        for i, box_info in enumerate(box_by_xy):
-            box, txt, score = box_info
-            imbox_cover = [box_coverage(im, box) for im in img_boxes]
-            argmax = imbox_cover.index(max(imbox_cover))
-            ocr_to_img_box.append(argmax)
-        print('ocr_to_img_box: ', ocr_to_img_box)
-        
-        for i, box_info in enumerate(box_by_xy):
-            box, txt, score = box_info
-            match_slice, match_score = get_best_match(txt, meme_txt, step=2, flex=4)
-            print(
-                colored(txt, color='blue'),
-                colored(meme_txt[match_slice], color='green'),
-                match_score,
-                match_slice,
-                len(meme_txt)
-            )
-            box_by_xy[i] = (box, txt, score, match_slice, match_score)
-
-            if i > 0 and match_score >= 0.75:
-                pass
-                # assert match_slice.start >= box_by_xy[i - 1][3].stop
-            elif match_score < 0.75:
-                logger.warning(f"Low match score! {match_score}")
-        char_to_img_box = [-1] * len(meme_txt)
-
-        # last_im_box_id = -1
-        for i, box_info in enumerate(box_by_xy):
-            match_slice, match_score = box_info[3:5]
-            match_len = match_slice.stop - match_slice.start
-            if match_len < 6 and match_score < 0.75:
-                continue
-            elif match_score < 0.6:
-                continue
-            
-            for j in range(match_slice.start, min(match_slice.stop, len(meme_txt))):
-                char_to_img_box[j] = ocr_to_img_box[i]
-            
-            if i < len(box_by_xy) - 1:
-                next_slice = box_by_xy[i - 1][3]
-                for j in range(match_slice.stop, next_slice.start):
-                    char_to_img_box[j] = ocr_to_img_box[i]
-        print(char_to_img_box)
-        for i in range(len(char_to_img_box)):
-            c = char_to_img_box[i]
-            if c < 0:
-                next_match = len(char_to_img_box)
-                next_img_id = max(char_to_img_box)
-                for j in range(i, len(char_to_img_box)):
-                    if char_to_img_box[j] >= 0:
-                        next_match = j
-                        next_img_id = char_to_img_box[j]
-                        break
-                prev_img_id = max(char_to_img_box[:i]) if i > 0 else -1
-
-                for j in range(i, next_match):
-                    if prev_img_id == next_img_id:
-                        char_to_img_box[j] = prev_img_id
-                    elif prev_img_id < next_img_id:
-                        char_to_img_box[j] = prev_img_id + 1
-                    else:
-                        # NOTE: happend when ocr's detected text not matching actual anno text.
-                        if j > (i + next_match) // 2:
-                            char_to_img_box[j] = next_img_id
-                        else:
-                            char_to_img_box[j] = prev_img_id
-                    #     raise RuntimeError(f'!? {prev_img_id}, {next_img_id}')
-                
-        
-        print(char_to_img_box)
-        print('-' * 100)
-        return char_to_img_box
-    
-    meme_anno = []
-    
-    with open(anno_json, 'r') as f:
-        for line in f:
-            meme_anno.append(json.loads(line))
-    
     with open(img_entity_pickle, 'rb') as pf:
         imgs_web_entity = pickle.load(pf)
     
@@ -819,69 +684,32 @@ def insert_anno_jsonl(img_entity_pickle, anno_json, split_boxes_json, ocr_boxes_
     with open(ocr_boxes_json, 'r') as f:
         ocr_anno = json.load(f)
     
-    title_summaries = imgs_web_entity['title_summaries']
-    entity_map = imgs_web_entity['entity_map']
-
-    for anno in meme_anno:
-        id = anno['id']
-        img_name = os.path.basename(anno['img'])
+    _anno_inputs = (
+        image_split_annos,
+        ocr_anno,
+        imgs_web_entity['entity_map'],
+        imgs_web_entity['title_summaries'],
+        ImageIndex(img_dir).refresh(num_workers=num_workers),
+    )
 
-        image_boxes = image_split_annos[img_name]
-        image_boxes = refine_split_box(image_boxes, img_name)
-        ocr_boxes = ocr_anno[img_name]
-        
-        if len(image_boxes) > 1:
-            logger.info(img_name)
-            char_to_img_box = find_appearence(anno['text'], ocr_boxes, image_boxes)
-        else:
-            char_to_img_box = [0] * len(anno['text'])
-
-        if f"{id:05d}" in entity_map:
-            img_entitys_splits = entity_map[f"{id:05d}"]
-            # img_entitys = reduce(lambda a, b: a + b, img_entitys_splits)
-            summaries_splits = title_summaries[f"{id:05d}"]
-        else:
-            if f"{id:05d}" in title_summaries:
-                summaries_splits = title_summaries[f"{id:05d}"]
-                img_entitys_splits = {k: [] for k in summaries_splits.keys()}
-            else:
-                summaries_splits = {}
-                img_entitys_splits = {}
-
-        anno['image_partition'] = []
-        anno['partition_description'] = []
-        anno['text_char_partition_id'] = char_to_img_box
-        assert max(char_to_img_box) < len(image_boxes), f"{max(char_to_img_box)} !< {len(image_boxes)}"
-
-        # split_number = sorted(img_entitys_splits.keys())
-        # for sn in split_number:
-        #     anno['image_partition'].append(image_boxes[sn])
-        #     entitys = img_entitys_splits[sn]
-        #     if len(entitys) <= 2:
-        #         if sn in summaries_splits:
-        #             web_page_summaries = summaries_splits[sn]
-        #             entitys += [' '.join(s) for s in web_page_summaries]
-        #     anno['partition_description'].append(entitys)
-        # assert len(anno['image_partition']) == len(image_boxes), F"{img_name}"
-        
-        anno['image_partition'] = image_boxes
-        for sn in range(len(image_boxes)):
-            if sn in img_entitys_splits:
-                entitys = img_entitys_splits[sn]
-            else:
-                entitys = []
-            use_title = len(entitys) <= 2
-            if use_title:
-                if sn in summaries_splits:
-                    web_page_summaries = summaries_splits[sn]
-                    entitys += [' '.join(s) for s in web_page_summaries]
-            anno['partition_description'].append(entitys)
-    
-    out_path = anno_json.replace('.json', '.entity.json')
-    with open(out_path, 'w') as f:
-        for anno_line in meme_anno:
-            seri_line = json.dumps(anno_line)
-            f.write(f"{seri_line}\n")
+    with Pool(num_workers) as pool:
+        jobs = []
+        for split_json in anno_jsons:
+            meme_anno = []
+            with open(split_json, 'r') as f:
+                for line in f:
+                    meme_anno.append(json.loads(line))
+            jobs.append((split_json, pool.map_async(_build_anno, meme_anno, chunksize=32)))
+
+        for split_json, job in jobs:
+            out_path = split_json.replace('.json', '.entity.json')
+            tmp_path = out_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for anno_line in job.get():
+                    seri_line = json.dumps(anno_line)
+                    f.write(f"{seri_line}\n")
+            os.replace(tmp_path, out_path)
+            print(f"Saved: {out_path}")
 
 
 if __name__ == "__main__":
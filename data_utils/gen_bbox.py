@@ -12,6 +12,8 @@ import tensorflow as tf
 import tensorflow_hub as hub
 from PIL import Image
 
+import dup_index
+
 
 def load_img(path):
     img = tf.io.read_file(path)
@@ -36,76 +38,165 @@ def run_detector_tensor(detector, converted_img):
     print("Found %d objects." % len([s for s in result["detection_scores"] if s > 0.2]))
     return result
 
-def pull_imgs(img_path_list, output_queue:queue.Queue):
+def pull_imgs(img_path_list, output_queue:queue.Queue, failed=None):
     for img_file in img_path_list:
-        img_tensor = load_img(img_file)
-        converted_img = tf.image.convert_image_dtype(img_tensor, tf.float32)[
-            tf.newaxis, ...]
-        print("[pull_imgs] ", img_file)
+        try:
+            img_tensor = load_img(img_file)
+            converted_img = tf.image.convert_image_dtype(img_tensor, tf.float32)[
+                tf.newaxis, ...]
+        except Exception as e:
+            # NOTE: a dead reader only loses its own images, keep going with the next one.
+            print(f"[failed] can't load {img_file}: {e!r}")
+            if failed is not None:
+                failed[img_file] = repr(e)
+            continue
         output_queue.put((converted_img, img_file))
 
-def hateful_meme(img_dir, output_path, debug=False):
+
+def result_to_anno(result, img_file, score_thres=0.2):
+    boxes_score = zip(
+        result["detection_boxes"],
+        result["detection_scores"],
+        result["detection_class_entities"],
+        result["detection_class_labels"])
+    boxes_score = [
+        {
+            'ymin': float(b[0]),
+            'xmin': float(b[1]),
+            'ymax': float(b[2]),
+            'xmax': float(b[3]),
+            'score': float(s),
+            'class_name': c.decode("ascii"),
+            'class_id': int(ci),
+        }
+        for b, s, c, ci in list(boxes_score) if s > score_thres]
+    return {
+        'img_name': os.path.basename(img_file),
+        'boxes_and_score': boxes_score 
+    }
+
+
+def load_shards(shard_dir):
+    det_annos = {}
+    for shard_file in sorted(glob.glob(os.path.join(shard_dir, 'box_*.jsonl'))):
+        with open(shard_file, 'r') as f:
+            for line in f:
+                try:
+                    anno = json.loads(line)
+                except json.JSONDecodeError:
+                    # NOTE: truncated last line of a killed run
+                    continue
+                det_annos[anno['img_name']] = anno
+    return det_annos
+
+
+def _detect_worker(detector, device, img_queue, shard_file, total, counter, lock, failed):
+    with open(shard_file, 'a') as f, tf.device(device):
+        while True:
+            item = img_queue.get()
+            if item is None:
+                img_queue.task_done()
+                break
+            tensor, img_file = item
+            # NOTE: a worker must keep draining the queue, or the readers block on the full queue forever.
+            try:
+                result = run_detector_tensor(detector, tensor)
+                f.write(json.dumps(result_to_anno(result, img_file)) + '\n')
+                f.flush()
+            except Exception as e:
+                print(f"[failed] {img_file}: {e!r}")
+                with lock:
+                    failed[img_file] = repr(e)
+                continue
+            finally:
+                img_queue.task_done()
+
+            with lock:
+                counter[0] += 1
+                print(f"[{counter[0]}/{total}] {img_file}")
+
+
+def hateful_meme(img_dir, output_path, debug=False, num_readers=4, num_workers=2,
+                 queue_size=16, shard_dir=None, device='/device:GPU:0', dup_map=None):
+    """
+    num_readers: threads decoding images.
+    num_workers: threads running the detector concurrently, each writes its results
+        to its own jsonl shard under `shard_dir` (default: OUTPUT_PATH.shards/) as soon as a image is done.
+        Rerun skip images already in the shards, and shards are merged into `output_path` at the end.
+
+    dup_map: near duplicate index of img_dir (`dup_index.py build`), only the canonical image
+        of every group of duplicates is detected, members get a copy of its boxes.
+
+    NOTE: the openimages_v4 hub module only accept one image per call, so images are not
+    batched into one tensor, instead multiple single image call run in parallel.
+    """
     print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
 
-    with tf.device('/device:GPU:0'):
-        img_pattern = os.path.join(img_dir, '*.png')
-        img_files = glob.glob(img_pattern)
-        img_files = sorted(img_files)
-
-        img_queue = queue.Queue(maxsize=16)
-        img_io_thread = threading.Thread(
-            daemon=True,
-            target=pull_imgs,
-            args=[img_files, img_queue]
-        )
-        img_io_thread.start()
-
-        if debug:
-            print('RUn in debug mode!')
-        
+    img_pattern = os.path.join(img_dir, '*.png')
+    img_files = glob.glob(img_pattern)
+    img_files = sorted(img_files)
+    if debug:
+        print('RUn in debug mode!')
+        img_files = img_files[:1001]
+
+    canonical = {os.path.basename(f): os.path.basename(f) for f in img_files}
+    if dup_map is not None:
+        canonical.update(dup_index.canonical_map(dup_map))
+
+    if shard_dir is None:
+        shard_dir = output_path + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    done = load_shards(shard_dir)
+    detect_names = {canonical[os.path.basename(f)] for f in img_files}
+    todo = [os.path.join(img_dir, n) for n in sorted(detect_names) if n not in done]
+    print(f"Find {len(img_files)} images ({len(detect_names)} after dedup), {len(todo)} images to detect")
+
+    if todo:
         module_handle = "https://tfhub.dev/google/faster_rcnn/openimages_v4/inception_resnet_v2/1" #@param ["https://tfhub.dev/google/openimages_v4/ssd/mobilenet_v2/1", "https://tfhub.dev/google/faster_rcnn/openimages_v4/inception_resnet_v2/1"]
         detector = hub.load(module_handle).signatures['default']
-        det_annos = []
 
-        i = 0
-        while True:
-            if debug and i > 1000:
-                break
-            if i >= len(img_files):
-                break
-            
-            tensor, img_file = img_queue.get(block=True, timeout=10)
-            
-            print(f"[{i}/{len(img_files)}] {img_file}")
-            result = run_detector_tensor(detector, tensor)
-            img_queue.task_done()
-
-            boxes_score = zip(
-                result["detection_boxes"],
-                result["detection_scores"],
-                result["detection_class_entities"],
-                result["detection_class_labels"])
-            boxes_score = [
-                {
-                    'ymin': float(b[0]),
-                    'xmin': float(b[1]),
-                    'ymax': float(b[2]),
-                    'xmax': float(b[3]),
-                    'score': float(s),
-                    'class_name': c.decode("ascii"),
-                    'class_id': int(ci),
-                }
-                for b, s, c, ci in list(boxes_score) if s > 0.2]
-            img_name = os.path.basename(img_file)
-            det_anno = {
-                'img_name': img_name,
-                'boxes_and_score': boxes_score 
-            }
-            det_annos.append(det_anno)
-            i += 1
-        
-        with open(output_path, mode='w') as output:
-            json.dump(det_annos, output)
+        img_queue = queue.Queue(maxsize=queue_size)
+        failed = {}
+        readers = [
+            threading.Thread(
+                daemon=True,
+                target=pull_imgs,
+                args=[todo[i::num_readers], img_queue, failed]
+            )
+            for i in range(num_readers)
+        ]
+        counter, lock = [0], threading.Lock()
+        workers = [
+            threading.Thread(
+                daemon=True,
+                target=_detect_worker,
+                args=[
+                    detector, device, img_queue,
+                    os.path.join(shard_dir, f"box_{i:03d}.jsonl"),
+                    len(todo), counter, lock, failed,
+                ]
+            )
+            for i in range(num_workers)
+        ]
+        for t in readers + workers:
+            t.start()
+        for t in readers:
+            t.join()
+        for _ in workers:
+            img_queue.put(None)
+        for t in workers:
+            t.join()
+        done = load_shards(shard_dir)
+        if failed:
+            print(f"{len(failed)} images failed (rerun to retry them): {sorted(failed)[:20]}")
+
+    det_annos = [
+        dict(done[canonical[os.path.basename(f)]], img_name=os.path.basename(f)) for f in img_files
+        if canonical[os.path.basename(f)] in done
+    ]
+    assert len(det_annos) == len(img_files), f"{len(det_annos)} != {len(img_files)}, some images failed"
+    with open(output_path, mode='w') as output:
+        json.dump(det_annos, output)
 
 
 def test():
@@ -1,8 +1,23 @@
-from grakn.client import GraknClient
+import os
+import re
 import csv
+import json
+import time
 import random
+import threading
+from queue import Queue
+from multiprocessing import Pool
+
+import fire
 from loguru import logger
 
+
+def GraknClient(uri):
+    # NOTE: imported on use, the stand-in loader doesn't need the grakn client installed
+    from grakn.client import GraknClient as _GraknClient
+    return _GraknClient(uri=uri)
+
+
 REL = [
     "/r/RelatedTo",
     "/r/FormOf",
@@ -243,7 +258,436 @@ def insert_triplets(csv_path, host='35.234.48.188', port=48555, batch_query=100)
                     transaction.commit()
                     transaction = session.transaction().write()
 
+"""
+Bulk loading
+"""
+
+DEFAULT_HOST = '35.234.48.188'
+DEFAULT_PORT = 48555
+
+
+def is_en_assertion(line):
+    parts = line.split('\t')
+    if len(parts) != 5:
+        return False
+    _, relation, entity_a, entity_b, meta = parts
+    # NOTE: same test as fitler_csv_by_language
+    return entity_a.startswith('/c/en/') and entity_b.startswith('/c/en')
+
+
+def concept_name(entity):
+    return entity.replace('/c/en/', '').split('/')[0]
+
+
+def _chunk_ranges(path, chunk_bytes):
+    size = os.path.getsize(path)
+    return [(path, start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+def _read_chunk_lines(path, start, end):
+    """
+    Lines that start inside [start, end) of the file.
+    """
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+
+def _filter_chunk(args):
+    path, start, end = args
+    kept = [line for line in _read_chunk_lines(path, start, end) if is_en_assertion(line)]
+    return ''.join(kept), len(kept)
+
+
+def _parse_chunk(args):
+    path, start, end = args
+    triplets = []
+    for line in _read_chunk_lines(path, start, end):
+        _, relation, entity_a, entity_b, meta = line.split('\t')
+        triplets.append((relation, concept_name(entity_a), concept_name(entity_b)))
+    return triplets
+
+
+def filter_csv_mp(csv_path, output_path, num_workers=8, chunk_mb=64):
+    """
+    Same output as fitler_csv_by_language, the csv is read in chunks by a pool of
+    workers and the kept lines are written in order, never holding the whole file.
+    """
+    chunks = _chunk_ranges(csv_path, chunk_mb * 2 ** 20)
+    total = 0
+    with Pool(num_workers) as pool, open(output_path + '.tmp', 'w') as f:
+        for i, (text, count) in enumerate(pool.imap(_filter_chunk, chunks)):
+            f.write(text)
+            total += count
+            logger.info(f"[filter] chunk {i + 1}/{len(chunks)}, {total} lines kept")
+    os.replace(output_path + '.tmp', output_path)
+    return total
+
+
+def iter_triplets(csv_path, num_workers=8, chunk_mb=16):
+    """
+    Yield (relation, head name, tail name) of every line of a filtered csv, in file order.
+    """
+    chunks = _chunk_ranges(csv_path, chunk_mb * 2 ** 20)
+    with Pool(num_workers) as pool:
+        for triplets in pool.imap(_parse_chunk, chunks):
+            yield from triplets
+
+
+class ConceptIds:
+    """
+    Concept name -> integer id, in order of first appearance.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        concept_id = self.ids.get(name)
+        if concept_id is None:
+            concept_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return concept_id
+
+
+def graql_str(value):
+    """
+    Graql string literal of value, escaped so any concept name is a single parameter of the query.
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+GRAQL_STR_PAT = re.compile(r'"(?:[^"\\]|\\.)*"')
+NODE_TEMPLATE = '$n{var} isa node, has name {name}, has supply_info_json "";'
+EDGE_TEMPLATE = (
+    'match $head isa node, has name {head}; $tail isa node, has name {tail}; '
+    'insert (head: $head, tail: $tail) isa edge, has edge_id {edge_id}, has edge_type {edge_type};'
+)
+
+
+def node_insert_query(names):
+    return 'insert ' + ' '.join(
+        NODE_TEMPLATE.format(var=i, name=graql_str(name)) for i, name in enumerate(names))
+
+
+def edge_insert_query(head, tail, edge_type, edge_id):
+    return EDGE_TEMPLATE.format(
+        head=graql_str(head), tail=graql_str(tail), edge_id=int(edge_id), edge_type=graql_str(edge_type))
+
+
+def _is_conflict(e):
+    msg = str(e).lower()
+    return any(k in msg for k in ('conflict', 'aborted', 'unavailable', 'deadline', 'temporarily'))
+
+
+class BulkLoader:
+    """
+    Write batches of queries through a pool of parallel sessions, one write
+    transaction per batch, retried with backoff when the commit conflicts.
+    Committed batches are appended to `progress_path`, so a rerun skips them.
+    """
+
+    def __init__(self, client, keyspace='conceptnet', num_sessions=4, max_retries=6, backoff=0.5,
+                 progress_path=None):
+        self.client = client
+        self.keyspace = keyspace
+        self.num_sessions = num_sessions
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.progress_path = progress_path
+        self.done = set()
+        if progress_path and os.path.exists(progress_path):
+            with open(progress_path, 'r') as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'queries': 0, 'retries': 0, 'skipped': 0}
+
+    def _write(self, session, queries):
+        for attempt in range(self.max_retries + 1):
+            transaction = session.transaction().write()
+            try:
+                for q in queries:
+                    transaction.query(q)
+                transaction.commit()
+                return
+            except Exception as e:
+                try:
+                    transaction.close()
+                except Exception:
+                    pass
+                if attempt == self.max_retries or not _is_conflict(e):
+                    raise
+                with self._lock:
+                    self.stats['retries'] += 1
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+
+    def _commit_done(self, batch_key, num_queries):
+        with self._lock:
+            self.done.add(batch_key)
+            self.stats['batches'] += 1
+            self.stats['queries'] += num_queries
+            if self.progress_path:
+                with open(self.progress_path, 'a') as f:
+                    f.write(batch_key + '\n')
+
+    def run(self, phase, batches):
+        """
+        batches: iterable of list of query, written concurrently, returns when all are committed.
+        """
+        queue = Queue(maxsize=self.num_sessions * 4)
+        errors = []
+
+        def worker():
+            with self.client.session(keyspace=self.keyspace) as session:
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        return
+                    batch_key, queries = item
+                    if errors:
+                        continue
+                    try:
+                        self._write(session, queries)
+                        self._commit_done(batch_key, len(queries))
+                    except Exception as e:
+                        errors.append((batch_key, e))
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.num_sessions)]
+        for t in threads:
+            t.start()
+        start = time.time()
+        for i, queries in enumerate(batches):
+            batch_key = f"{phase}:{i}"
+            if batch_key in self.done:
+                self.stats['skipped'] += 1
+                continue
+            if errors:
+                break
+            queue.put((batch_key, queries))
+            if i % 100 == 0:
+                logger.info(f"[{phase}] batch {i}, {self.stats}, {time.time() - start:.1f}s")
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        if errors:
+            batch_key, e = errors[0]
+            raise RuntimeError(f"batch {batch_key} failed after {self.max_retries} retries: {e!r}")
+        logger.info(f"[{phase}] done, {self.stats}, {time.time() - start:.1f}s")
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def collect_graph(csv_path, num_workers=8):
+    """
+    Return ConceptIds and edge list of (relation, head id, tail id), edge id is the index in the list.
+    """
+    concepts = ConceptIds()
+    edges = []
+    for relation, head, tail in iter_triplets(csv_path, num_workers=num_workers):
+        edges.append((relation, concepts[head], concepts[tail]))
+    logger.info(f"{len(concepts)} concepts, {len(edges)} edges")
+    return concepts, edges
+
+
+def load_graph(client, concepts, edges, num_sessions=4, nodes_per_query=50, queries_per_tx=200,
+               edges_per_tx=500, progress_path=None, keyspace='conceptnet'):
+    """
+    Insert every concept once, then every edge matching its two nodes by name.
+    """
+    loader = BulkLoader(client, keyspace=keyspace, num_sessions=num_sessions, progress_path=progress_path)
+    node_queries = (node_insert_query(names) for names in _batched(concepts.names, nodes_per_query))
+    loader.run('node', _batched(node_queries, queries_per_tx))
+
+    names = concepts.names
+    edge_queries = (
+        edge_insert_query(names[head], names[tail], relation, edge_id)
+        for edge_id, (relation, head, tail) in enumerate(edges)
+    )
+    loader.run('edge', _batched(edge_queries, edges_per_tx))
+    return loader.stats
+
+
+def bulk_load(csv_path, host=DEFAULT_HOST, port=DEFAULT_PORT, keyspace='conceptnet', num_workers=8,
+              num_sessions=4, edges_per_tx=500, progress_path=None):
+    """
+    csv_path: english assertions (output of filter_csv_mp / fitler_csv_by_language).
+    progress_path: committed batches, default to CSV_PATH.progress
+    """
+    concepts, edges = collect_graph(csv_path, num_workers=num_workers)
+    with GraknClient(uri=f"{host}:{port}") as client:
+        stats = load_graph(
+            client, concepts, edges, num_sessions=num_sessions, edges_per_tx=edges_per_tx,
+            progress_path=progress_path or csv_path + '.progress', keyspace=keyspace)
+    print(stats)
+
+
+"""
+In-process stand-in of the Grakn client, records the queries of committed transactions
+"""
+
+
+class _RecordingTransaction:
+
+    def __init__(self, client):
+        self.client = client
+        self.queries = []
+        self.open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def query(self, q):
+        assert self.open, 'transaction closed'
+        self.queries.append(q)
+        return iter([])
+
+    def commit(self):
+        assert self.open, 'transaction closed'
+        self.open = False
+        time.sleep(self.client.latency)
+        if random.random() < self.client.conflict_rate:
+            raise RuntimeError('[GRAKN] transaction conflict, please retry')
+        with self.client.lock:
+            self.client.committed.extend(self.queries)
+            self.client.num_commits += 1
+
+    def close(self):
+        self.open = False
+
+
+class _RecordingSession:
+
+    def __init__(self, client, keyspace):
+        self.client = client
+        self.keyspace = keyspace
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def transaction(self):
+        return self
+
+    def write(self):
+        return _RecordingTransaction(self.client)
+
+    def close(self):
+        pass
+
+
+class RecordingClient:
+
+    def __init__(self, conflict_rate=0.0, latency=0.0):
+        self.conflict_rate = conflict_rate
+        self.latency = latency
+        self.committed = []
+        self.num_commits = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def session(self, keyspace):
+        return _RecordingSession(self, keyspace)
+
+
+def _fake_assertions(path, num_lines, seed=0):
+    rng = random.Random(seed)
+    words = [f"word_{i}" for i in range(num_lines // 4)] + ['say "hi"', 'back\\slash', 'café']
+    langs = ['en', 'en', 'en', 'fr', 'de']
+    with open(path, 'w') as f:
+        for i in range(num_lines):
+            rel = rng.choice(REL)
+            a = f"/c/{rng.choice(langs)}/{rng.choice(words)}/n"
+            b = f"/c/{rng.choice(langs)}/{rng.choice(words)}"
+            f.write(f"/a/[{rel}/,{a}/,{b}/]\t{rel}\t{a}\t{b}\t{{\"weight\": {rng.random():.3f}}}\n")
+
+
+def stand_in_check(num_lines=200000, num_workers=4, num_sessions=8, conflict_rate=0.05, latency=0.001,
+                   work_dir='/tmp/conceptnet_stand_in'):
+    """
+    Filter and load a generated assertion csv into the recording stand-in, and check the result
+    against the original filter and insert_triplets: every concept inserted once, every edge once.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    csv_path = os.path.join(work_dir, 'assertions.csv')
+    _fake_assertions(csv_path, num_lines)
+
+    start = time.time()
+    fitler_csv_by_language(csv_path, os.path.join(work_dir, 'en.legacy.csv'))
+    legacy_sec = time.time() - start
+    start = time.time()
+    filter_csv_mp(csv_path, os.path.join(work_dir, 'en.csv'), num_workers=num_workers, chunk_mb=1)
+    print(f"filter: {legacy_sec:.2f}s -> {time.time() - start:.2f}s")
+    with open(os.path.join(work_dir, 'en.legacy.csv'), 'rb') as a, open(os.path.join(work_dir, 'en.csv'), 'rb') as b:
+        assert a.read() == b.read(), 'filtered csv differs'
+
+    expect = []
+    with open(os.path.join(work_dir, 'en.csv'), 'r') as f:
+        for line in f:
+            _, relation, entity_a, entity_b, meta = line.split('\t')
+            expect.append((concept_name(entity_a), concept_name(entity_b), relation))
+
+    client = RecordingClient(conflict_rate=conflict_rate, latency=latency)
+    start = time.time()
+    concepts, edges = collect_graph(os.path.join(work_dir, 'en.csv'), num_workers=num_workers)
+    stats = load_graph(client, concepts, edges, num_sessions=num_sessions)
+    print(f"load: {time.time() - start:.2f}s, {stats}, {client.num_commits} commits")
+
+    node_names = []
+    edge_rows = {}
+    for q in client.committed:
+        literals = [json.loads(m) for m in GRAQL_STR_PAT.findall(q)]
+        if q.startswith('insert'):
+            node_names += literals[0::2]
+        else:
+            head, tail, edge_type = literals
+            edge_id = int(re.search(r'has edge_id (\d+)', q).group(1))
+            assert edge_id not in edge_rows, f"edge {edge_id} inserted twice"
+            edge_rows[edge_id] = (head, tail, edge_type)
+    assert len(node_names) == len(set(node_names)), 'concept inserted more than once'
+    assert set(node_names) == {n for h, t, _ in expect for n in (h, t)}
+    assert [edge_rows[i] for i in range(len(expect))] == expect
+    print(f"OK: {len(node_names)} concepts, {len(edge_rows)} edges, {stats['retries']} retried commits")
+
+
 if __name__ == "__main__":
-    # define_schema()
-    delete_all()
-    insert_triplets('/home/ron/Downloads/hateful_meme_cache/conceptnet-en-5.7.0.csv')
\ No newline at end of file
+    fire.Fire({
+        'filter': fitler_csv_by_language,
+        'filter_mp': filter_csv_mp,
+        'define_schema': define_schema,
+        'delete_all': delete_all,
+        'insert_triplets': insert_triplets,
+        'bulk_load': bulk_load,
+        'stand_in_check': stand_in_check,
+    })
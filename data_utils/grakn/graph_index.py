@@ -0,0 +1,318 @@
+"""
+File backed ConceptNet graph index, read-only neighbour queries without a Grakn server.
+
+    python3 graph_index.py build conceptnet-en-5.7.0.csv /data/ccnet_index
+    python3 graph_index.py benchmark /data/ccnet_index conceptnet-en-5.7.0.csv
+
+    index = GraphIndex('/data/ccnet_index')
+    index.neighbors('dog', relations=['/r/IsA'])        # [('/r/IsA', 'animal'), ...]
+    index.k_hop(['dog', 'cat'], k=2, relations=['/r/IsA', '/r/RelatedTo'])
+    index.batch_neighbors(['dog', 'cat'], direction='both')
+
+Concept names are interned to integer ids (the `ConceptIds` order of
+conceptnet.py). Edges are stored twice, by head (`out_*`) and by tail (`in_*`),
+as CSR arrays: `indptr[v]:indptr[v + 1]` is the slice of node v in `indices`
+(the other end) and `rel` (relation id), sorted by relation inside the slice, so
+the edges of one relation are a contiguous run found by binary search. Names
+are a utf-8 blob with an offset table, and a permutation of the ids sorted by
+name for lookup. Every array is a `.npy` file opened with `mmap_mode='r'`:
+opening the index is instant, and only the pages touched by a query are read.
+"""
+import os
+import json
+import time
+
+import fire
+import numpy as np
+
+import conceptnet
+
+
+def _save(out_dir, name, arr):
+    path = os.path.join(out_dir, name + '.npy')
+    np.save(path + '.tmp.npy', arr)
+    os.replace(path + '.tmp.npy', path)
+
+
+def _csr(src, dst, rel, num_nodes):
+    order = np.lexsort((dst, rel, src))
+    indptr = np.zeros([num_nodes + 1], dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32), rel[order].astype(np.int16)
+
+
+def build(csv_path, out_dir, num_workers=8):
+    """
+    csv_path: english assertions (output of conceptnet.filter_csv_mp).
+    """
+    start = time.time()
+    os.makedirs(out_dir, exist_ok=True)
+    concepts, edges = conceptnet.collect_graph(csv_path, num_workers=num_workers)
+
+    relations = list(conceptnet.REL)
+    rel_id = {r: i for i, r in enumerate(relations)}
+    for relation, _, _ in edges:
+        if relation not in rel_id:
+            rel_id[relation] = len(relations)
+            relations.append(relation)
+    rel = np.fromiter((rel_id[e[0]] for e in edges), dtype=np.int16, count=len(edges))
+    src = np.fromiter((e[1] for e in edges), dtype=np.int64, count=len(edges))
+    dst = np.fromiter((e[2] for e in edges), dtype=np.int64, count=len(edges))
+    num_nodes = len(concepts)
+
+    for prefix, (a, b) in [('out', (src, dst)), ('in', (dst, src))]:
+        indptr, indices, rels = _csr(a, b, rel, num_nodes)
+        _save(out_dir, f"{prefix}_indptr", indptr)
+        _save(out_dir, f"{prefix}_indices", indices)
+        _save(out_dir, f"{prefix}_rel", rels)
+
+    encoded = [n.encode('utf-8') for n in concepts.names]
+    offsets = np.zeros([num_nodes + 1], dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(os.path.join(out_dir, 'names.bin.tmp'), 'wb') as f:
+        f.write(b''.join(encoded))
+    os.replace(os.path.join(out_dir, 'names.bin.tmp'), os.path.join(out_dir, 'names.bin'))
+    _save(out_dir, 'name_offsets', offsets)
+    _save(out_dir, 'name_order', np.asarray(sorted(range(num_nodes), key=encoded.__getitem__), dtype=np.int32))
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'csv_path': os.path.abspath(csv_path),
+            'num_nodes': num_nodes,
+            'num_edges': len(edges),
+            'relations': relations,
+        }, f, indent=2)
+    print(f"{num_nodes} concepts, {len(edges)} edges, {len(relations)} relations in {time.time() - start:.1f}s")
+
+
+class GraphIndex:
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.relations = self.meta['relations']
+        self.rel_id = {r: i for i, r in enumerate(self.relations)}
+        self.num_nodes = self.meta['num_nodes']
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+
+        self.csr = {
+            d: (load(f"{d}_indptr"), load(f"{d}_indices"), load(f"{d}_rel"))
+            for d in ('out', 'in')
+        }
+        self._names = np.memmap(os.path.join(index_dir, 'names.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(index_dir, 'names.bin')) else np.zeros([0], np.uint8)
+        self._offsets = load('name_offsets')
+        self._order = load('name_order')
+
+    def __len__(self):
+        return self.num_nodes
+
+    def name(self, node_id):
+        start, end = self._offsets[node_id], self._offsets[node_id + 1]
+        return bytes(self._names[start:end]).decode('utf-8')
+
+    def _name_bytes(self, node_id):
+        return bytes(self._names[self._offsets[node_id]: self._offsets[node_id + 1]])
+
+    def id(self, name):
+        """
+        Id of a concept name (or of a /c/en/... uri), None if unknown.
+        """
+        key = conceptnet.concept_name(name).encode('utf-8')
+        lo, hi = 0, self.num_nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_bytes(self._order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_nodes and self._name_bytes(self._order[lo]) == key:
+            return int(self._order[lo])
+        return None
+
+    def ids(self, names):
+        return [self.id(n) for n in names]
+
+    def _rel_mask(self, relations):
+        if relations is None:
+            return None
+        mask = np.zeros([len(self.relations)], dtype=bool)
+        mask[[self.rel_id[r] for r in relations if r in self.rel_id]] = True
+        return mask
+
+    def expand(self, nodes, relations=None, direction='out'):
+        """
+        nodes: int array of node ids, return (source position, neighbour id, relation id)
+        arrays of every edge of these nodes, in one vectorized gather.
+        """
+        directions = ['out', 'in'] if direction == 'both' else [direction]
+        nodes = np.asarray(nodes, dtype=np.int64)
+        rel_mask = self._rel_mask(relations)
+        result = []
+        for d in directions:
+            indptr, indices, rel = self.csr[d]
+            starts, ends = indptr[nodes], indptr[nodes + 1]
+            lengths = ends - starts
+            total = int(lengths.sum())
+            owner = np.repeat(np.arange(len(nodes)), lengths)
+            pos = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+            nbr, nbr_rel = np.asarray(indices[pos], dtype=np.int64), np.asarray(rel[pos], dtype=np.int64)
+            if rel_mask is not None:
+                keep = rel_mask[nbr_rel]
+                owner, nbr, nbr_rel = owner[keep], nbr[keep], nbr_rel[keep]
+            result.append((owner, nbr, nbr_rel))
+        return tuple(np.concatenate(parts) for parts in zip(*result))
+
+    def neighbor_ids(self, node_id, relation=None, direction='out'):
+        """
+        Neighbour ids of one node through one relation, a binary search in the relation sorted slice.
+        """
+        indptr, indices, rel = self.csr[direction]
+        start, end = int(indptr[node_id]), int(indptr[node_id + 1])
+        if relation is None:
+            return np.asarray(indices[start:end])
+        r = self.rel_id[relation]
+        rels = rel[start:end]
+        lo, hi = np.searchsorted(rels, r, 'left'), np.searchsorted(rels, r, 'right')
+        return np.asarray(indices[start + lo: start + hi])
+
+    def neighbors(self, name, relations=None, direction='out'):
+        """
+        Return list of (relation, neighbour name).
+        """
+        node_id = self.id(name)
+        if node_id is None:
+            return []
+        _, nbr, nbr_rel = self.expand([node_id], relations, direction)
+        return [(self.relations[r], self.name(n)) for n, r in zip(nbr.tolist(), nbr_rel.tolist())]
+
+    def batch_neighbors(self, names, relations=None, direction='out'):
+        """
+        neighbors of many concepts at once, one list per name (empty for unknown names).
+        """
+        ids = self.ids(names)
+        known = [i for i, node_id in enumerate(ids) if node_id is not None]
+        result = [[] for _ in names]
+        if not known:
+            return result
+        owner, nbr, nbr_rel = self.expand([ids[i] for i in known], relations, direction)
+        for o, n, r in zip(owner.tolist(), nbr.tolist(), nbr_rel.tolist()):
+            result[known[o]].append((self.relations[r], self.name(n)))
+        return result
+
+    def k_hop(self, names, k=2, relations=None, direction='both', max_nodes=None, return_ids=False):
+        """
+        Return {concept: hop distance} of every concept within k hops of the given ones.
+        max_nodes: stop expanding once that many concepts are reached.
+        """
+        seeds = [i for i in self.ids(names) if i is not None]
+        dist = np.full([self.num_nodes], -1, dtype=np.int16)
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        dist[frontier] = 0
+        reached = len(frontier)
+        for hop in range(1, k + 1):
+            if not len(frontier) or (max_nodes and reached >= max_nodes):
+                break
+            _, nbr, _ = self.expand(frontier, relations, direction)
+            nbr = np.unique(nbr)
+            frontier = nbr[dist[nbr] < 0]
+            if max_nodes:
+                frontier = frontier[:max(max_nodes - reached, 0)]
+            dist[frontier] = hop
+            reached += len(frontier)
+        found = np.flatnonzero(dist >= 0)
+        if return_ids:
+            return dict(zip(found.tolist(), dist[found].tolist()))
+        return {self.name(i): int(dist[i]) for i in found.tolist()}
+
+
+def benchmark(index_dir, csv_path, num_queries=1000, k=2, host=None, port=conceptnet.DEFAULT_PORT, seed=0):
+    """
+    Neighbour lookups of random concepts: GraphIndex against the same query over the
+    csv loaded in a DataFrame, and against Graql match queries if a Grakn host is given.
+    """
+    import pandas as pd
+
+    start = time.time()
+    index = GraphIndex(index_dir)
+    print(f"open index: {(time.time() - start) * 1000:.1f}ms")
+
+    rng = np.random.default_rng(seed)
+    names = [index.name(i) for i in rng.integers(0, len(index), num_queries).tolist()]
+
+    start = time.time()
+    results = [index.neighbors(n, direction='both') for n in names]
+    sec = time.time() - start
+    print(f"GraphIndex neighbors: {num_queries / sec:.0f} query/s")
+    start = time.time()
+    batch = index.batch_neighbors(names, direction='both')
+    print(f"GraphIndex batch_neighbors: {num_queries / (time.time() - start):.0f} query/s")
+    assert [sorted(r) for r in batch] == [sorted(r) for r in results]
+    start = time.time()
+    hop_sizes = [len(index.k_hop([n], k=k, relations=['/r/IsA', '/r/RelatedTo'])) for n in names[:100]]
+    print(f"GraphIndex {k}-hop: {100 / (time.time() - start):.0f} query/s, avg {np.mean(hop_sizes):.0f} concepts")
+
+    start = time.time()
+    df = pd.read_csv(csv_path, sep='\t', header=None, names=['uri', 'rel', 'head', 'tail', 'meta'],
+                     usecols=['rel', 'head', 'tail'], quoting=3, dtype=str)
+    df['head'] = df['head'].str.slice(len('/c/en/')).str.split('/').str[0]
+    df['tail'] = df['tail'].str.slice(len('/c/en/')).str.split('/').str[0]
+    print(f"load csv to DataFrame: {time.time() - start:.1f}s")
+    num_scan = min(num_queries, 50)
+    start = time.time()
+    for n, expect in zip(names[:num_scan], results):
+        out = df[df['head'] == n]
+        into = df[df['tail'] == n]
+        scan = list(zip(out['rel'], out['tail'])) + list(zip(into['rel'], into['head']))
+        assert sorted(scan) == sorted(expect), n
+    print(f"DataFrame scan neighbors: {num_scan / (time.time() - start):.1f} query/s")
+
+    if host is not None:
+        num_graql = min(num_queries, 50)
+        with conceptnet.GraknClient(uri=f"{host}:{port}") as client:
+            with client.session(keyspace='conceptnet') as session:
+                start = time.time()
+                for n in names[:num_graql]:
+                    with session.transaction().read() as tx:
+                        query = (
+                            f"match $h isa node, has name {conceptnet.graql_str(n)}; "
+                            f"$e (head: $h, tail: $t) isa edge; $t has name $name; get $name;")
+                        list(tx.query(query))
+                print(f"Graql neighbors: {num_graql / (time.time() - start):.1f} query/s")
+
+
+def check(csv_path, index_dir):
+    """
+    Compare the index with the edges of the csv.
+    """
+    index = GraphIndex(index_dir)
+    out_edges, in_edges = {}, {}
+    with open(csv_path, 'r') as f:
+        for line in f:
+            _, relation, entity_a, entity_b, _ = line.split('\t')
+            a, b = conceptnet.concept_name(entity_a), conceptnet.concept_name(entity_b)
+            out_edges.setdefault(a, []).append((relation, b))
+            in_edges.setdefault(b, []).append((relation, a))
+    names = sorted(set(out_edges) | set(in_edges))
+    assert len(names) == len(index)
+    assert index.batch_neighbors(['__unknown__'])[0] == []
+    for n, out_nbr, in_nbr in zip(
+            names, index.batch_neighbors(names, direction='out'), index.batch_neighbors(names, direction='in')):
+        assert sorted(out_nbr) == sorted(out_edges.get(n, [])), n
+        assert sorted(in_nbr) == sorted(in_edges.get(n, [])), n
+        for relation, _ in out_nbr[:1]:
+            expect = sorted(t for r, t in out_edges[n] if r == relation)
+            got = sorted(index.name(i) for i in index.neighbor_ids(index.id(n), relation).tolist())
+            assert got == expect, n
+    print(f"OK: {len(names)} concepts")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'build': build,
+        'check': check,
+        'benchmark': benchmark,
+    })
@@ -0,0 +1,370 @@
+"""
+Wikidata item label embeddings on disk, with top-k cosine search.
+
+    python3 item_embed.py build /data/KenshoDerivedWikimediaDataset /data/wiki_embed --batch_size 64
+    python3 item_embed.py build_ivf /data/wiki_embed --num_lists 4096
+    python3 item_embed.py search /data/wiki_embed "Adolf Hitler" "star of david" --k 10 --nprobe 16
+
+    store = EmbedStore('/data/wiki_embed')
+    queries = LabelEncoder(**store.encoder_args).encode(['Adolf Hitler'])
+    store.search_items(queries, k=10)    # [[(item_id, score, row), ...]]
+
+Every primary label of item.csv (and alias of item_aliases.csv) is a row of the
+store. Labels are encoded on CPU in batches of similar length (little padding),
+L2 normalized and written into `embed.npy`, a float16 (num_rows, dim) array
+opened with `mmap_mode`, so cosine similarity is a dot product and nothing is
+held in RAM. `ids.npy` / `alias.npy` give the item id of every row and whether
+it is an alias, labels are a utf-8 blob with an offset table. An interrupted
+build resumes from `progress.json`.
+
+Search scans the matrix in blocks of rows and keeps a running top-k, memory is
+O(num_queries * block_rows) instead of the full similarity matrix. `build_ivf`
+adds a coarse index (spherical k-means centroids, rows grouped by nearest
+centroid), searching with `nprobe` only scores the rows of the `nprobe` closest
+lists.
+"""
+import os
+import json
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+
+def _save(out_dir, name, arr):
+    path = os.path.join(out_dir, name + '.npy')
+    np.save(path + '.tmp.npy', arr)
+    os.replace(path + '.tmp.npy', path)
+
+
+def _write_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _normalize(vectors):
+    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norm, 1e-12)
+
+
+def _top_k(scores, rows, k):
+    """
+    scores, rows: (num_queries, n), return the k best of every query, best first.
+    """
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+def load_labels(data_dir, with_aliases=True):
+    """
+    Return (item ids, is alias, labels) of every item label to embed.
+    """
+    item_tab = pd.read_csv(os.path.join(data_dir, 'item.csv'), usecols=['item_id', 'en_label']).dropna()
+    ids = [item_tab.item_id.to_numpy()]
+    labels = [item_tab.en_label.astype(str).to_numpy()]
+    if with_aliases:
+        alias_tab = pd.read_csv(
+            os.path.join(data_dir, 'item_aliases.csv'), usecols=['item_id', 'en_alias']).dropna()
+        ids.append(alias_tab.item_id.to_numpy())
+        labels.append(alias_tab.en_alias.astype(str).to_numpy())
+    alias = np.concatenate([np.full([len(x)], i > 0) for i, x in enumerate(ids)])
+    return np.concatenate(ids).astype(np.int64), alias, np.concatenate(labels)
+
+
+class LabelEncoder:
+
+    def __init__(self, model='roberta-large', pooling='pooler', max_length=32, num_threads=None):
+        """
+        pooling: 'pooler', output of roberta's pooler (same as the original create_item_embed),
+            or 'mean' of the token embeddings.
+        """
+        import torch
+        from transformers import RobertaTokenizer, RobertaModel
+
+        assert pooling in ('pooler', 'mean')
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.torch = torch
+        self.tokenizer = RobertaTokenizer.from_pretrained(model)
+        self.model = RobertaModel.from_pretrained(model).eval()
+        self.pooling = pooling
+        self.max_length = max_length
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts):
+        """
+        Return (len(texts), dim) float32, L2 normalized.
+        """
+        encoded_input = self.tokenizer(
+            list(texts),
+            return_tensors='pt',
+            padding=True,
+            truncation=True,
+            max_length=self.max_length)
+        with self.torch.no_grad():
+            output = self.model(**encoded_input)
+        if self.pooling == 'pooler':
+            embed = output[1]
+        else:
+            mask = encoded_input['attention_mask'].unsqueeze(-1).to(output[0].dtype)
+            embed = (output[0] * mask).sum(1) / mask.sum(1).clamp(min=1)
+        return _normalize(embed.cpu().numpy().astype(np.float32))
+
+
+def create_store(out_dir, ids, alias, labels, dim, meta):
+    """
+    Write the id / label tables and return the (num_rows, dim) float16 memmap to fill.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    _save(out_dir, 'ids', np.asarray(ids, dtype=np.int64))
+    _save(out_dir, 'alias', np.asarray(alias, dtype=bool))
+    encoded = [str(t).encode('utf-8') for t in labels]
+    offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(os.path.join(out_dir, 'labels.bin.tmp'), 'wb') as f:
+        f.write(b''.join(encoded))
+    os.replace(os.path.join(out_dir, 'labels.bin.tmp'), os.path.join(out_dir, 'labels.bin'))
+    _save(out_dir, 'label_offsets', offsets)
+
+    for name in ['progress.json', 'ivf_centroids.npy', 'ivf_rows.npy', 'ivf_offsets.npy']:
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+    vectors = np.lib.format.open_memmap(
+        os.path.join(out_dir, 'embed.npy'), mode='w+', dtype=np.float16, shape=(len(encoded), dim))
+    _write_json(os.path.join(out_dir, 'meta.json'), dict(meta, num_rows=len(encoded), dim=dim, complete=False))
+    return vectors
+
+
+def build(data_dir, out_dir, model='roberta-large', pooling='pooler', batch_size=64, max_length=32,
+          with_aliases=True, num_threads=None, save_every=100):
+    """
+    Replace the per item loop of wikidata.create_item_embed.
+    """
+    start = time.time()
+    ids, alias, labels = load_labels(data_dir, with_aliases=with_aliases)
+    encoder = LabelEncoder(model=model, pooling=pooling, max_length=max_length, num_threads=num_threads)
+    meta = {
+        'data_dir': os.path.abspath(data_dir),
+        'model': model,
+        'pooling': pooling,
+        'max_length': max_length,
+        'with_aliases': with_aliases,
+    }
+
+    meta_path = os.path.join(out_dir, 'meta.json')
+    progress_path = os.path.join(out_dir, 'progress.json')
+    done = 0
+    if os.path.exists(meta_path) and os.path.exists(progress_path):
+        with open(meta_path, 'r') as f:
+            old_meta = json.load(f)
+        if all(old_meta.get(k) == v for k, v in meta.items()) and old_meta['num_rows'] == len(labels):
+            with open(progress_path, 'r') as f:
+                done = json.load(f)['done']
+            vectors = np.load(os.path.join(out_dir, 'embed.npy'), mmap_mode='r+')
+            print(f"[item_embed] resume from {done}/{len(labels)}")
+    if done == 0:
+        vectors = create_store(out_dir, ids, alias, labels, encoder.dim, meta)
+
+    # NOTE: sorted by length, a batch of similar labels needs little padding.
+    order = np.argsort(np.fromiter((len(t) for t in labels), dtype=np.int64, count=len(labels)), kind='stable')
+    num_batches = 0
+    batch_start = time.time()
+    for i in range(done, len(order), batch_size):
+        rows = np.sort(order[i: i + batch_size])
+        vectors[rows] = encoder.encode(labels[rows]).astype(np.float16)
+        done = min(i + batch_size, len(order))
+        num_batches += 1
+        if num_batches % save_every == 0 or done == len(order):
+            vectors.flush()
+            _write_json(progress_path, {'done': done})
+            rate = (num_batches * batch_size) / (time.time() - batch_start)
+            print(f"[item_embed] {done}/{len(order)} labels, {rate:.0f} label/s")
+
+    vectors.flush()
+    _write_json(meta_path, dict(meta, num_rows=len(labels), dim=encoder.dim, complete=True))
+    print(f"[item_embed] {len(labels)} labels of {len(np.unique(ids))} items in {time.time() - start:.1f}s")
+
+
+class EmbedStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if not self.meta['complete']:
+            print(f"[item_embed] {store_dir} is not complete, rows not encoded yet are zero")
+
+        def load(name):
+            return np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r')
+
+        self.vectors = load('embed')
+        self.ids = load('ids')
+        self.alias = load('alias')
+        self.label_offsets = load('label_offsets')
+        self.labels = np.memmap(os.path.join(store_dir, 'labels.bin'), dtype=np.uint8, mode='r') \
+            if self.label_offsets[-1] > 0 else np.zeros([0], dtype=np.uint8)
+        self.ivf = None
+        if os.path.exists(os.path.join(store_dir, 'ivf_centroids.npy')):
+            self.ivf = (load('ivf_centroids'), load('ivf_rows'), load('ivf_offsets'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def encoder_args(self):
+        return {k: self.meta[k] for k in ['model', 'pooling', 'max_length']}
+
+    def label(self, row):
+        return self.labels[self.label_offsets[row]: self.label_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def _search_exact(self, queries, k, block_rows):
+        best_scores = np.full([len(queries), 0], -np.inf, dtype=np.float32)
+        best_rows = np.zeros([len(queries), 0], dtype=np.int64)
+        for start in range(0, len(self), block_rows):
+            block = np.asarray(self.vectors[start: start + block_rows], dtype=np.float32)
+            scores = queries @ block.T
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            scores, rows = _top_k(scores, rows, k)
+            best_scores, best_rows = _top_k(
+                np.concatenate([best_scores, scores], axis=1), np.concatenate([best_rows, rows], axis=1), k)
+        return best_scores, best_rows
+
+    def _search_ivf(self, queries, k, nprobe):
+        centroids, ivf_rows, ivf_offsets = self.ivf
+        probes = _top_k(queries @ np.asarray(centroids, dtype=np.float32).T,
+                        np.broadcast_to(np.arange(len(centroids)), (len(queries), len(centroids))),
+                        nprobe)[1]
+        best_scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+        best_rows = np.full([len(queries), k], -1, dtype=np.int64)
+        for i, lists in enumerate(probes):
+            rows = np.sort(np.concatenate([ivf_rows[ivf_offsets[l]: ivf_offsets[l + 1]] for l in lists.tolist()]))
+            if len(rows) == 0:
+                continue
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ queries[i]
+            scores, rows = _top_k(scores[None], rows[None], k)
+            best_scores[i, :scores.shape[1]] = scores[0]
+            best_rows[i, :rows.shape[1]] = rows[0]
+        return best_scores, best_rows
+
+    def search(self, queries, k=10, nprobe=None, block_rows=65536):
+        """
+        queries: (num_queries, dim) vectors, return (scores, rows) of the k most similar
+        rows by cosine similarity, best first. With nprobe (and build_ivf done) only the
+        rows of the nprobe closest lists are scored; rows of -1 when fewer are found.
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        k = min(k, len(self))
+        if nprobe is not None and self.ivf is not None:
+            return self._search_ivf(queries, k, min(nprobe, len(self.ivf[0])))
+        return self._search_exact(queries, k, block_rows)
+
+    def search_items(self, queries, k=10, oversample=4, **kwargs):
+        """
+        Return [[(item_id, score, row), ...]] of every query, the best row of every item.
+        """
+        scores, rows = self.search(queries, k=k * oversample, **kwargs)
+        results = []
+        for query_scores, query_rows in zip(scores.tolist(), rows.tolist()):
+            found = {}
+            for score, row in zip(query_scores, query_rows):
+                if row < 0:
+                    continue
+                found.setdefault(int(self.ids[row]), (score, row))
+                if len(found) == k:
+                    break
+            results.append([(item_id, score, row) for item_id, (score, row) in found.items()])
+        return results
+
+
+def _assign(vectors, centroids, block_rows):
+    assign = np.zeros([len(vectors)], dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start: start + block_rows], dtype=np.float32)
+        assign[start: start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def build_ivf(store_dir, num_lists=1024, sample_size=200000, iters=10, block_rows=65536, seed=0):
+    """
+    Coarse index of the store: spherical k-means on a sample of the rows, then every
+    row is assigned to its closest centroid.
+    """
+    start = time.time()
+    store = EmbedStore(store_dir)
+    rng = np.random.default_rng(seed)
+    num_lists = min(num_lists, len(store))
+    sample_rows = np.sort(rng.choice(len(store), min(sample_size, len(store)), replace=False))
+    sample = np.asarray(store.vectors[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+
+    for it in range(iters):
+        assign = _assign(sample, centroids, block_rows)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=num_lists)
+        nonempty = np.flatnonzero(counts)
+        sums = np.add.reduceat(sample[order], np.cumsum(counts)[nonempty] - counts[nonempty], axis=0)
+        # NOTE: empty lists keep their centroid
+        centroids[nonempty] = _normalize(sums)
+        print(f"[item_embed] k-means {it + 1}/{iters}, {num_lists - len(nonempty)} empty lists")
+
+    assign = _assign(store.vectors, centroids, block_rows)
+    offsets = np.zeros([num_lists + 1], dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=num_lists), out=offsets[1:])
+    _save(store_dir, 'ivf_rows', np.argsort(assign, kind='stable').astype(np.int64))
+    _save(store_dir, 'ivf_offsets', offsets)
+    _save(store_dir, 'ivf_centroids', centroids.astype(np.float32))
+    sizes = np.diff(offsets)
+    print(f"[item_embed] {num_lists} lists, size mean {sizes.mean():.0f} max {sizes.max()}, "
+          f"in {time.time() - start:.1f}s")
+
+
+def search(store_dir, *texts, k=10, nprobe=None):
+    store = EmbedStore(store_dir)
+    encoder = LabelEncoder(**store.encoder_args)
+    for text, found in zip(texts, store.search_items(encoder.encode(texts), k=k, nprobe=nprobe)):
+        print(text)
+        for item_id, score, row in found:
+            print(f"    {score:.3f} Q{item_id} {store.label(row)}")
+
+
+def benchmark(store_dir, num_queries=100, k=10, nprobe=16, block_rows=65536, noise=0.05, seed=0):
+    """
+    Random rows of the store plus noise as queries: blocked exact search against
+    the full similarity matrix (small stores only), and the recall of the IVF search.
+    """
+    store = EmbedStore(store_dir)
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(store.vectors[np.sort(rng.choice(len(store), num_queries))], dtype=np.float32)
+    queries = _normalize(queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32))
+
+    start = time.time()
+    scores, rows = store.search(queries, k=k, block_rows=block_rows)
+    print(f"blocked exact search: {num_queries / (time.time() - start):.1f} query/s over {len(store)} rows")
+
+    if len(store) * num_queries <= 1e8:
+        full = queries @ np.asarray(store.vectors, dtype=np.float32).T
+        expect = -np.sort(-full, axis=1)[:, :k]
+        assert np.allclose(scores, expect, atol=1e-5)
+        print("blocked exact search == full similarity matrix")
+
+    if store.ivf is not None:
+        start = time.time()
+        _, ivf_rows = store.search(queries, k=k, nprobe=nprobe)
+        sec = time.time() - start
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(rows.tolist(), ivf_rows.tolist())])
+        print(f"IVF search (nprobe={nprobe}): {num_queries / sec:.1f} query/s, recall@{k} {recall:.3f}")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'build': build,
+        'build_ivf': build_ivf,
+        'search': search,
+        'benchmark': benchmark,
+    })
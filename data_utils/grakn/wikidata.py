@@ -1,99 +1,182 @@
 import os
-import torch
+import time
 import numpy as np
 import pandas as pd
 import networkx as nx
 
 from loguru import logger
 from graph_tool.all import *
-from sentence_transformers import SentenceTransformer
-from transformers import RobertaTokenizer, RobertaModel
 
+import item_embed
 
-def build_statement_nx_graph(data_dir, graph_out):
+
+def _pack_strings(values):
+    encoded = [str(v).encode('utf-8') if isinstance(v, str) else b'' for v in values]
+    offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    data = blob.tobytes()
+    return [data[a:b].decode('utf-8') for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def build_statement_arrays(data_dir):
+    """
+    Statement graph as flat arrays:
+        vertex_id: item id of every vertex, the `num_items` items of item.csv (in file order)
+            followed by item ids only seen in statements.
+        vertex_label: en_label of the items.
+        edge_src, edge_dst: vertex index of every statement (in file order).
+        edge_prop: index of the property of every statement in prop_id / prop_label, -1 if unknown.
+    """
     assert os.path.exists(data_dir)
-    item_tab = pd.read_csv(os.path.join(data_dir, 'item.csv'))
-    statem = pd.read_csv(os.path.join(data_dir, 'statements.csv'))
-    prop = pd.read_csv(os.path.join(data_dir, 'property.csv'))
+    start = time.time()
+    item_tab = pd.read_csv(os.path.join(data_dir, 'item.csv'), usecols=['item_id', 'en_label'])
+    item_tab = item_tab.drop_duplicates('item_id')
+    statem = pd.read_csv(
+        os.path.join(data_dir, 'statements.csv'),
+        usecols=['source_item_id', 'edge_property_id', 'target_item_id'])
+    # NOTE: first row of a property id, same as `prop.loc[...].to_list()[0]`
+    prop = pd.read_csv(os.path.join(data_dir, 'property.csv'), usecols=['property_id', 'en_label'])
+    prop = prop.drop_duplicates('property_id').reset_index(drop=True)
+    logger.info(f"{len(item_tab)} items, {len(statem)} statements, {len(prop)} properties loaded "
+                f"in {time.time() - start:.1f}s")
+
+    item_ids = item_tab.item_id.to_numpy()
+    src_ids = statem.source_item_id.to_numpy()
+    dst_ids = statem.target_item_id.to_numpy()
+    endpoints = pd.unique(np.concatenate([src_ids, dst_ids]))
+    extra_ids = endpoints[~np.isin(endpoints, item_ids)]
+    vertex_ids = np.concatenate([item_ids, extra_ids])
+
+    vertex_type = pd.CategoricalDtype(categories=vertex_ids)
+    edge_src = pd.Categorical(src_ids, dtype=vertex_type).codes.astype(np.int32)
+    edge_dst = pd.Categorical(dst_ids, dtype=vertex_type).codes.astype(np.int32)
+    edge_prop = pd.Categorical(statem.edge_property_id, categories=prop.property_id).codes.astype(np.int32)
+    num_missing_prop = int((edge_prop < 0).sum())
+    if num_missing_prop:
+        logger.warning(f"{num_missing_prop} statements with unknown property")
+    if len(extra_ids):
+        logger.warning(f"{len(extra_ids)} item ids of statements are not in item.csv")
+
+    label_blob, label_offsets = _pack_strings(item_tab.en_label.tolist())
+    prop_blob, prop_offsets = _pack_strings(prop.en_label.tolist())
+    arrays = {
+        'num_items': np.int64(len(item_ids)),
+        'vertex_id': vertex_ids.astype(np.int64),
+        'vertex_label_blob': label_blob,
+        'vertex_label_offsets': label_offsets,
+        'edge_src': edge_src,
+        'edge_dst': edge_dst,
+        'edge_prop': edge_prop,
+        'prop_id': prop.property_id.to_numpy().astype(np.int64),
+        'prop_label_blob': prop_blob,
+        'prop_label_offsets': prop_offsets,
+    }
+    logger.info(f"statement arrays: {len(vertex_ids)} vertices, {len(edge_src)} edges in {time.time() - start:.1f}s")
+    return arrays
+
+
+def save_statement_arrays(arrays, path):
+    """
+    Binary artifact (.npz) of the statement graph, reloaded with load_statement_arrays.
+    """
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
 
+
+def load_statement_arrays(path):
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def _labels(arrays, prefix):
+    return np.asarray(
+        _unpack_strings(arrays[f"{prefix}_label_blob"], arrays[f"{prefix}_label_offsets"]), dtype=object)
+
+
+def arrays_to_nx(arrays):
+    """
+    Undirected networkx graph, same layout as the original build_statement_nx_graph:
+    node attribute `label`, edge attributes `property_id`, `property_label`.
+    """
+    num_items = int(arrays['num_items'])
+    vertex_id = arrays['vertex_id'].tolist()
     G = nx.Graph()
-    num_items = len(item_tab)
-    for i, row in item_tab.iterrows():
-        G.add_node(row.item_id, label=row.en_label)
-        print(f"[ITEM] {i}/{num_items}")
-        if i > 100:
-            break
-    
-    num_state = len(statem)
-    for i, row in statem.iterrows():
-        pid = row.edge_property_id
-        plabel = prop.loc[prop['property_id'] == pid].en_label
-        plabel = plabel.to_list()[0]
-        print(f"[EDGE] {i}/{num_state}  {row.source_item_id} --[{pid}, {plabel}]--> {row.target_item_id}")
-        G.add_edge(
-            row.source_item_id,
-            row.target_item_id,
-            property_id=pid,
-            property_label=plabel
-        )
-        if i > 100:
-            break
-    nx.write_gpickle(G, graph_out)
+    G.add_nodes_from((vid, {'label': label}) for vid, label in zip(vertex_id[:num_items], _labels(arrays, 'vertex')))
 
+    prop_id = np.append(arrays['prop_id'], -1)
+    prop_label = np.append(_labels(arrays, 'prop'), None)
+    edge_prop = arrays['edge_prop']
+    G.add_edges_from(
+        (vertex_id[s], vertex_id[t], {'property_id': p, 'property_label': l})
+        for s, t, p, l in zip(
+            arrays['edge_src'].tolist(), arrays['edge_dst'].tolist(),
+            prop_id[edge_prop].tolist(), prop_label[edge_prop].tolist())
+    )
+    return G
 
-def build_statement_gtool_graph(data_dir, graph_out):
-    assert os.path.exists(data_dir)
-    save_dir = os.path.dirname(graph_out)
-    log_file = os.path.join(save_dir, 'wiki_gtool_graph_{time}.log')
-    logger.add(log_file)
-    
-    item_tab = pd.read_csv(os.path.join(data_dir, 'item.csv'))
-    num_items = len(item_tab)
 
+def arrays_to_gtool(arrays):
+    """
+    graph-tool graph, same layout as the original build_statement_gtool_graph: vertex properties
+    `id`, `label`, edge properties `property_id`, `property_label`. Statements with a item
+    missing from item.csv are left out.
+    """
+    num_items = int(arrays['num_items'])
     G = Graph()
-    v_label = G.new_vertex_property('string')
+    G.add_vertex(num_items)
     v_id = G.new_vertex_property('int')
-    id_to_vert = {}
-    
-    for i, row in item_tab.iterrows():
-        v = G.add_vertex()
-        v_id[v] = row.item_id
-        v_label[v] = row.en_label
-        id_to_vert[row.item_id] = v
-        print(f"[ITEM] {i}/{num_items}")
-        # if i > 100:
-        #     break
-    G.vertex_properties["label"] = v_label
-    G.vertex_properties["id"] = v_id
-    G.save(os.path.join(save_dir, 'wikidata.item.xml.gz'))
-    del item_tab
-    
-    statem = pd.read_csv(os.path.join(data_dir, 'statements.csv'))
-    prop = pd.read_csv(os.path.join(data_dir, 'property.csv'))
-    num_state = len(statem)
+    v_id.a[:] = arrays['vertex_id'][:num_items]
+    v_label = G.new_vertex_property('string', vals=_labels(arrays, 'vertex'))
 
+    src, dst, edge_prop = arrays['edge_src'], arrays['edge_dst'], arrays['edge_prop']
+    keep = (src < num_items) & (dst < num_items)
+    if (~keep).any():
+        logger.warning(f"{int((~keep).sum())} statements have missing item!")
+    prop_id = np.append(arrays['prop_id'], -1)
     e_id = G.new_edge_property('int')
-    e_label = G.new_edge_property('string')
-
-    for i, row in statem.iterrows():
-        pid = row.edge_property_id
-        plabel = prop.loc[prop['property_id'] == pid].en_label
-        plabel = plabel.to_list()[0]
-        print(f"[EDGE] {i}/{num_state}  {row.source_item_id} --[{pid}, {plabel}]--> {row.target_item_id}")
-        try:
-            e = G.add_edge(
-                id_to_vert[row.source_item_id],
-                id_to_vert[row.target_item_id],
-            )
-            e_id[e] = pid
-            e_label[e] = plabel
-        except KeyError:
-            logger.warning(f"{row.source_item_id} --[{pid}, {plabel}]--> {row.target_item_id} have missing item!")
-        # if i > 100:
-        #     break
+    e_code = G.new_edge_property('int')
+    G.add_edge_list(
+        np.stack([src[keep], dst[keep], prop_id[edge_prop[keep]], edge_prop[keep]], axis=1),
+        eprops=[e_id, e_code])
+    # NOTE: string properties can't be set from an array, `vals` follow the G.edges() order
+    prop_label = np.append(_labels(arrays, 'prop'), '')
+    e_label = G.new_edge_property('string', vals=prop_label[G.get_edges([e_code])[:, 2]])
 
+    G.vertex_properties["label"] = v_label
+    G.vertex_properties["id"] = v_id
     G.edge_properties["property_label"] = e_label
     G.edge_properties["property_id"] = e_id
+    return G
+
+
+def build_statement_nx_graph(data_dir, graph_out, arrays_out=None):
+    arrays = build_statement_arrays(data_dir)
+    if arrays_out is not None:
+        save_statement_arrays(arrays, arrays_out)
+    G = arrays_to_nx(arrays)
+    nx.write_gpickle(G, graph_out)
+
+
+def build_statement_gtool_graph(data_dir, graph_out, arrays_out=None):
+    """
+    graph_out: .gt for graph-tool's binary format (fastest to reload), or .xml.gz
+    arrays_out: also save the statement arrays (.npz)
+    """
+    save_dir = os.path.dirname(graph_out)
+    log_file = os.path.join(save_dir, 'wiki_gtool_graph_{time}.log')
+    logger.add(log_file)
+
+    start = time.time()
+    arrays = build_statement_arrays(data_dir)
+    if arrays_out is not None:
+        save_statement_arrays(arrays, arrays_out)
+    G = arrays_to_gtool(arrays)
+    logger.info(f"graph built: {G.num_vertices()} vertices, {G.num_edges()} edges in {time.time() - start:.1f}s")
     G.save(graph_out)
 
 
@@ -158,39 +241,12 @@ def filter_edge(data_dir):
     print(statem)
 
 
-def embed_mtx_cos(mtx_a, mtx_b):
-    norm_a = np.linalg.norm(mtx_a, keepdims=True, axis=1)
-    norm_b = np.linalg.norm(mtx_b, keepdims=True, axis=1)
-    mtx_norm = np.matmul(norm_a, norm_b.T)
-    mtx_cos = np.matmul(mtx_a, mtx_b.T) / mtx_norm
-    return mtx_cos
-
-
-def create_item_embed(data_dir):
-    item_tab = pd.read_csv(os.path.join(data_dir, 'item.csv'))
-    aliase_tab = pd.read_csv(os.path.join(data_dir, 'item_aliases.csv'))
-    
-    # roberta = SentenceTransformer('roberta-large-nli-stsb-mean-tokens')
-    tokenizer = RobertaTokenizer.from_pretrained('roberta-large')
-    roberta = RobertaModel.from_pretrained('roberta-large')
-
-    with torch.no_grad():
-        for i, row in item_tab.iterrows():
-            primary_label = row.en_label
-            iid = row.item_id
-            alias = aliase_tab[aliase_tab.item_id == iid].en_alias.values.tolist()
-            # embed = roberta.encode([primary_label] + alias)
-            
-            encoded_input = tokenizer(
-                ['A small cat', primary_label] + alias,
-                return_tensors='pt',
-                padding=True)
-            output = roberta(**encoded_input)
-            embed = output[1].cpu().numpy()
-            _cos_dis = embed_mtx_cos(embed, embed)
-            import pdb; pdb.set_trace()
-            break
-
+def create_item_embed(data_dir, out_dir=None, **kwargs):
+    """
+    Embedding of every item label and alias, see item_embed.py.
+    """
+    out_dir = out_dir or os.path.join(data_dir, 'item_embed')
+    item_embed.build(data_dir, out_dir, **kwargs)
 
 
 if __name__ == "__main__":
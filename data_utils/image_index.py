@@ -0,0 +1,182 @@
+"""
+Persistent image metadata index: id, path, width, height, file size, mtime (and sha1) of every image under a directory.
+
+    index = ImageIndex('/meme_data/img').refresh(num_workers=8)
+    w, h = index.size('01235.png')
+    index.ids()  # {'01235', ...}
+
+The index is a json file next to the image directory (`<img_dir>.index.json`
+by default, image dirs are often mounted read-only). Only image headers are
+parsed (PIL doesn't decode pixels until they are accessed). `refresh` stats
+every file and only re-reads the ones that are new or whose size / mtime
+changed, in a process pool.
+
+The content hash (sha1 of the raw bytes) reads every file in full, so it is
+opt-in: `refresh(sha1=True)` also hashes the images without one yet, for
+callers keyed on image content (pipeline items, dup_index). Changed files lose
+their hash and get a new one on the next `refresh(sha1=True)`.
+
+    python3 image_index.py build /meme_data/img --num_workers 16 [--sha1]
+"""
+import os
+import json
+import time
+import hashlib
+from multiprocessing import Pool
+
+import fire
+from PIL import Image
+
+
+IMG_EXTS = ('.png', '.jpg', '.jpeg')
+
+
+def image_id(path):
+    return os.path.basename(path).split('.')[0]
+
+
+def _scan(img_dir):
+    """
+    Return {relative path: (size, mtime_ns)} of every image under img_dir.
+    """
+    found = {}
+    stack = [img_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMG_EXTS):
+                    st = entry.stat()
+                    found[os.path.relpath(entry.path, img_dir)] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+def _read_meta(args):
+    img_dir, rel_path, sha1 = args
+    path = os.path.join(img_dir, rel_path)
+    try:
+        with Image.open(path) as img:
+            meta = dict(zip(('w', 'h'), img.size))
+        if sha1:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            meta['sha1'] = h.hexdigest()
+    except Exception as e:
+        print(f"[image_index] can't read {path}: {e}")
+        return rel_path, None
+    return rel_path, meta
+
+
+class ImageIndex:
+
+    def __init__(self, img_dir, index_path=None):
+        self.img_dir = os.path.abspath(img_dir)
+        self.index_path = index_path or self.img_dir.rstrip('/') + '.index.json'
+        self.entries = {}  # relative path -> {id, w, h, size, mtime_ns[, sha1]}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.entries = json.load(f)['images']
+        self._by_name = None
+        self.hashed = False  # every entry has its sha1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def refresh(self, num_workers=8, sha1=False):
+        """
+        sha1: also hash the content of images without sha1.
+        """
+        start = time.time()
+        found = _scan(self.img_dir)
+        removed = [p for p in self.entries if p not in found]
+        for p in removed:
+            del self.entries[p]
+        todo = [
+            p for p, (size, mtime_ns) in found.items()
+            if p not in self.entries
+            or self.entries[p]['size'] != size
+            or self.entries[p]['mtime_ns'] != mtime_ns
+            or (sha1 and 'sha1' not in self.entries[p])
+        ]
+
+        if todo:
+            args = [(self.img_dir, p, sha1) for p in todo]
+            if num_workers > 1 and len(todo) > 1:
+                with Pool(num_workers) as pool:
+                    metas = pool.map(_read_meta, args, chunksize=64)
+            else:
+                metas = [_read_meta(a) for a in args]
+            unreadable = [rel_path for rel_path, meta in metas if meta is None]
+            if unreadable:
+                print(f"[image_index] {len(unreadable)} unreadable images left out of the index: {unreadable[:20]}")
+            for rel_path, meta in metas:
+                if meta is None:
+                    self.entries.pop(rel_path, None)
+                    continue
+                size, mtime_ns = found[rel_path]
+                meta.update(id=image_id(rel_path), size=size, mtime_ns=mtime_ns)
+                self.entries[rel_path] = meta
+
+        if todo or removed or not os.path.exists(self.index_path):
+            self.save()
+        self._by_name = None
+        self.hashed = all('sha1' in e for e in self.entries.values())
+        print(
+            f"[image_index] {self.img_dir}: {len(self.entries)} images, {len(todo)} (re)indexed{' with sha1' if sha1 else ''}, "
+            f"{len(removed)} removed in {time.time() - start:.1f}s")
+        return self
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'img_dir': self.img_dir, 'images': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, name):
+        """
+        name: path relative to img_dir, or file name of an image in any sub directory.
+        """
+        if name in self.entries:
+            return self.entries[name]
+        if self._by_name is None:
+            self._by_name = {os.path.basename(p): e for p, e in self.entries.items()}
+        return self._by_name.get(name)
+
+    def size(self, name):
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(f"{name} not in image index of {self.img_dir}")
+        return entry['w'], entry['h']
+
+    def paths(self, max_depth=None, exts=IMG_EXTS):
+        """
+        Absolute path of indexed images, max_depth=0 for the images directly in img_dir.
+        """
+        return [
+            os.path.join(self.img_dir, p)
+            for p in sorted(self.entries)
+            if (max_depth is None or p.count(os.sep) <= max_depth) and p.lower().endswith(exts)
+        ]
+
+    def ids(self, max_depth=None, exts=IMG_EXTS):
+        return {
+            e['id'] for p, e in self.entries.items()
+            if (max_depth is None or p.count(os.sep) <= max_depth) and p.lower().endswith(exts)
+        }
+
+
+def build(img_dir, index_path=None, num_workers=8, sha1=False):
+    index = ImageIndex(img_dir, index_path=index_path).refresh(num_workers=num_workers, sha1=sha1)
+    print(f"Saved: {index.index_path}")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'build': build,
+    })
@@ -0,0 +1,182 @@
+"""
+White text mask used to inpaint OCR text away.
+
+Same output as the original `multi_boxes_mask`: pure white pixels inside the
+(padded) OCR boxes, dilated by cumulatively OR-ing the mask with shifted copies
+of itself (offsets in `DILATE_SHIFTS`). Instead of building 9 padded full frame
+copies, the mask is single-channel, only the rectangle covering all boxes (plus
+the dilation reach) is processed, and every shift is a single in-place
+`np.maximum` between two views of that crop.
+
+    python3 mask_engine.py benchmark --num_images 50
+"""
+import time
+
+import fire
+import numpy as np
+
+
+DILATE_SHIFTS = [
+    (1, 0), (-1, 0), (0, 1), (0, -1),
+    (1, 1), (-1, 1), (1, -1), (-1, -1),
+]
+
+
+def _dilate_shift_(mask, ox, oy):
+    """
+    In-place: mask[y, x] |= mask[y + oy, x + ox], outside of mask count as 0.
+    """
+    h, w = mask.shape
+    if abs(ox) >= w or abs(oy) >= h:
+        return mask
+    dst = mask[max(0, -oy): h - max(0, oy), max(0, -ox): w - max(0, ox)]
+    src = mask[max(0, oy): h - max(0, -oy), max(0, ox): w - max(0, -ox)]
+    # NOTE: numpy copies `src` first since it overlaps `dst`, so this matches the out-of-place version.
+    np.maximum(dst, src, out=dst)
+    return mask
+
+
+def padded_boxes(boxes, img_hw, pad_crop=5):
+    """
+    boxes: (n, 4) ymin, xmin, ymax, xmax
+    """
+    boxes = np.array(boxes, dtype=np.int64).reshape([-1, 4])
+    boxes[:, :2] = np.maximum(boxes[:, :2] - pad_crop, 0)
+    boxes[:, 2:] = np.minimum(boxes[:, 2:] + pad_crop, np.asarray(img_hw[:2]))
+    # NOTE: the original implementation slice the image with those values directly,
+    # so a negative ymax/xmax count from the end of the axis, like python slicing does.
+    boxes[:, 2:] = np.where(
+        boxes[:, 2:] < 0, np.maximum(boxes[:, 2:] + np.asarray(img_hw[:2]), 0), boxes[:, 2:])
+    return boxes
+
+
+def white_text_mask(image, boxes, pad_crop=5, shift=3, white_thresh=253):
+    """
+    image: np.uint8 (h, w, c)
+    boxes: (n, 4) ymin, xmin, ymax, xmax
+    Return np.uint8 (h, w) mask, 1 for masked pixel.
+    """
+    ih, iw = image.shape[:2]
+    mask = np.zeros([ih, iw], dtype=np.uint8)
+    boxes = padded_boxes(boxes, (ih, iw), pad_crop=pad_crop)
+    boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+    if len(boxes) == 0:
+        return mask
+
+    # region of interest: every box plus how far the dilation can reach
+    reach = shift * 3
+    y0 = max(int(boxes[:, 0].min()) - reach, 0)
+    x0 = max(int(boxes[:, 1].min()) - reach, 0)
+    y1 = min(int(boxes[:, 2].max()) + reach, ih)
+    x1 = min(int(boxes[:, 3].max()) + reach, iw)
+    roi = mask[y0: y1, x0: x1]
+
+    for ymin, xmin, ymax, xmax in boxes.tolist():
+        patch = image[ymin: ymax, xmin: xmax]
+        # NOTE: per channel compare then AND is a lot faster than `.all(axis=-1)` on the channel axis.
+        white = patch[..., 0] > white_thresh
+        for c in range(1, patch.shape[-1]):
+            white &= patch[..., c] > white_thresh
+        roi_box = roi[ymin - y0: ymax - y0, xmin - x0: xmax - x0]
+        np.maximum(roi_box, white, out=roi_box)
+
+    # NOTE: the dilation is only exact inside the roi if the roi touch the image border or
+    # leave `reach` pixel of margin around the boxes, which is guaranteed by the crop above.
+    for ox, oy in DILATE_SHIFTS:
+        _dilate_shift_(roi, ox * shift, oy * shift)
+    return mask
+
+
+def apply_mask(image, mask):
+    """
+    Return (masked image, 3 channel 0/255 mask image), same as the original multi_boxes_mask.
+    """
+    keep = 1 - mask
+    masked = image * keep[..., None]
+    mask_img = np.empty_like(image)
+    mask_img[...] = (mask * np.uint8(255))[..., None]
+    return masked, mask_img
+
+
+def legacy_multi_boxes_mask(image, boxes, pad_crop=5):
+    """
+    Original full frame implementation (without debug prints), kept as benchmark reference.
+    """
+    image = image.copy()
+    boxes = np.array(boxes, dtype=np.int32)
+    mask = np.zeros_like(image)
+    ih, iw, ic = image.shape
+
+    for box in boxes:
+        box[:2] = np.maximum(box[:2] - pad_crop, 0)
+        box[2:] = np.minimum(box[2:] + pad_crop, image.shape[:2])
+        patch = image[box[0]: box[2], box[1]: box[3], :]
+        pure_white = (patch > 253).all(axis=-1).astype(np.uint8)
+        mask[box[0]: box[2], box[1]: box[3], :] = pure_white[..., None]
+
+    shift = 3
+    shifts = [
+        (0, 0), (shift, 0), (-shift, 0), (0, shift), (0, -shift),
+        (shift, shift), (-shift, shift), (shift, -shift), (-shift, -shift)
+    ]
+    for ox, oy in shifts:
+        _mask = mask[
+            max(0, 0 + oy): min(ih, ih + oy),
+            max(0, 0 + ox): min(iw, iw + ox),
+            :
+        ]
+        crop_pad = [
+            (max(0, -oy), max(0, oy)),
+            (max(0, -ox), max(0, ox)),
+            (0, 0)
+        ]
+        _mask = np.pad(_mask, crop_pad)
+        mask = np.clip(_mask + mask, 0, 1)
+
+    image = image * (1 - mask) + mask * 255 * 0
+    mask *= 255
+    return image, mask
+
+
+def synthetic_meme(rng, h=600, w=800, num_boxes=4):
+    """
+    Noisy background with white "text strokes" inside a few wide boxes.
+    """
+    image = rng.integers(0, 250, size=[h, w, 3], dtype=np.uint8)
+    boxes = []
+    for _ in range(num_boxes):
+        bh = int(rng.integers(20, 80))
+        bw = int(rng.integers(100, w))
+        y = int(rng.integers(0, h - bh))
+        x = int(rng.integers(0, w - bw))
+        strokes = rng.random([bh, bw]) < 0.3
+        image[y: y + bh, x: x + bw][strokes] = 255
+        boxes.append([y, x, y + bh, x + bw])
+    return image, np.asarray(boxes, dtype=np.int32)
+
+
+def benchmark(num_images=50, height=600, width=800, num_boxes=4, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = [synthetic_meme(rng, height, width, num_boxes) for _ in range(num_images)]
+
+    start = time.time()
+    legacy = [legacy_multi_boxes_mask(img, boxes) for img, boxes in samples]
+    legacy_sec = time.time() - start
+
+    start = time.time()
+    fast = [apply_mask(img, white_text_mask(img, boxes)) for img, boxes in samples]
+    fast_sec = time.time() - start
+
+    for (l_img, l_mask), (f_img, f_mask) in zip(legacy, fast):
+        assert np.array_equal(l_mask, f_mask), "mask mismatch"
+        assert np.array_equal(l_img, f_img), "masked image mismatch"
+
+    print(f"legacy: {legacy_sec / num_images * 1000:.2f} ms/img")
+    print(f"roi:    {fast_sec / num_images * 1000:.2f} ms/img")
+    print(f"speedup: {legacy_sec / fast_sec:.1f}x, outputs identical")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'benchmark': benchmark,
+    })
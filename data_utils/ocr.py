@@ -2,95 +2,38 @@ import os
 import glob
 import json
 import shutil
+import hashlib
 from multiprocessing import Pool
 
 import fire
-import easyocr
 import numpy as np
-import torch
 
 from PIL import Image
 from skimage import transform
 from skimage.feature import canny
 from skimage.color import rgb2gray, gray2rgb
 
+from ocr_engine import run_sharded_ocr, merge_shards
+from mask_engine import white_text_mask, apply_mask
+
 
 def multi_boxes_mask(image, boxes, pad_crop=5):
     """
     image: np.uint8 (h, w, c)
     boxes: np.int32 (n, 4) ymin, xmin, ymax, xmax
     """
-    image = image.copy()
-    mask = np.zeros_like(image)
-    ih, iw, ic = image.shape
-    resize = lambda a, b: transform.resize(a, b, preserve_range=True).astype(np.uint8)
-    import matplotlib.pyplot as plt
-    
-    for box in boxes:
-        # image[box[0]: box[2], box[1]: box[3], :] = 0
-        box[:2] = np.maximum(box[:2] - pad_crop, 0)
-        box[2:] = np.minimum(box[2:] + pad_crop, image.shape[:2])
-        
-        patch = image[box[0]: box[2], box[1]: box[3], :]
-        pure_white = (patch > 253).all(axis=-1).astype(np.uint8)
-        mask[box[0]: box[2], box[1]: box[3], :] = pure_white[..., None]
-        
-        # plt.subplot(2, 1, 1)
-        # plt.imshow(patch)
-        # plt.subplot(2, 1, 2)
-        # plt.imshow(pure_white)
-        # plt.colorbar()
-        # plt.show()
-        
-        print('pure_white ', pure_white.sum())
-    
-    shift = 3
-    shifts = [
-        (0, 0), (shift, 0), (-shift, 0), (0, shift), (0, -shift),
-        (shift, shift), (-shift, shift), (shift, -shift), (-shift, -shift)
-    ]
-    # shifts = []
-    for offset in shifts:
-        ox, oy = offset
-        _mask = mask.copy()
-
-        slice_y = slice(max(0, 0 + oy), min(ih, ih + oy))
-        slice_x = slice(max(0, 0 + ox), min(iw, iw + ox))
-        print(slice_y, slice_x)
-        _mask = _mask[
-            max(0, 0 + oy): min(ih, ih + oy),
-            max(0, 0 + ox): min(iw, iw + ox),
-            :
-        ]
-        crop_pad = [
-            (max(0, -oy), max(0, oy)),
-            (max(0, -ox), max(0, ox)),
-            (0, 0)
-        ]
-        _mask = np.pad(_mask, crop_pad)
-        print(
-            crop_pad,
-            np.abs(_mask - mask).sum(),
-            np.abs(mask - np.clip(_mask + mask, 0, 1)).sum()
-        )
-        mask = np.clip(_mask + mask, 0, 1)
-
-    image = image * (1 - mask) + mask * 255 * 0
-    mask *= 255
-    return image, mask
-
-def cast_pred_type(pred):
-    result = []
-    for tup in pred:
-        coord, txt, score = tup
-        coord = np.array(coord).tolist()
-        score = float(score)
-        result.append((coord, txt, score))
-    return result
-
-
-def detect(root_dir):
-    reader = easyocr.Reader(['en'])
+    mask = white_text_mask(image, boxes, pad_crop=pad_crop)
+    return apply_mask(image, mask)
+
+
+def detect(root_dir, num_workers=1, batch_size=8, gpu=True, shard_dir=None, images_per_batch=8):
+    """
+    num_workers: number of OCR processes, each holding its own EasyOCR model.
+    batch_size: text crops per recognizer batch.
+    images_per_batch: images of the same size OCRed in one `readtext_batched` call.
+    shard_dir: where partial results are kept, rerun with the same shard_dir only
+        process images that don't have result yet. Default to ROOT/ocr_shards.
+    """
     image_dir = os.path.join(root_dir, 'img')
     images = glob.glob(os.path.join(image_dir, '*.png'))
     images += glob.glob(os.path.join(image_dir, '**', '*.png'))
@@ -98,17 +41,20 @@ def detect(root_dir):
     assert len(images) > 9000
 
     out_json = os.path.join(root_dir, 'ocr.json')
-    out_anno = {}
+    if shard_dir is None:
+        shard_dir = os.path.join(root_dir, 'ocr_shards')
     print(f"Find {len(images)} images!")
 
-    for i, image_path in enumerate(images):
-        print(F"{i}/{len(images)}")
-        img_name = os.path.basename(image_path)
-        pred = reader.readtext(image_path)
-        out_anno[img_name] = cast_pred_type(pred)
-
-    with open(out_json, 'w') as f:
-        json.dump(out_anno, f)
+    run_sharded_ocr(
+        sorted(images),
+        shard_dir,
+        num_workers=num_workers,
+        gpu=gpu,
+        batch_size=batch_size,
+        images_per_batch=images_per_batch,
+    )
+    out_anno = merge_shards(shard_dir, out_json)
+    print(f"Write {len(out_anno)} OCR results to {out_json}")
 
 
 def point_to_box(anno_json):
@@ -133,53 +79,93 @@ def point_to_box(anno_json):
         json.dump(boxed_anno, f)
 
 
+MASK_MANIFEST = 'mask_manifest.jsonl'
+
+
+def _mask_entry_hash(img_boxes, pad_crop, mask_only):
+    content = json.dumps([img_boxes, pad_crop, mask_only], sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
 def _mask_white_txt(args):
-    img_name, img_boxes, img_dir, out_dir = args
+    img_name, img_boxes, img_dir, out_dir, pad_crop, mask_only, compress_level = args
     img_path = os.path.join(img_dir, img_name)
     out_path = os.path.join(out_dir, img_name)
+    mask_path = os.path.join(out_dir, img_name.replace('.png', '.mask.png'))
     
-    if os.path.exists(out_path):
-        return
-    # if img_name != '01487.png':
-    #     continue
-    
-    print(out_path)
     img_boxes = [box_info[0] for box_info in img_boxes]
+    img = np.array(Image.open(img_path).convert('RGB'))
     if len(img_boxes) > 0:
         boxes = np.asarray(img_boxes, dtype=np.int32)
-        # print(boxes)
-        boxes = np.concatenate([boxes[:, ::-1][:, 2:], boxes[:,::-1][:, :2]], axis=1)
-        # print(boxes)
         # x,y,x,y -> y,x,y,x
-        img = np.array(Image.open(img_path).convert('RGB'))
-        # res = inpaint_model.inpaint_multi_boxes(img, boxes)
-        masked_img, mask = multi_boxes_mask(img, boxes)
-
-        Image.fromarray(masked_img).save(out_path)
-        out_path = os.path.join(out_dir, img_name.replace('.png', '.mask.png'))
-        Image.fromarray(mask).save(out_path)
+        boxes = np.concatenate([boxes[:, ::-1][:, 2:], boxes[:,::-1][:, :2]], axis=1)
+        mask = white_text_mask(img, boxes, pad_crop=pad_crop)
     else:
-        img = np.asarray(Image.open(img_path).convert('RGB'))
-        shutil.copy(img_path, out_path)
+        mask = np.zeros(img.shape[:2], dtype=np.uint8)
 
-        mask = np.zeros_like(img)
-        out_path = os.path.join(out_dir, img_name.replace('.png', '.mask.png'))
-        Image.fromarray(mask).save(out_path)
+    if mask_only:
+        Image.fromarray(mask * np.uint8(255)).save(mask_path, compress_level=compress_level)
+    else:
+        masked_img, mask_img = apply_mask(img, mask)
+        if len(img_boxes) > 0:
+            Image.fromarray(masked_img).save(out_path, compress_level=compress_level)
+        else:
+            shutil.copy(img_path, out_path)
+        Image.fromarray(mask_img).save(mask_path, compress_level=compress_level)
+    return img_name
+
+
+def _load_mask_manifest(out_dir):
+    done = {}
+    manifest_path = os.path.join(out_dir, MASK_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[rec['img_name']] = rec['hash']
+    return done
+
+
+def generate_mask(ocr_box_anno, img_dir, out_dir, num_workers=16, chunk_size=16,
+                  max_in_flight=1024, pad_crop=5, compress_level=6, mask_only=False):
+    """
+    num_workers: size of the process pool.
+    max_in_flight: number of images submitted to the pool at once, bounds memory usage.
+    compress_level: PNG zlib level 0~9, lower is faster but make bigger file.
+    mask_only: only write the single channel mask (*.mask.png), without the masked image.
 
-def generate_mask(ocr_box_anno, img_dir, out_dir):
+    Every finished image is recorded in OUT_DIR/mask_manifest.jsonl together with
+    a hash of its OCR boxes and mask settings, so rerun only process new or changed entries.
+    """
     os.makedirs(out_dir, exist_ok=True)
     with open(ocr_box_anno, 'r') as f:
         boxes_anno = json.load(f)
 
-    # for i, (img_name, img_boxes) in enumerate(boxes_anno.items()):
-    #     pass
-    
-    with Pool(16) as pool:
-        args = [
-            (img_name, img_boxes, img_dir, out_dir)
-            for img_name, img_boxes in boxes_anno.items()
-        ]
-        pool.map(_mask_white_txt, args)
+    done = _load_mask_manifest(out_dir)
+    todo = []
+    for img_name, img_boxes in boxes_anno.items():
+        entry_hash = _mask_entry_hash(img_boxes, pad_crop, mask_only)
+        mask_path = os.path.join(out_dir, img_name.replace('.png', '.mask.png'))
+        if done.get(img_name) != entry_hash or not os.path.exists(mask_path):
+            todo.append((img_name, entry_hash))
+    print(f"Find {len(boxes_anno)} OCR entries, {len(todo)} need new mask")
+
+    manifest_path = os.path.join(out_dir, MASK_MANIFEST)
+    with Pool(num_workers) as pool, open(manifest_path, 'a') as manifest:
+        for i in range(0, len(todo), max_in_flight):
+            window = todo[i: i + max_in_flight]
+            hashes = dict(window)
+            args = (
+                (img_name, boxes_anno[img_name], img_dir, out_dir, pad_crop, mask_only, compress_level)
+                for img_name, _ in window
+            )
+            for img_name in pool.imap_unordered(_mask_white_txt, args, chunksize=chunk_size):
+                manifest.write(json.dumps({'img_name': img_name, 'hash': hashes[img_name]}) + '\n')
+            manifest.flush()
+            print(f"[generate_mask] {min(i + max_in_flight, len(todo))}/{len(todo)}")
 
 
 if __name__ == "__main__":
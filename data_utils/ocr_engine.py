@@ -0,0 +1,159 @@
+"""
+Resumable, multi-process EasyOCR runner.
+
+Images are split into shards, one per worker process. Every worker appends
+its results to `shard_dir/shard_XXX.jsonl` as soon as an image is done, so a
+crashed or interrupted run loses at most the images in flight. On (re)start
+all existing shard files are scanned to build the index of finished images,
+and only the missing ones are processed. `merge_shards` then collects every
+shard into the `{img_name: [(coord, txt, score), ...]}` layout of ocr.json.
+
+Images of the same size are OCRed together with `Reader.readtext_batched`
+(`images_per_batch` at a time), so the text detector runs on a batch of images
+instead of one; `batch_size` is the number of text crops per recognizer batch.
+Images are never resized for batching, a size without a partner is OCRed alone.
+"""
+import os
+import glob
+import json
+import time
+import multiprocessing as mp
+
+import numpy as np
+from PIL import Image
+
+
+def cast_pred_type(pred):
+    result = []
+    for tup in pred:
+        coord, txt, score = tup
+        coord = np.array(coord).tolist()
+        score = float(score)
+        result.append((coord, txt, score))
+    return result
+
+
+def _iter_shard_records(shard_dir):
+    for shard_file in sorted(glob.glob(os.path.join(shard_dir, 'shard_*.jsonl'))):
+        with open(shard_file, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # NOTE: last line of a shard can be truncated if the worker got killed mid write.
+                    continue
+
+
+def completed_images(shard_dir):
+    return {rec['img_name'] for rec in _iter_shard_records(shard_dir)}
+
+
+def _open_for_append(path):
+    f = open(path, 'a+')
+    if f.tell() > 0:
+        f.seek(f.tell() - 1)
+        if f.read(1) != '\n':
+            # NOTE: terminate the truncated line left by a killed worker.
+            f.write('\n')
+    return f
+
+
+def _image_size(path):
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        # NOTE: let easyocr report the broken image, alone in its group
+        return path
+
+
+def same_size_groups(image_paths, images_per_batch):
+    """
+    Yield lists of at most `images_per_batch` paths of images with the same size.
+    """
+    pending = {}
+    for path in image_paths:
+        size = _image_size(path)
+        group = pending.setdefault(size, [])
+        group.append(path)
+        if len(group) >= images_per_batch:
+            yield group
+            pending[size] = []
+    for group in pending.values():
+        if group:
+            yield group
+
+
+def _ocr_group(reader, group, batch_size):
+    if len(group) == 1 or not hasattr(reader, 'readtext_batched'):
+        return [reader.readtext(path, batch_size=batch_size) for path in group]
+    return reader.readtext_batched(group, batch_size=batch_size)
+
+
+def _ocr_worker(args):
+    shard_id, image_paths, shard_dir, lang, gpu, batch_size, images_per_batch, num_threads = args
+    import torch
+    import easyocr
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    reader = easyocr.Reader(lang, gpu=gpu)
+    shard_file = os.path.join(shard_dir, f"shard_{shard_id:03d}.jsonl")
+    start = time.time()
+
+    done = 0
+    with _open_for_append(shard_file) as f:
+        for group in same_size_groups(image_paths, images_per_batch):
+            for image_path, pred in zip(group, _ocr_group(reader, group, batch_size)):
+                rec = {
+                    'img_name': os.path.basename(image_path),
+                    'pred': cast_pred_type(pred),
+                }
+                f.write(json.dumps(rec) + '\n')
+            f.flush()
+            if (done + len(group)) // 100 > done // 100:
+                speed = (done + len(group)) / (time.time() - start)
+                print(f"[shard {shard_id}] {done + len(group)}/{len(image_paths)}, {speed:.2f} img/s")
+            done += len(group)
+    return len(image_paths)
+
+
+def run_sharded_ocr(image_paths, shard_dir, num_workers=1, lang=('en',), gpu=True, batch_size=8,
+                    images_per_batch=8):
+    """
+    OCR every image in `image_paths` that doesn't have a result in `shard_dir` yet.
+
+    batch_size: text crops per recognizer batch.
+    images_per_batch: same size images per `readtext_batched` call.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    done = completed_images(shard_dir)
+    todo = [p for p in image_paths if os.path.basename(p) not in done]
+    print(f"[ocr_engine] {len(done)} images done, {len(todo)} images to go")
+    if not todo:
+        return 0
+
+    num_workers = max(1, min(num_workers, len(todo)))
+    # NOTE: split CPU cores between workers, otherwise every torch worker spawns one thread per core.
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    args = [
+        (i, todo[i::num_workers], shard_dir, list(lang), gpu, batch_size, images_per_batch, num_threads)
+        for i in range(num_workers)
+    ]
+    if num_workers == 1:
+        return _ocr_worker(args[0])
+
+    with mp.get_context('spawn').Pool(num_workers) as pool:
+        return sum(pool.map(_ocr_worker, args))
+
+
+def merge_shards(shard_dir, out_json):
+    out_anno = {}
+    for rec in _iter_shard_records(shard_dir):
+        out_anno[rec['img_name']] = rec['pred']
+
+    tmp_json = out_json + '.tmp'
+    with open(tmp_json, 'w') as f:
+        json.dump(out_anno, f)
+    os.replace(tmp_json, out_json)
+    return out_anno
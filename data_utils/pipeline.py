@@ -0,0 +1,992 @@
+"""
+Content addressed, incremental runner of the preprocessing steps of
+run_stage_1.sh, run_entity_det.sh, run_anno_processing.sh and run_feat_extract.sh.
+
+    python3 pipeline.py plan                         # what is out of date, and how many items
+    python3 pipeline.py run --max_parallel 3         # run everything that is out of date
+    python3 pipeline.py run --targets anno,bua_feat  # only these steps and what they depend on
+
+Every step is keyed by a hash of its command, parameters and the content of
+its inputs (files are hashed once per size / mtime), saved to
+`<meme_root>/.pipeline/<step>.json` when the step succeeds. A step runs again
+only if its key changed or one of its outputs is missing. Keys depend on the
+content of upstream outputs, not on time stamps, so a step that reproduces the
+same output doesn't invalidate the steps after it. Step dependencies are
+derived from the inputs / outputs of the steps.
+
+Item steps (OCR, mask, inpainting, detection, web detection, ...) also keep a
+key per image: hash of the image, and of its entry in the json inputs. Only
+the items whose key changed are recomputed:
+
+    * `DropRecords` / `RemoveFiles`: stale results are dropped from the resumable
+      cache of the tool (result shards, per image output files), then the tool is
+      rerun and only redo what is missing;
+    * `Staged`: for tools that always process a whole directory, stale items are
+      hard linked into a staging directory, the tool runs on it, and the results
+      are moved back into the real output (dir and json);
+    * `ItemList`: the list of stale items is written to a file passed to the tool.
+
+Steps whose dependencies are done run concurrently in a thread pool, with at
+most `max_gpu_jobs` of them running a GPU container at the same time. The
+output of every step is written to `.pipeline/logs/<step>.log`.
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import fire
+
+import dup_index
+from image_index import ImageIndex, IMG_EXTS
+
+
+SELF = os.path.dirname(os.path.realpath(__file__))
+STATE_DIR = '.pipeline'
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(json.dumps(p, sort_keys=True).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _write_json_atomic(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def _stem(item):
+    return os.path.splitext(os.path.basename(item))[0]
+
+
+def _item_fields(item):
+    return {'item': item, 'name': os.path.basename(item), 'stem': _stem(item)}
+
+
+def _item_files(out_dir, pattern, item):
+    fields = {k: glob.escape(v) for k, v in _item_fields(item).items()}
+    return glob.glob(os.path.join(out_dir, pattern.format(**fields)))
+
+
+class HashCache:
+    """
+    sha1 of files and directories, a file is only re-read when its size / mtime changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # file path -> [[size, mtime_ns], sha1]
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def file(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        with self._lock:
+            self.entries[path] = [stamp, h.hexdigest()]
+        return h.hexdigest()
+
+    def path_hash(self, path):
+        if not os.path.exists(path):
+            return None
+        if os.path.isfile(path):
+            return self.file(path)
+        files = {}
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [d for d in dirs if d != STATE_DIR]
+            for name in names:
+                if not name.endswith('.tmp'):
+                    full = os.path.join(root, name)
+                    files[os.path.relpath(full, path)] = self.file(full)
+        return _digest(files)
+
+    def save(self):
+        with self._lock:
+            entries = dict(self.entries)
+        _write_json_atomic(self.path, entries)
+
+
+"""
+Item sources
+"""
+
+
+class ImageItems:
+    """
+    Images under img_dir (at most max_depth sub dir level), keyed by path relative to img_dir.
+    companions: file name pattern of files belong to an image (eg. '{stem}.mask.png'),
+        they are hashed with the image and aren't items of their own.
+    exclude_ids_of: image dir, images with the same id (name before the first '.') are left out.
+    """
+
+    def __init__(self, img_dir, max_depth=None, companions=(), exclude_ids_of=None, exts=IMG_EXTS):
+        self.img_dir = img_dir
+        self.max_depth = max_depth
+        self.companions = companions
+        self.exclude_ids_of = exclude_ids_of
+        self.exts = exts
+
+    def paths(self):
+        paths = [self.img_dir] + ([self.exclude_ids_of] if self.exclude_ids_of else [])
+        return paths
+
+    def hashes(self, run):
+        index = run.image_index(run.fmt(self.img_dir), sha1=True)
+        entries = {
+            p: e for p, e in index.entries.items()
+            if (self.max_depth is None or p.count(os.sep) <= self.max_depth) and p.lower().endswith(self.exts)
+        }
+        companion_of = {}
+        for p in entries:
+            for pattern in self.companions:
+                companion = os.path.join(os.path.dirname(p), pattern.format(**_item_fields(p)))
+                companion_of[companion] = p
+        excluded = set()
+        if self.exclude_ids_of:
+            excluded = run.image_index(run.fmt(self.exclude_ids_of)).ids(max_depth=1)
+
+        result = {}
+        for p, e in entries.items():
+            if p in companion_of or e['id'] in excluded:
+                continue
+            hashes = [e['sha1']]
+            for pattern in self.companions:
+                companion = os.path.join(os.path.dirname(p), pattern.format(**_item_fields(p)))
+                hashes.append(entries[companion]['sha1'] if companion in entries else None)
+            result[p] = hashes[0] if len(hashes) == 1 else _digest(hashes)
+        return result
+
+
+class JsonItems:
+    """
+    Entries of a json dict, or of a list of records with a `key` field.
+    """
+
+    def __init__(self, json_path, key='img_name'):
+        self.json_path = json_path
+        self.key = key
+
+    def paths(self):
+        return [self.json_path]
+
+    def hashes(self, run):
+        with open(run.fmt(self.json_path), 'r') as f:
+            anno = json.load(f)
+        if isinstance(anno, dict):
+            return {k: _digest(v) for k, v in anno.items()}
+        return {rec[self.key]: _digest(rec) for rec in anno}
+
+
+class DupItems:
+    """
+    Canonical image of every item, and its content, from a near duplicate index (dup_index.py).
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    def paths(self):
+        return [self.index_path]
+
+    def hashes(self, run):
+        with open(run.fmt(self.index_path), 'r') as f:
+            entries = json.load(f)['images']
+        return {p: _digest(e['canonical'], e['canonical_sha1']) for p, e in entries.items()}
+
+
+def _lookup(hashes, item):
+    if item in hashes:
+        return hashes[item]
+    return hashes.get(os.path.basename(item))
+
+
+"""
+Incremental update of item steps
+"""
+
+
+class DropRecords:
+    """
+    Remove the records of stale items from the jsonl result shards of a resumable tool.
+    """
+    partial = False
+
+    def __init__(self, shard_pattern, key='img_name'):
+        self.shard_pattern = shard_pattern
+        self.key = key
+
+    def before(self, run, stale, removed):
+        names = {os.path.basename(i) for i in list(stale) + list(removed)}
+        dropped = 0
+        for shard_file in sorted(glob.glob(run.fmt(self.shard_pattern))):
+            kept = []
+            with open(shard_file, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        # NOTE: truncated last line of a killed run
+                        continue
+                    if rec.get(self.key) in names:
+                        dropped += 1
+                    else:
+                        kept.append(line if line.endswith('\n') else line + '\n')
+            with open(shard_file + '.tmp', 'w') as f:
+                f.writelines(kept)
+            os.replace(shard_file + '.tmp', shard_file)
+        run.log(f"dropped {dropped} cached records")
+
+    def after(self, run, stale, removed):
+        pass
+
+
+class RemoveFiles:
+    """
+    Delete the per item output files of stale items, tools skip items whose output exists.
+    """
+    partial = False
+
+    def __init__(self, out_dir, patterns=('{name}',)):
+        self.out_dir = out_dir
+        self.patterns = patterns
+
+    def before(self, run, stale, removed):
+        out_dir = run.fmt(self.out_dir)
+        count = 0
+        for item in list(stale) + list(removed):
+            for pattern in self.patterns:
+                for path in _item_files(out_dir, pattern, item):
+                    os.remove(path)
+                    count += 1
+        run.log(f"removed {count} stale output files")
+
+    def after(self, run, stale, removed):
+        pass
+
+
+class ItemList:
+    """
+    Write the stale items (formatted by `template`, eg. a container path) to `{stage}/items.txt`.
+    """
+    partial = True
+
+    def __init__(self, template):
+        self.template = template
+
+    def before(self, run, stale, removed):
+        os.makedirs(run.stage_dir, exist_ok=True)
+        with open(os.path.join(run.stage_dir, 'items.txt'), 'w') as f:
+            for item in stale:
+                f.write(run.fmt(self.template, **_item_fields(item)) + '\n')
+
+    def after(self, run, stale, removed):
+        pass
+
+
+class Staged:
+    """
+    Run the tool on `{stage}/in` (hard links of the stale items of in_dir), then move
+    `{stage}/out` into out_dir and merge `{stage}/out.json` into out_json.
+    patterns: output files of an item in out_dir, deleted before new results are moved in.
+    dups: near duplicate index of in_dir (dup_index.py), only canonical images are staged,
+        the outputs (files and json entries) of the other members are copies of the canonical one.
+    """
+    partial = True
+
+    def __init__(self, in_dir, out_dir, out_json=None, companions=(), patterns=('{stem}.*',), dups=None):
+        self.in_dir = in_dir
+        self.out_dir = out_dir
+        self.out_json = out_json
+        self.companions = companions
+        self.patterns = patterns
+        self.dups = dups
+
+    def _canonical(self, run):
+        if self.dups is None:
+            return {}
+        return dup_index.canonical_map(run.fmt(self.dups))
+
+    def before(self, run, stale, removed):
+        if os.path.exists(run.stage_dir):
+            shutil.rmtree(run.stage_dir)
+        stage_in = os.path.join(run.stage_dir, 'in')
+        os.makedirs(os.path.join(run.stage_dir, 'out'))
+        in_dir = run.fmt(self.in_dir)
+        canonical = self._canonical(run)
+        staged = sorted({canonical.get(item, item) for item in stale})
+        if len(staged) < len(stale):
+            run.log(f"{len(stale)} items staged as {len(staged)} canonical images")
+        for item in staged:
+            names = [item] + [
+                os.path.join(os.path.dirname(item), c.format(**_item_fields(item))) for c in self.companions]
+            for name in names:
+                src, dst = os.path.join(in_dir, name), os.path.join(stage_in, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+
+    def after(self, run, stale, removed):
+        out_dir = run.fmt(self.out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        for item in list(stale) + list(removed):
+            for pattern in self.patterns:
+                for path in _item_files(out_dir, pattern, item):
+                    os.remove(path)
+
+        stage_out = os.path.join(run.stage_dir, 'out')
+        moved = 0
+        for root, _, names in os.walk(stage_out):
+            for name in names:
+                src = os.path.join(root, name)
+                dst = os.path.join(out_dir, os.path.relpath(src, stage_out))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+                moved += 1
+        run.log(f"moved {moved} files to {out_dir}")
+
+        canonical = self._canonical(run)
+        copies = {item: canonical[item] for item in stale if canonical.get(item, item) != item}
+        for item, canon in copies.items():
+            canon_stem, stem = _stem(canon), _stem(item)
+            for pattern in self.patterns:
+                for path in _item_files(out_dir, pattern, canon):
+                    name = os.path.basename(path)
+                    dst = os.path.join(os.path.dirname(path), stem + name[len(canon_stem):])
+                    try:
+                        os.link(path, dst)
+                    except OSError:
+                        shutil.copy2(path, dst)
+        if copies:
+            run.log(f"copied outputs of {len(copies)} near duplicate items")
+
+        if self.out_json is not None:
+            out_json = run.fmt(self.out_json)
+            stale_stems = {_stem(i) for i in list(stale) + list(removed)}
+            merged = {}
+            if os.path.exists(out_json):
+                with open(out_json, 'r') as f:
+                    merged = json.load(f)
+            merged = {k: v for k, v in merged.items() if _stem(k) not in stale_stems}
+            stage_json = os.path.join(run.stage_dir, 'out.json')
+            if os.path.exists(stage_json):
+                with open(stage_json, 'r') as f:
+                    merged.update(json.load(f))
+            by_stem = {_stem(k): k for k in merged}
+            for item, canon in copies.items():
+                key = by_stem.get(_stem(canon))
+                if key is not None:
+                    merged[_stem(item) + key[len(_stem(canon)):]] = merged[key]
+            _write_json_atomic(out_json, merged)
+        shutil.rmtree(run.stage_dir)
+
+
+"""
+Actions
+"""
+
+
+class Docker:
+    """
+    mounts: list of (host path, container path[:ro]), host path and args are formatted
+        with the pipeline paths ({src}, {meme}, {data}, {pretrain}, {stage}) and the step params.
+    """
+
+    def __init__(self, image, args, mounts, gpu=True, workdir=None, ipc_host=False, env=()):
+        self.image = image
+        self.args = list(args)
+        self.mounts = list(mounts)
+        self.gpu = gpu
+        self.workdir = workdir
+        self.ipc_host = ipc_host
+        self.env = list(env)
+
+    def signature(self):
+        return ['docker', self.image, self.args, self.mounts, self.workdir]
+
+    def command(self, run):
+        cmd = ['docker', 'run', '--rm']
+        if self.gpu:
+            cmd += ['--gpus', 'all']
+        if self.ipc_host:
+            cmd += ['--ipc=host']
+        for host, container in self.mounts:
+            cmd += ['-v', f"{run.fmt(host)}:{container}"]
+        for name in self.env:
+            cmd += ['-e', name]
+        if self.workdir:
+            cmd += ['-w', self.workdir]
+        cmd.append(self.image)
+        cmd += [run.fmt(a) for a in self.args]
+        return cmd
+
+    def __call__(self, run):
+        cmd = self.command(run)
+        run.log(' '.join(cmd))
+        with open(run.log_path, 'a') as log:
+            ret = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+        if ret != 0:
+            raise RuntimeError(f"[{run.step.name}] exit code {ret}, see {run.log_path}")
+
+
+class Local:
+    """
+    Python function run in the pipeline process, called with the `StepRun`.
+    """
+    gpu = False
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def signature(self):
+        return ['local', self.fn.__name__]
+
+    def __call__(self, run):
+        self.fn(run)
+
+
+class Step:
+
+    def __init__(self, name, action, inputs=(), outputs=(), items=(), update=(), params=None, after=()):
+        """
+        items: item sources, the first one defines the items, others add to their hash.
+        update: how stale items are recomputed (DropRecords, RemoveFiles, ItemList, Staged).
+        after: extra dependencies, steps writing to a shared output that isn't in their `outputs`.
+        """
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.items = list(items)
+        self.update = list(update)
+        self.params = params or {}
+        self.after = list(after)
+
+    def input_paths(self):
+        paths = list(self.inputs)
+        for src in self.items:
+            paths += src.paths()
+        return paths
+
+    def partial(self):
+        return any(u.partial for u in self.update)
+
+
+class StepRun:
+    """
+    State of one step in one pipeline run.
+    """
+
+    def __init__(self, pipeline, step):
+        self.pipeline = pipeline
+        self.step = step
+        self.state_path = os.path.join(pipeline.state_dir, f"{step.name}.json")
+        self.stage_dir = os.path.join(pipeline.state_dir, 'stage', step.name)
+        self.log_path = os.path.join(pipeline.state_dir, 'logs', f"{step.name}.log")
+        self.state = {'key': None, 'items': {}, 'pending': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+
+    def fmt(self, template, **extra):
+        return template.format(**self.pipeline.paths, stage=self.stage_dir, **self.step.params, **extra)
+
+    def log(self, msg):
+        print(f"[{self.step.name}] {msg}")
+        with open(self.log_path, 'a') as f:
+            f.write(f"[pipeline] {msg}\n")
+
+    def image_index(self, img_dir, sha1=False):
+        return self.pipeline.image_index(img_dir, sha1)
+
+    def save_state(self):
+        _write_json_atomic(self.state_path, self.state)
+
+    def compute_keys(self):
+        hash_cache = self.pipeline.hash_cache
+        item_paths = {p for src in self.step.items for p in src.paths()}
+        input_hashes = {
+            p: hash_cache.path_hash(self.fmt(p))
+            for p in self.step.inputs if p not in item_paths
+        }
+        key = _digest(self.step.name, self.step.action.signature(), self.step.params, input_hashes)
+
+        item_keys = {}
+        if self.step.items:
+            source_hashes = [src.hashes(self) for src in self.step.items]
+            item_keys = {
+                item: _digest(key, h, [_lookup(s, item) for s in source_hashes[1:]])
+                for item, h in source_hashes[0].items()
+            }
+        return key, item_keys
+
+    def missing_outputs(self):
+        return [p for p in self.step.outputs if not os.path.exists(self.fmt(p))]
+
+    def plan(self):
+        """
+        Return (key, item keys, stale items, removed items), stale is None if up to date.
+        """
+        key, item_keys = self.compute_keys()
+        missing = self.missing_outputs()
+        if not self.step.items:
+            stale = [] if key != self.state['key'] or missing else None
+            return key, item_keys, stale, []
+
+        # NOTE: resumable tools rebuild a missing output from their own cache,
+        # staged results only exist in the output.
+        done = {} if missing and self.step.partial() else self.state['items']
+        stale = [i for i, k in item_keys.items() if done.get(i) != k]
+        removed = [i for i in self.state['items'] if i not in item_keys]
+        if not stale and not removed and key == self.state['key'] and not missing:
+            return key, item_keys, None, []
+        return key, item_keys, stale, removed
+
+    def execute(self, gpu_slots):
+        key, item_keys, stale, removed = self.plan()
+        if stale is None:
+            self.log("up to date")
+            return False
+        if self.step.items:
+            self.log(f"{len(stale)}/{len(item_keys)} items to compute, {len(removed)} removed")
+
+        # NOTE: items invalidated by a failed run are in `pending`, not invalidated again
+        # so the resumable tools keep what they did finish.
+        pending = self.state.get('pending', {})
+        to_invalidate = [i for i in stale if pending.get(i) != item_keys[i]]
+        for update in self.step.update:
+            if update.partial:
+                update.before(self, stale, removed)
+            elif to_invalidate or removed:
+                update.before(self, to_invalidate, removed)
+        if not self.step.partial():
+            pending.update({i: item_keys[i] for i in stale})
+            self.state['pending'] = pending
+            self.save_state()
+
+        if stale or not self.step.partial():
+            start = time.time()
+            if self.step.action.gpu:
+                with gpu_slots:
+                    self.step.action(self)
+            else:
+                self.step.action(self)
+            self.log(f"done in {time.time() - start:.1f}s")
+        for update in self.step.update:
+            update.after(self, stale, removed)
+
+        self.state = {'key': key, 'items': item_keys, 'pending': {}, 'time': time.time()}
+        self.save_state()
+        return True
+
+
+class Pipeline:
+
+    def __init__(self, steps, meme_root=None, data_root=None, pretrain_dir=None, index_workers=8):
+        data_root = os.path.abspath(data_root or os.path.join(SELF, '..', 'data'))
+        meme_root = os.path.abspath(meme_root or os.path.join(data_root, 'hateful_memes'))
+        self.paths = {
+            'src': SELF,
+            'meme': meme_root,
+            'data': data_root,
+            'pretrain': os.path.abspath(pretrain_dir or os.path.join(SELF, '..', 'pretrain_model')),
+        }
+        self.steps = {s.name: s for s in steps}
+        self.state_dir = os.path.join(meme_root, STATE_DIR)
+        os.makedirs(os.path.join(self.state_dir, 'logs'), exist_ok=True)
+        self.hash_cache = HashCache(os.path.join(self.state_dir, 'file_hashes.json'))
+        self.index_workers = index_workers
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        self.deps = self._derive_deps()
+
+    def _derive_deps(self):
+        producer = {}
+        for step in self.steps.values():
+            for path in step.outputs:
+                assert path not in producer, f"{path} is output of {producer[path]} and {step.name}"
+                producer[path] = step.name
+        return {
+            step.name: sorted(
+                ({producer[p] for p in step.input_paths() if p in producer} | set(step.after)) - {step.name})
+            for step in self.steps.values()
+        }
+
+    def image_index(self, img_dir, sha1=False):
+        """
+        sha1: content hash of every image is needed, images are only hashed for such callers.
+        """
+        # NOTE: refreshed once per run, a dir is only read after the step writing it is done.
+        with self._index_lock:
+            index = self._indexes.get(img_dir)
+            if index is None or (sha1 and not index.hashed):
+                index = (index or ImageIndex(img_dir)).refresh(num_workers=self.index_workers, sha1=sha1)
+                self._indexes[img_dir] = index
+            return index
+
+    def _forget_index(self, step):
+        with self._index_lock:
+            for path in step.outputs:
+                self._indexes.pop(StepRun(self, step).fmt(path), None)
+
+    def select(self, targets=None):
+        if targets is None:
+            return list(self.steps)
+        if isinstance(targets, str):
+            targets = targets.split(',')
+        todo, selected = list(targets), set()
+        while todo:
+            name = todo.pop()
+            if name not in self.steps:
+                raise KeyError(f"Unknown step {name}, choose from {list(self.steps)}")
+            if name not in selected:
+                selected.add(name)
+                todo += self.deps[name]
+        return [n for n in self.steps if n in selected]
+
+    def plan(self, targets=None):
+        will_run = set()
+        for name in self.select(targets):
+            if set(self.deps[name]) & will_run:
+                print(f"{name:<20} after {', '.join(sorted(set(self.deps[name]) & will_run))}")
+                will_run.add(name)
+                continue
+            missing = [p for p in self.steps[name].input_paths() if not os.path.exists(StepRun(self, self.steps[name]).fmt(p))]
+            if missing:
+                print(f"{name:<20} missing input {missing[0]}")
+                will_run.add(name)
+                continue
+            run = StepRun(self, self.steps[name])
+            _, item_keys, stale, removed = run.plan()
+            if stale is None:
+                print(f"{name:<20} up to date")
+            else:
+                will_run.add(name)
+                detail = f"{len(stale)}/{len(item_keys)} items, {len(removed)} removed" if item_keys or removed else ''
+                print(f"{name:<20} run {detail}")
+        self.hash_cache.save()
+        return will_run
+
+    def run(self, targets=None, max_parallel=3, max_gpu_jobs=1):
+        names = self.select(targets)
+        gpu_slots = threading.Semaphore(max_gpu_jobs)
+        status = {}
+
+        def execute(name):
+            ran = StepRun(self, self.steps[name]).execute(gpu_slots)
+            if ran:
+                self._forget_index(self.steps[name])
+            return ran
+
+        with ThreadPoolExecutor(max_parallel) as pool:
+            running = {}
+            while len(status) < len(names):
+                progressed = False
+                for name in names:
+                    if name in status or name in running.values():
+                        continue
+                    deps = self.deps[name]
+                    if any(status.get(d) in ('failed', 'blocked') for d in deps):
+                        status[name] = 'blocked'
+                        progressed = True
+                        print(f"[{name}] blocked by failed dependency")
+                    elif all(status.get(d) in ('done', 'skipped') for d in deps):
+                        running[pool.submit(execute, name)] = name
+                if not running:
+                    assert progressed or len(status) == len(names), f"dependency cycle in {names}"
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = 'done' if future.result() else 'skipped'
+                    except Exception as e:
+                        status[name] = 'failed'
+                        print(f"[{name}] failed: {e!r}")
+                self.hash_cache.save()
+
+        self.hash_cache.save()
+        for name in names:
+            print(f"{name:<20} {status[name]}")
+        return status
+
+
+"""
+Steps of the run_*.sh scripts
+"""
+
+
+VL_BERT = 'dsfhe49854/vl-bert'
+SRC_MEME = [('{src}', '/src'), ('{meme}', '/data')]
+SRC_MEME_DATA = [('{src}', '/src'), ('{meme}', '/meme_data'), ('{data}', '/data')]
+ANNO_SPLITS = ['train', 'test_unseen', 'test_seen', 'dev_unseen', 'dev_seen', 'dev_all']
+
+
+def _dedup(run):
+    img_dir = run.fmt('{meme}/img_clean')
+    index = dup_index.DupIndex(
+        img_dir, index_path=run.fmt('{meme}/img_clean.dups.json'),
+        threshold=run.step.params['threshold'], same_size=run.step.params['same_size'])
+    index.refresh(num_workers=run.pipeline.index_workers, image_index=run.image_index(img_dir, sha1=True))
+
+
+def _train_dev_all(run):
+    with open(run.fmt('{meme}/train_dev_all.entity.jsonl.tmp'), 'w') as out:
+        for split in ['train', 'dev_all']:
+            with open(run.fmt(f"{{meme}}/{split}.entity.jsonl"), 'r') as f:
+                shutil.copyfileobj(f, out)
+    os.replace(run.fmt('{meme}/train_dev_all.entity.jsonl.tmp'), run.fmt('{meme}/train_dev_all.entity.jsonl'))
+
+
+def stage_1_steps():
+    return [
+        Step(
+            'ocr', Docker(VL_BERT, ['python3', '/src/ocr.py', 'detect', '/data'], SRC_MEME),
+            outputs=['{meme}/ocr.json'],
+            items=[ImageItems('{meme}/img', max_depth=1, exts=('.png',))],
+            update=[DropRecords('{meme}/ocr_shards/shard_*.jsonl')],
+        ),
+        Step(
+            'ocr_box', Docker(VL_BERT, ['python3', '/src/ocr.py', 'point_to_box', '/data/ocr.json'], SRC_MEME, gpu=False),
+            inputs=['{meme}/ocr.json'],
+            outputs=['{meme}/ocr.box.json'],
+        ),
+        Step(
+            'ocr_mask',
+            Docker(VL_BERT, [
+                'python3', '/src/ocr.py', 'generate_mask',
+                '/data/ocr.box.json', '/data/img', '/data/img_mask_3px', '--pad_crop', '{pad_crop}',
+            ], SRC_MEME, gpu=False),
+            outputs=['{meme}/img_mask_3px'],
+            items=[JsonItems('{meme}/ocr.box.json'), ImageItems('{meme}/img', max_depth=1)],
+            update=[RemoveFiles('{meme}/img_mask_3px', ['{name}', '{stem}.mask.png'])],
+            params={'pad_crop': 5},
+        ),
+        Step(
+            'inpaint',
+            Docker('dsfhe49854/mmedit', [
+                'python3', '/mmediting/demo/inpainting_demo.py',
+                '/mmediting/configs/inpainting/deepfillv2/deepfillv2_256x256_8x2_places.py',
+                '/pretrain_model/deepfillv2_256x256_8x2_places_20200619-10d15793.pth',
+                '/stage/in/', '/stage/out',
+            ], [('{pretrain}', '/pretrain_model'), ('{meme}', '/data'), ('{stage}', '/stage')]),
+            outputs=['{meme}/img_clean'],
+            items=[ImageItems('{meme}/img_mask_3px', companions=['{stem}.mask.png'])],
+            update=[Staged('{meme}/img_mask_3px', '{meme}/img_clean', companions=['{stem}.mask.png'],
+                           patterns=['{name}'])],
+        ),
+        Step(
+            'dedup', Local(_dedup),
+            inputs=['{meme}/img_clean'],
+            outputs=['{meme}/img_clean.dups.json'],
+            params={'threshold': 6, 'same_size': True},
+        ),
+        Step(
+            'oid_box',
+            Docker(VL_BERT, [
+                'python3', '/src/gen_bbox.py', '/data/img_clean', '/data/box_annos.json',
+                '--dup_map', '/data/img_clean.dups.json',
+            ], SRC_MEME),
+            outputs=['{meme}/box_annos.json'],
+            items=[ImageItems('{meme}/img_clean', max_depth=0, exts=('.png',)), DupItems('{meme}/img_clean.dups.json')],
+            update=[DropRecords('{meme}/box_annos.json.shards/box_*.jsonl')],
+        ),
+        Step(
+            'patch_detect',
+            Docker('dsfhe49854/mmdetect-mmedit', [
+                'python3', 'tools/inspect_image_clip.py', '/stage/in', '/stage/out', '/stage/out.json',
+                '--config_file', 'configs/res2net/faster_rcnn_r2_101_fpn_2x_img_clip.py',
+                '--checkpoint_file', '/pretrain_model/faster_rcnn_r2_101_fpn_2x_img_clip/epoch_3.pth',
+            ], [('{pretrain}', '/pretrain_model'), ('{meme}', '/data'), ('{stage}', '/stage')]),
+            outputs=['{meme}/split_img_clean', '{meme}/split_img_clean_boxes.json'],
+            items=[ImageItems('{meme}/img_clean', max_depth=0), DupItems('{meme}/img_clean.dups.json')],
+            update=[Staged('{meme}/img_clean', '{meme}/split_img_clean', '{meme}/split_img_clean_boxes.json',
+                           dups='{meme}/img_clean.dups.json')],
+        ),
+        Step(
+            'face_race',
+            Docker('dsfhe49854/fairface-dlib', [
+                'python3', 'inference.py', 'detect_race_mp',
+                '/data/box_annos.json', '/data/img_clean', '/data/face_race_boxes.json',
+                '--debug', 'False', '--worker', '{worker}',
+            ], [('{meme}', '/data')]),
+            inputs=['{meme}/box_annos.json', '{meme}/img_clean'],
+            outputs=['{meme}/face_race_boxes.json'],
+            params={'worker': 4},
+        ),
+        Step(
+            'race_box',
+            Docker('dsfhe49854/fairface-dlib', [
+                'python3', 'inference.py', 'map_race_to_person_box',
+                '/data/img_clean', '/data/box_annos.json', '/data/face_race_boxes.json',
+            ], [('{meme}', '/data')]),
+            inputs=['{meme}/img_clean', '{meme}/box_annos.json', '{meme}/face_race_boxes.json'],
+            outputs=['{meme}/box_annos.race.json'],
+        ),
+    ]
+
+
+def entity_steps():
+    detect = [
+        'python3', '/src/gcp/web_enetity.py', 'detect_dataset', '/stage/items.txt', '/data/entity_json',
+        '--auto_break', 'None', '--concurrency', '{concurrency}', '--qps', '{qps}',
+    ]
+    mounts = SRC_MEME_DATA + [('{stage}', '/stage')]
+    return [
+        Step(
+            'web_detect', Docker(VL_BERT, detect, mounts, gpu=False, env=['GOOGLE_API_KEY']),
+            items=[ImageItems('{meme}/img_clean', max_depth=1, exts=('.png',), exclude_ids_of='{meme}/split_img_clean')],
+            update=[RemoveFiles('{data}/entity_json', ['{stem}.json']), ItemList('/meme_data/img_clean/{item}')],
+            params={'concurrency': 16, 'qps': 10},
+        ),
+        Step(
+            'web_detect_split', Docker(VL_BERT, detect, mounts, gpu=False, env=['GOOGLE_API_KEY']),
+            items=[ImageItems('{meme}/split_img_clean', max_depth=1, exts=('.png',))],
+            update=[RemoveFiles('{data}/entity_json', ['{stem}.json']), ItemList('/meme_data/split_img_clean/{item}')],
+            params={'concurrency': 16, 'qps': 10},
+        ),
+        Step(
+            'description',
+            Docker(VL_BERT, [
+                'python3', '/src/gcp/web_enetity.py', 'create_description',
+                '--json_dir', '/data/entity_json', '--out_pickle', '/data/entity_tags.pickle',
+            ], SRC_MEME_DATA, gpu=False),
+            inputs=['{data}/entity_json'],
+            outputs=['{data}/entity_tags.pickle'],
+            # NOTE: both web detection steps write to entity_json
+            after=['web_detect', 'web_detect_split'],
+        ),
+        Step(
+            'titles_cleanup',
+            Docker(VL_BERT, [
+                'python3', '/src/gcp/web_enetity.py', 'titles_cleanup',
+                '/data/entity_tags.pickle', '--out_pickle', '/data/entity_cleaned.pickle',
+            ], SRC_MEME_DATA),
+            inputs=['{data}/entity_tags.pickle'],
+            outputs=['{data}/entity_cleaned.pickle'],
+        ),
+        Step(
+            'titles_summary',
+            Docker(VL_BERT, [
+                'python3', '/src/gcp/web_enetity.py', 'titles_summary',
+                '/data/entity_cleaned.pickle', '/data/summary_entity_cleaned.pickle',
+            ], SRC_MEME_DATA),
+            inputs=['{data}/entity_cleaned.pickle'],
+            outputs=['{data}/summary_entity_cleaned.pickle'],
+        ),
+        Step(
+            'merge_dev', Docker(VL_BERT, ['python3', '/src/merge_dev_set.py', '/data'], SRC_MEME, gpu=False),
+            inputs=['{meme}/dev_seen.jsonl', '{meme}/dev_unseen.jsonl'],
+            outputs=['{meme}/dev_all.jsonl'],
+        ),
+        Step(
+            'anno',
+            Docker(VL_BERT, [
+                'python3', '/src/gcp/web_enetity.py', 'insert_anno_jsonl',
+                '/data/summary_entity_cleaned.pickle',
+                ','.join(f"/meme_data/{s}.jsonl" for s in ANNO_SPLITS),
+                '/meme_data/split_img_clean_boxes.json', '/meme_data/ocr.box.json',
+            ], SRC_MEME_DATA, gpu=False),
+            inputs=[
+                '{data}/summary_entity_cleaned.pickle', '{meme}/split_img_clean_boxes.json', '{meme}/ocr.box.json',
+                '{meme}/img',
+            ] + [f"{{meme}}/{s}.jsonl" for s in ANNO_SPLITS],
+            outputs=[f"{{meme}}/{s}.entity.jsonl" for s in ANNO_SPLITS],
+        ),
+        Step(
+            'train_dev_all', Local(_train_dev_all),
+            inputs=['{meme}/train.entity.jsonl', '{meme}/dev_all.entity.jsonl'],
+            outputs=['{meme}/train_dev_all.entity.jsonl'],
+        ),
+    ]
+
+
+def feature_steps():
+    bua_mounts = [('{meme}', '/data')]
+    steps = [
+        Step(
+            'uniter_npz',
+            Docker('chenrocks/butd-caffe:nlvr2', ['bash', '-c', 'python tools/generate_npz.py --gpu 0'],
+                   [('{stage}/in', '/img:ro'), ('{stage}/out', '/output')], workdir='/src', ipc_host=True),
+            outputs=['{data}/uniter/MEME_NPZ'],
+            items=[ImageItems('{meme}/img_clean', max_depth=0), DupItems('{meme}/img_clean.dups.json')],
+            update=[Staged('{meme}/img_clean', '{data}/uniter/MEME_NPZ', dups='{meme}/img_clean.dups.json')],
+        ),
+        Step(
+            'bua_feat',
+            Docker('dsfhe49854/py-bottom-up-attention', [
+                'python3', 'hateful_meme_feature.py', 'extract_oid_boxes_feat',
+                '/data/box_annos.json', '/data', '/data/hateful_memes_v2.pt',
+            ], bua_mounts),
+            inputs=['{meme}/box_annos.json', '{meme}/img_clean'],
+            outputs=['{meme}/hateful_memes_v2.pt'],
+        ),
+    ]
+    for i, seed in enumerate([5659, 6582, 7505]):
+        steps.append(Step(
+            f"bua_feat_aug{i}",
+            Docker('dsfhe49854/py-bottom-up-attention', [
+                'python3', 'hateful_meme_feature.py', 'extract_oid_boxes_feat_with_img_aug',
+                '/data/box_annos.json', '/data', f"/data/hateful_memes_v2.aug.{i}.pt", '--random_seed', '{seed}',
+            ], bua_mounts),
+            inputs=['{meme}/box_annos.json', '{meme}/img_clean'],
+            outputs=[f"{{meme}}/hateful_memes_v2.aug.{i}.pt"],
+            params={'seed': seed},
+        ))
+    return steps
+
+
+def default_pipeline(meme_root=None, data_root=None, pretrain_dir=None):
+    return Pipeline(
+        stage_1_steps() + entity_steps() + feature_steps(),
+        meme_root=meme_root, data_root=data_root, pretrain_dir=pretrain_dir)
+
+
+def plan(targets=None, meme_root=None, data_root=None):
+    default_pipeline(meme_root, data_root).plan(targets)
+
+
+def run(targets=None, meme_root=None, data_root=None, pretrain_dir=None, max_parallel=3, max_gpu_jobs=1):
+    """
+    targets: comma separated step names, default to every step.
+    max_gpu_jobs: GPU containers allowed to run at the same time.
+    """
+    pipeline = default_pipeline(meme_root, data_root, pretrain_dir)
+    status = pipeline.run(targets, max_parallel=max_parallel, max_gpu_jobs=max_gpu_jobs)
+    if 'failed' in status.values():
+        raise SystemExit(1)
+
+
+def steps(meme_root=None, data_root=None):
+    pipeline = default_pipeline(meme_root, data_root)
+    for name in pipeline.steps:
+        print(f"{name:<20} <- {', '.join(pipeline.deps[name])}")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'plan': plan,
+        'run': run,
+        'steps': steps,
+    })
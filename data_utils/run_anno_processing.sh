@@ -49,21 +49,27 @@ docker run \
 
 SPLIT_LIST=("train.jsonl" "test_unseen.jsonl" "test_seen.jsonl" "dev_unseen.jsonl" "dev_seen.jsonl" "dev_all.jsonl")
 
+TODO_SPLITS=()
 for SPLIT in "${SPLIT_LIST[@]}"; do
-    if [ ! -e "$MEME_ROOT_DIR/$SPLIT" ]; then
-        echo "Insert features to: $MEME_ROOT_DIR/$SPLIT"
-        docker run \
-            -v $SELF:/src \
-            -v $MEME_ROOT_DIR:/meme_data \
-            -v $DATA:/data \
-            dsfhe49854/vl-bert \
-            python3 /src/gcp/web_enetity.py insert_anno_jsonl  \
-                /data/summary_entity_cleaned.pickle  \
-                /meme_data/$SPLIT \
-                /meme_data/split_img_clean_boxes.json  \
-                /meme_data/ocr.box.json
+    if [ ! -e "$MEME_ROOT_DIR/${SPLIT/.jsonl/.entity.jsonl}" ]; then
+        TODO_SPLITS+=("/meme_data/$SPLIT")
     fi
 done
 
+if [ ${#TODO_SPLITS[@]} -gt 0 ]; then
+    ANNO_JSONS=$(IFS=,; echo "${TODO_SPLITS[*]}")
+    echo "Insert features to: $ANNO_JSONS"
+    docker run \
+        -v $SELF:/src \
+        -v $MEME_ROOT_DIR:/meme_data \
+        -v $DATA:/data \
+        dsfhe49854/vl-bert \
+        python3 /src/gcp/web_enetity.py insert_anno_jsonl  \
+            /data/summary_entity_cleaned.pickle  \
+            $ANNO_JSONS \
+            /meme_data/split_img_clean_boxes.json  \
+            /meme_data/ocr.box.json
+fi
+
 cp "$MEME_ROOT_DIR/train.entity.jsonl" "$MEME_ROOT_DIR/train_dev_all.entity.jsonl"
 cat "$MEME_ROOT_DIR/dev_all.entity.jsonl" >> "$MEME_ROOT_DIR/train_dev_all.entity.jsonl"
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Lazily loaded, process-wide shared spaCy pipelines.
+
+    nlp = get_nlp("en_core_web_lg", disable=['ner'])
+
+The model is only loaded the first time it is requested (with the requested
+components disabled) and then reused by every caller asking for the same
+pipeline. Call `preload` before creating a fork based `multiprocessing.Pool`,
+so the workers share the parent's copy of the model (copy-on-write) instead of
+each loading their own.
+
+NOTE: always import it as `spacy_registry`, with data_utils on `sys.path` (as
+ensemble.py and gcp/web_enetity.py do, data_utils is mounted as /src in the
+docker steps), a second import name would be a second registry with its own cache.
+"""
+import gc
+import os
+import time
+import resource
+import threading
+
+import spacy
+
+
+_PIPELINES = {}
+_LOAD_STATS = []
+_LOCK = threading.Lock()
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        # NOTE: peak rss instead of current rss, in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _key(name, disable, variant):
+    return (name, tuple(sorted(disable or [])), variant)
+
+
+def get_nlp(name="en_core_web_lg", disable=None, variant=None):
+    """
+    name: spaCy model name or path.
+    disable: pipeline components not to load, eg. ['parser', 'ner'].
+    variant: callers that modify the pipeline (eg. add_pipe) should pass a
+        variant name, so they get their own copy instead of the shared one.
+    """
+    key = _key(name, disable, variant)
+    nlp = _PIPELINES.get(key)
+    if nlp is not None:
+        return nlp
+
+    with _LOCK:
+        if key not in _PIPELINES:
+            rss_before = _rss_mb()
+            start = time.time()
+            _PIPELINES[key] = spacy.load(name, disable=list(disable or []))
+            stat = {
+                'name': name,
+                'disable': list(key[1]),
+                'variant': variant,
+                'pid': os.getpid(),
+                'load_sec': time.time() - start,
+                'rss_mb': _rss_mb() - rss_before,
+            }
+            _LOAD_STATS.append(stat)
+            print(
+                f"[spacy_registry] load {name} (disable={stat['disable']}) in {stat['load_sec']:.1f}s, "
+                f"+{stat['rss_mb']:.0f}MB rss, pipes: {_PIPELINES[key].pipe_names}")
+    return _PIPELINES[key]
+
+
+def preload(name="en_core_web_lg", disable=None, variant=None):
+    """
+    Load the pipeline in the parent process before forking workers.
+
+    Objects that already exist are moved out of the gc's tracking (gc.freeze),
+    so the garbage collector of the children doesn't touch, and copy, the
+    memory pages holding the model.
+    """
+    nlp = get_nlp(name, disable=disable, variant=variant)
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    return nlp
+
+
+def load_stats():
+    return list(_LOAD_STATS)
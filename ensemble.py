@@ -1,31 +1,24 @@
 import os
-import glob
-import shutil
-
-import fire
-import spacy
-import pandas as pd
-from sklearn.cluster import KMeans
-nlp = spacy.load("en_core_web_lg")
-
-
-import os
+import sys
 import glob
 import json
 import shutil
 import pickle
 
 import cv2
+import fire
 import numpy as np
-
-
+import pandas as pd
 from loguru import logger
 from termcolor import colored
-import spacy
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
 
-nlp = spacy.load("en_core_web_lg")
+import ensemble_engine
+from keyword_matcher import KeywordMatcher
+from skin_tone import estimate_face_tones
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_utils'))
+from spacy_registry import get_nlp
 
 
 def centroid_histogram(clt):
@@ -60,7 +53,7 @@ def plot_colors(hist, centroids):
 	return bar
 
 
-def rasicm_det(meme_anno_path, box_anno_json, img_dir, check_skin_tone=True):
+def rasicm_det(meme_anno_path, box_anno_json, img_dir, check_skin_tone=True, skin_tone_cache=None, num_workers=8):
     
     meme_anno = {}
     with open(meme_anno_path, 'r') as f:
@@ -76,125 +69,96 @@ def rasicm_det(meme_anno_path, box_anno_json, img_dir, check_skin_tone=True):
         for a in box_anno
     }
     keyword = ['crime', 'hang', 'rob', 'steal', 'jail', 'prison', 'slave', 'apes', 'criminal', 'gorilla']
-    keyword_tok = list(nlp(' '.join(keyword)))
+    # NOTE: only word vectors are used, none of the pipeline components.
+    nlp = get_nlp("en_core_web_lg", disable=['tagger', 'parser', 'ner'])
+    keyword_matcher = KeywordMatcher(nlp, keyword, threshold=0.6)
 
-    cnt = 0
-    rasicm_sample_idx = []
-    
-    for i, (id, anno) in enumerate(meme_anno.items()):
+    candidates = []
+    for id, anno in meme_anno.items():
         boxes = box_anno_map[id]
         box_cls = [b['class_name'].lower() for b in boxes['boxes_and_score']]
         race_boxes = [b for b in boxes['boxes_and_score'] if b['race']]
-        face_boxes = [b for b in boxes['boxes_and_score'] if b['class_name'].lower() == "human face"]
         blacks = [b for b in race_boxes if b['race'].lower() == 'black']
-        
-        match = any([
-            any([token.similarity(kwt) > 0.6 for kwt in keyword_tok])
-            for token in nlp(anno['text'])
-        ])
         not_mat = not ('monkey' in box_cls)
 
-        if len(blacks) == len(race_boxes) and len(blacks) > 0 and (match and not_mat):
-            print(colored(f"[{cnt}]", color='green'))
-            cnt += 1
-            not_skin_color = False
-
-            if check_skin_tone:
-                img_path = os.path.join(img_dir, os.path.basename(anno['img']))
-                im = cv2.imread(img_path)
-                im_hsv = cv2.cvtColor(im, cv2.COLOR_BGR2HSV_FULL)
-                im_rgb = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-                imh, imw, _ = im.shape
-
-                print(anno['img'], f" {len(blacks)} black face")
-                for bbox in face_boxes:
-                    center = [
-                        (bbox['ymin'] + bbox['ymax']) / 2,
-                        (bbox['xmin'] + bbox['xmax']) / 2,
-                    ]
-                    ymin = (bbox['ymin'] * 0.5 + center[0] * 0.5) * imh 
-                    ymax = (bbox['ymax'] * 0.5 + center[0] * 0.5) * imh
-                    xmin = (bbox['xmin'] * 0.5 + center[1] * 0.5) * imw
-                    xmax = (bbox['xmax'] * 0.5 + center[1] * 0.5) * imw
-                    yslice = slice(int(ymin), int(ymax))
-                    xslice = slice(int(xmin), int(xmax))
-
-                    face_crop = im_hsv[yslice, xslice, ...]
-                    print('crop h, v channel mean: ', face_crop[..., 0].mean(), face_crop[..., 1].mean())
-                    
-                    clt = KMeans(n_clusters = 5)
-                    clt.fit(im_hsv[yslice, xslice, ...].reshape([-1, 3]))
-                    hist = centroid_histogram(clt)
-                    top1 = hist.argmax()
-                    
-                    if 160 > clt.cluster_centers_[top1, 0] > 30:
-                        not_skin_color = True
-                        break
-
-            if not not_skin_color:
-                rasicm_sample_idx.append(id)
+        if len(blacks) == len(race_boxes) and len(blacks) > 0 and not_mat:
+            candidates.append(id)
+    
+    text_match = keyword_matcher.match([meme_anno[id]['text'] for id in candidates])
+
+    matched = [id for id, match in zip(candidates, text_match) if match]
+    img_name = lambda id: os.path.basename(meme_anno[id]['img'])
+    face_boxes = {
+        img_name(id): [
+            b for b in box_anno_map[id]['boxes_and_score']
+            if b['class_name'].lower() == "human face"
+        ]
+        for id in matched
+    }
+    if check_skin_tone:
+        face_tones = estimate_face_tones(
+            face_boxes, img_dir, cache_path=skin_tone_cache, num_workers=num_workers)
+
+    rasicm_sample_idx = []
+    
+    for cnt, id in enumerate(matched):
+        print(colored(f"[{cnt}]", color='green'))
+        not_skin_color = False
+
+        if check_skin_tone:
+            print(meme_anno[id]['img'], f" {len(face_boxes[img_name(id)])} face")
+            for tone in face_tones[img_name(id)]:
+                if tone is None:
+                    continue
+                print('crop dominant h, s, v: ', tone[:3])
+                if 160 > tone[0] > 30:
+                    not_skin_color = True
+                    break
+
+        if not not_skin_color:
+            rasicm_sample_idx.append(id)
     print(f"Find {len(rasicm_sample_idx)} rasicm meme:", rasicm_sample_idx)
     return rasicm_sample_idx
 
 
 
-def merge(dfs):
-    return sum([df.proba.values for df in dfs]) / len(dfs)
-
-
-def get_mean_predict(root_dir, out_path):
-    ernie_csv = os.path.join(root_dir, 'checkpoints', 'ernie-vil', '**', 'test_set.csv')
-    vl_bert_csv = os.path.join(root_dir, 'checkpoints', 'vl-bert', '**', '*_test.csv')
-    uniter_csv = os.path.join(root_dir, 'checkpoints', 'uniter', '**', 'test.csv')
-    
-    csv_list = glob.glob(ernie_csv)
-    csv_list += glob.glob(vl_bert_csv)
-    csv_list += glob.glob(uniter_csv)
-    print(f"Found {len(csv_list)} csv eval result!")
+def get_mean_predict(root_dir, out_path, manifest=None, method=None, num_workers=8):
+    """
+    manifest: json file describing which prediction csv to ensemble (see ensemble_engine.py),
+        fallback to all csv found under ROOT/checkpoints/{ernie-vil,vl-bert,uniter}.
+    method: mean / weighted / rank / logit, override the method in manifest.
+    """
+    members, ids, proba = ensemble_engine.ensemble(
+        root_dir, manifest=manifest, method=method, num_workers=num_workers)
+    print(f"Ensemble {len(members)} csv eval result!")
 
     gather_dir = os.path.join(root_dir, 'test_set_csvs')
     if os.path.exists(gather_dir):
         shutil.rmtree(gather_dir)
     os.makedirs(gather_dir, exist_ok=True)
 
-    ensem_list = []
-    All = False
-    for csv_file in csv_list:
-        # print(csv_file)
-        if not All:
-            yn = input(f"Include {csv_file} to ensemble? (y/n/all)")
-        else:
-            yn = 'y'
-        yn = yn.strip().lower()
-        if yn == 'all':
-            All = True
-        
-        if yn == 'y' or All:
-            ensem_list.append(csv_file)
-            dir_name = os.path.basename(os.path.dirname(csv_file))
-            shutil.copy(
-                csv_file,
-                os.path.join(
-                    gather_dir,
-                    f"{dir_name}_{os.path.basename(csv_file)}"
-                )
+    for csv_file, weight in members:
+        print(f"[{weight:.2f}] {csv_file}")
+        dir_name = os.path.basename(os.path.dirname(csv_file))
+        shutil.copy(
+            csv_file,
+            os.path.join(
+                gather_dir,
+                f"{dir_name}_{os.path.basename(csv_file)}"
             )
-    assert len(ensem_list) >= 2, f'You must select at least two file to ensemble, only {len(ensem_list)} is picked'
-    
-    base = pd.read_csv(ensem_list[0])
-    print(len(ensem_list))
-    ensem_list = [pd.read_csv(c) for c in ensem_list]
-    base.proba = merge(ensem_list)
+        )
 
     rasicm_idx = rasicm_det(
         os.path.join(root_dir, 'data/hateful_memes/test_unseen.jsonl'),
         os.path.join(root_dir, 'data/hateful_memes/box_annos.race.json'),
         os.path.join(root_dir, 'data/hateful_memes/img_clean'),
+        skin_tone_cache=os.path.join(root_dir, 'data/hateful_memes/face_tone_cache.pickle'),
+        num_workers=num_workers,
     )
-    for i in rasicm_idx:
-        base.at[int(base.index[base['id']==i].values), 'proba'] = 1.0
+    table = ensemble_engine.PredictionTable(ids, proba)
+    table.override('rasicm_det', rasicm_idx, 1.0)
 
-    base.to_csv(out_path, index=False)
+    table.write(out_path, audit_path=os.path.splitext(out_path)[0] + '.audit.csv')
 
 if __name__ == "__main__":
-    fire.Fire(get_mean_predict)
\ No newline at end of file
+    fire.Fire(get_mean_predict)
@@ -0,0 +1,239 @@
+"""
+Non-interactive ensemble engine.
+
+Members of an ensemble are described by a manifest (json) instead of being
+picked one by one at the prompt:
+
+{
+    "method": "mean",
+    "exclude": ["*/debug/*"],
+    "members": [
+        {"glob": "checkpoints/ernie-vil/**/test_set.csv", "weight": 1.0},
+        {"glob": "checkpoints/vl-bert/**/*_test.csv", "exclude": ["*base*"], "weight": 2.0},
+        {"glob": "checkpoints/uniter/**/test.csv", "include": ["*large*"]}
+    ]
+}
+
+`glob` is resolved relative to the ensemble root dir, `include`/`exclude` are
+fnmatch patterns tested against the matched path and `weight` (default 1.0)
+is applied to every file the rule matches. Top level `include`/`exclude` apply
+to all rules, and a file matched by more than one rule is only taken once
+(first rule wins).
+"""
+import os
+import glob
+import json
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_MANIFEST = {
+    'method': 'mean',
+    'members': [
+        {'glob': os.path.join('checkpoints', 'ernie-vil', '**', 'test_set.csv')},
+        {'glob': os.path.join('checkpoints', 'vl-bert', '**', '*_test.csv')},
+        {'glob': os.path.join('checkpoints', 'uniter', '**', 'test.csv')},
+    ],
+}
+
+METHODS = ['mean', 'weighted', 'rank', 'logit']
+
+
+def load_manifest(manifest=None):
+    if manifest is None:
+        return DEFAULT_MANIFEST
+    if isinstance(manifest, dict):
+        return manifest
+    with open(manifest, 'r') as f:
+        return json.load(f)
+
+
+def _match_any(path, patterns):
+    return any(fnmatch.fnmatch(path, p) for p in patterns)
+
+
+def resolve_members(manifest, root_dir):
+    """
+    Return list of (csv_path, weight) selected by the manifest, in a stable order.
+    """
+    g_include = manifest.get('include', [])
+    g_exclude = manifest.get('exclude', [])
+    members = []
+    seen = set()
+
+    for rule in manifest['members']:
+        include = rule.get('include', []) + g_include
+        exclude = rule.get('exclude', []) + g_exclude
+        weight = float(rule.get('weight', 1.0))
+        pattern = rule['glob']
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(root_dir, pattern)
+
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if path in seen:
+                continue
+            if include and not _match_any(path, include):
+                continue
+            if exclude and _match_any(path, exclude):
+                continue
+            seen.add(path)
+            members.append((path, weight))
+    return members
+
+
+def _read_proba(csv_path):
+    df = pd.read_csv(csv_path, usecols=['id', 'proba'])
+    return df['id'].to_numpy(dtype=np.int64), df['proba'].to_numpy(dtype=np.float32)
+
+
+def load_prediction_matrix(csv_list, num_workers=8):
+    """
+    Read all prediction csv concurrently and align them by meme id.
+
+    Return:
+        ids: np.int64 (n,), sorted meme ids
+        mtx: np.float32 (n, m), mtx[i, j] is the proba of member j on ids[i]
+    """
+    assert len(csv_list) > 0
+    with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(csv_list)))) as pool:
+        loaded = list(pool.map(_read_proba, csv_list))
+
+    for csv_path, (member_ids, _) in zip(csv_list, loaded):
+        # NOTE: a repeated id could hide a missing one from the row count and id checks below.
+        if len(np.unique(member_ids)) != len(member_ids):
+            raise ValueError(f"{csv_path} has repeated ids")
+
+    ids = np.sort(loaded[0][0])
+    mtx = np.empty([len(ids), len(csv_list)], dtype=np.float32)
+
+    for j, (csv_path, (member_ids, proba)) in enumerate(zip(csv_list, loaded)):
+        if len(member_ids) != len(ids):
+            raise ValueError(f"{csv_path} has {len(member_ids)} rows, expect {len(ids)}")
+        pos = np.searchsorted(ids, member_ids)
+        pos = np.clip(pos, 0, len(ids) - 1)
+        if not np.array_equal(ids[pos], member_ids):
+            raise ValueError(f"{csv_path} doesn't cover the same set of ids as {csv_list[0]}")
+        mtx[pos, j] = proba
+    return ids, mtx
+
+
+def _column_rank(mtx):
+    order = np.argsort(mtx, axis=0, kind='stable')
+    rank = np.empty_like(order)
+    np.put_along_axis(
+        rank, order, np.arange(len(mtx))[:, None].repeat(mtx.shape[1], axis=1), axis=0)
+    return rank.astype(np.float32) / max(len(mtx) - 1, 1)
+
+
+def combine(mtx, weights=None, methods=METHODS, eps=1e-6):
+    """
+    Compute every requested combination of the member columns of `mtx`.
+
+    mean:     arithmetic mean of proba
+    weighted: weighted mean of proba
+    rank:     weighted mean of per-member normalized rank, in [0, 1]
+    logit:    sigmoid of the weighted mean of logit(proba)
+    """
+    num_member = mtx.shape[1]
+    if weights is None:
+        weights = np.ones([num_member], dtype=np.float32)
+    weights = np.asarray(weights, dtype=np.float32)
+    assert weights.shape == (num_member,), f"{weights.shape} != ({num_member},)"
+    w = weights / weights.sum()
+
+    result = {}
+    for method in methods:
+        if method == 'mean':
+            result[method] = mtx.mean(axis=1)
+        elif method == 'weighted':
+            result[method] = mtx @ w
+        elif method == 'rank':
+            result[method] = _column_rank(mtx) @ w
+        elif method == 'logit':
+            p = np.clip(mtx, eps, 1 - eps)
+            z = np.log(p) - np.log1p(-p)
+            result[method] = (1 / (1 + np.exp(-(z @ w)))).astype(np.float32)
+        else:
+            raise ValueError(f"Unknown ensemble method: {method}, should be one of {METHODS}")
+    return result
+
+
+def write_prediction(out_path, ids, proba, threshold=0.5):
+    pd.DataFrame({
+        'id': ids,
+        'proba': proba,
+        'label': (proba > threshold).astype(np.int64),
+    }).to_csv(out_path, index=False)
+
+
+class PredictionTable:
+    """
+    Ensemble prediction keyed by meme id, with rule based overrides.
+
+    Every override is a vectorized assignment on the rows of the given ids,
+    and rows whose proba actually changed are recorded in an audit log
+    (rule, id, before, after).
+    """
+
+    def __init__(self, ids, proba):
+        order = np.argsort(ids, kind='stable')
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.proba = np.asarray(proba, dtype=np.float32)[order].copy()
+        self._audit = []
+
+    def locate(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).reshape([-1])
+        pos = np.clip(np.searchsorted(self.ids, ids), 0, max(len(self.ids) - 1, 0))
+        missing = ids[self.ids[pos] != ids] if len(self.ids) else ids
+        if len(missing):
+            raise KeyError(f"Unknown ids: {missing.tolist()}")
+        return pos
+
+    def override(self, rule, ids, value):
+        """
+        Set proba of `ids` to `value` (a scalar, or one value per id).
+        """
+        pos = self.locate(ids)
+        before = self.proba[pos].copy()
+        self.proba[pos] = value
+        after = self.proba[pos]
+        changed = before != after
+        self._audit.append(pd.DataFrame({
+            'rule': rule,
+            'id': self.ids[pos][changed],
+            'before': before[changed],
+            'after': after[changed],
+        }))
+        print(f"[{rule}] override {changed.sum()}/{len(pos)} rows")
+        return int(changed.sum())
+
+    def audit(self):
+        if not self._audit:
+            return pd.DataFrame(columns=['rule', 'id', 'before', 'after'])
+        return pd.concat(self._audit, ignore_index=True)
+
+    def write(self, out_path, audit_path=None, threshold=0.5):
+        write_prediction(out_path, self.ids, self.proba, threshold=threshold)
+        if audit_path is not None:
+            self.audit().to_csv(audit_path, index=False, float_format='%.6f')
+
+
+def ensemble(root_dir, manifest=None, method=None, num_workers=8):
+    """
+    Run the ensemble described by `manifest`.
+
+    Return (members, ids, proba), where members is the list of (csv_path, weight) used.
+    """
+    manifest = load_manifest(manifest)
+    method = method or manifest.get('method', 'mean')
+    members = resolve_members(manifest, root_dir)
+    assert len(members) >= 2, f'Ensemble need at least two prediction file, only {len(members)} is matched'
+
+    csv_list = [m[0] for m in members]
+    weights = [m[1] for m in members]
+    ids, mtx = load_prediction_matrix(csv_list, num_workers=num_workers)
+    proba = combine(mtx, weights=weights, methods=[method])[method]
+    return members, ids, proba
@@ -0,0 +1,304 @@
+"""
+Search which checkpoints (and with what weights) to ensemble, based on their dev set predictions.
+
+    python3 ensemble_search.py search ROOT dev_manifest.json data/hateful_memes/dev_all.jsonl \
+        --strategy greedy --out_manifest test_manifest.json
+
+`dev_manifest.json` uses the same format as the manifest of ensemble_engine.py but
+points to dev set prediction csv. Every candidate ensemble is scored by the
+weighted mean of member proba, many candidates at a time: scores are built from
+a running sum of the selected members, and AUROC of the whole batch is computed
+in preallocated buffers from nearly sorted rows (see `BatchScorer`) instead of
+one roc_auc_score call per candidate.
+"""
+import os
+import glob
+import json
+import itertools
+
+import fire
+import numpy as np
+
+import ensemble_engine
+
+
+class BatchScorer:
+    """
+    Score many candidate ensemble at once.
+
+    probas: np.float32 (n, m), dev set proba of m members
+    labels: (n,) 0/1 ground truth
+
+    AUROC is the Mann-Whitney statistic, from one in-place sort per candidate of
+    int64 keys (order preserving bits of the float32 score, label in the lowest
+    bit, so negatives come first inside a tie group) and cumulative sums, all in
+    buffers allocated once. Candidates are permuted by the order of a base score
+    before the sort: the current ensemble in greedy / hill climbing, which every
+    candidate only differs from by one member, so the rows are nearly sorted and
+    the adaptive (timsort) sort is close to linear.
+    """
+
+    def __init__(self, probas, labels, max_batch=1024):
+        self.probas_t = np.ascontiguousarray(probas.T, dtype=np.float32)  # (m, n)
+        self.labels = np.asarray(labels).astype(bool)
+        self.num_pos = int(self.labels.sum())
+        self.num_neg = len(self.labels) - self.num_pos
+        assert self.num_pos > 0 and self.num_neg > 0, "Need both positive and negative samples"
+        self.max_batch = max_batch
+
+        n = len(self.labels)
+        self._labels = self.labels.astype(np.int64)
+        self._scores = np.empty([max_batch, n], dtype=np.float32)
+        self._int_bufs = [np.empty([max_batch, n], dtype=np.int64) for _ in range(4)]
+        self._new_group = np.empty([max_batch, n], dtype=bool)
+
+    def auroc(self, scores, base_order=None):
+        """
+        scores: (c, n), c candidate score vectors
+        base_order: (n,) argsort of a score close to every candidate, or None
+        Return: np.float64 (c,), AUROC of each candidate, ties count as half.
+        """
+        c, n = scores.shape
+        assert c <= self.max_batch
+        keys, tmp, neg_cum, neg_below = [b[:c] for b in self._int_bufs]
+        new_group = self._new_group[:c]
+
+        # NOTE: -0.0 + 0.0 == +0.0, both zeros must get the same key
+        s = self._scores[:c]
+        np.add(scores, np.float32(0), out=s)
+        np.copyto(tmp, s.view(np.int32))
+        np.right_shift(tmp, 31, out=keys)
+        np.bitwise_and(keys, 0x7FFFFFFF, out=keys)
+        np.bitwise_xor(tmp, keys, out=tmp)  # negative floats: reversed order of their bits
+        np.left_shift(tmp, 1, out=tmp)
+        labels = self._labels
+        if base_order is not None:
+            np.take(tmp, base_order, axis=1, out=keys)
+            labels = labels[base_order]
+        else:
+            keys, tmp = tmp, keys
+        np.bitwise_or(keys, labels, out=keys)
+        keys.sort(axis=1, kind='stable')
+
+        # tie groups: keys differ by more than the label bit
+        np.bitwise_xor(keys[:, 1:], keys[:, :-1], out=tmp[:, 1:])
+        np.right_shift(tmp[:, 1:], 1, out=tmp[:, 1:])
+        np.not_equal(tmp[:, 1:], 0, out=new_group[:, 1:])
+        new_group[:, 0] = True
+
+        # neg_cum: negatives up to and including each position
+        y = tmp
+        np.bitwise_and(keys, 1, out=y)
+        np.subtract(1, y, out=neg_cum)
+        np.cumsum(neg_cum, axis=1, out=neg_cum)
+        # neg_below: negatives strictly below the tie group of each position
+        np.add(neg_cum, y, out=neg_below)
+        np.subtract(neg_below, 1, out=neg_below)
+        np.multiply(neg_below, new_group, out=neg_below)
+        np.maximum.accumulate(neg_below, axis=1, out=neg_below)
+
+        # a positive wins over the negatives below its group, and half of the ones in it:
+        # neg_below + (neg_cum - neg_below) / 2, its group's negatives are all before it.
+        np.add(neg_cum, neg_below, out=neg_cum)
+        np.multiply(neg_cum, y, out=neg_cum)
+        return 0.5 * neg_cum.sum(axis=1) / (self.num_pos * self.num_neg)
+
+    def accuracy(self, scores, weight_sum, threshold=0.5):
+        correct = self._new_group[:len(scores)]
+        np.greater(scores, threshold * np.asarray(weight_sum).reshape([-1, 1]), out=correct)
+        np.equal(correct, self.labels[None, :], out=correct)
+        return correct.mean(axis=1)
+
+    def base_order(self, weights):
+        return np.argsort(np.asarray(weights, dtype=np.float32) @ self.probas_t, kind='stable')
+
+    def score_weights(self, weights, base_order=None):
+        """
+        weights: (c, m) candidate member weights
+        Return (auroc, accuracy), both (c,)
+        """
+        weights = np.asarray(weights, dtype=np.float32)
+        auroc = np.empty([len(weights)])
+        acc = np.empty([len(weights)])
+        for i in range(0, len(weights), self.max_batch):
+            w = weights[i: i + self.max_batch]
+            scores = np.matmul(w, self.probas_t, out=self._scores[:len(w)])
+            acc[i: i + len(w)] = self.accuracy(scores, w.sum(axis=1))
+            auroc[i: i + len(w)] = self.auroc(scores, base_order)
+        return auroc, acc
+
+    def score_increment(self, running_sum, running_weight, step=1.0):
+        """
+        Score adding each member (with weight `step`) to the ensemble whose
+        weighted proba sum is `running_sum`.
+        """
+        m = len(self.probas_t)
+        assert m <= self.max_batch
+        scores = np.multiply(self.probas_t, np.float32(step), out=self._scores[:m])
+        scores += running_sum[None, :]
+        acc = self.accuracy(scores, np.full([m], running_weight + step))
+        base_order = np.argsort(running_sum, kind='stable') if running_weight > 0 else None
+        return self.auroc(scores, base_order), acc
+
+
+def _objective(auroc, acc, metric):
+    if metric == 'auroc':
+        return auroc + 1e-6 * acc
+    elif metric == 'acc':
+        return acc + 1e-6 * auroc
+    elif metric == 'sum':
+        return auroc + acc
+    raise ValueError(f"Unknown metric: {metric}, should be one of auroc, acc, sum")
+
+
+def greedy_forward(scorer, metric='auroc', max_size=10, allow_repeat=True):
+    """
+    Forward selection: keep adding the member that improve the objective the most.
+    With allow_repeat a member can be picked multiple times, which act as a integer weight.
+    """
+    num_member = len(scorer.probas_t)
+    weights = np.zeros([num_member], dtype=np.float32)
+    running_sum = np.zeros([len(scorer.labels)], dtype=np.float32)
+    best = -np.inf
+
+    for _ in range(max_size):
+        auroc, acc = scorer.score_increment(running_sum, weights.sum())
+        obj = _objective(auroc, acc, metric)
+        if not allow_repeat:
+            obj[weights > 0] = -np.inf
+        j = int(obj.argmax())
+        if obj[j] <= best:
+            break
+        best = obj[j]
+        weights[j] += 1
+        running_sum += scorer.probas_t[j]
+        print(f"[greedy] add member {j}, auroc={auroc[j]:.4f} acc={acc[j]:.4f}")
+    return weights
+
+
+def hill_climb(scorer, weights, metric='auroc', step=0.25, max_iter=200):
+    """
+    Move a single member weight by +/- step at a time, as long as the objective improves.
+    """
+    weights = np.asarray(weights, dtype=np.float32).copy()
+    num_member = len(weights)
+    auroc, acc = scorer.score_weights(weights[None, :])
+    best = _objective(auroc, acc, metric)[0]
+    deltas = np.concatenate([np.eye(num_member), -np.eye(num_member)]).astype(np.float32) * step
+
+    for i in range(max_iter):
+        cands = np.maximum(weights[None, :] + deltas, 0)
+        cands = cands[cands.sum(axis=1) > 0]
+        auroc, acc = scorer.score_weights(cands, scorer.base_order(weights))
+        obj = _objective(auroc, acc, metric)
+        j = int(obj.argmax())
+        if obj[j] <= best:
+            break
+        best = obj[j]
+        weights = cands[j]
+        print(f"[hill_climb] iter {i}, auroc={auroc[j]:.4f} acc={acc[j]:.4f}")
+    return weights
+
+
+def exhaustive(scorer, metric='auroc', max_k=3, min_k=2, chunk=4096):
+    """
+    Try every equal weight subset with size between min_k and max_k.
+    """
+    num_member = len(scorer.probas_t)
+    if min_k < 1 or max_k < min_k:
+        raise ValueError(f"Need 1 <= min_k <= max_k, got min_k={min_k}, max_k={max_k}")
+    if num_member < min_k:
+        raise ValueError(f"Need at least min_k={min_k} members, only {num_member} are loaded")
+    best, best_weights = -np.inf, None
+    # NOTE: members are correlated, every subset mean is close to the order of the all member mean.
+    base_order = scorer.base_order(np.ones([num_member]))
+
+    for k in range(min_k, min(max_k, num_member) + 1):
+        subsets = itertools.combinations(range(num_member), k)
+        while True:
+            batch = list(itertools.islice(subsets, chunk))
+            if not batch:
+                break
+            cands = np.zeros([len(batch), num_member], dtype=np.float32)
+            np.put_along_axis(cands, np.asarray(batch), 1.0, axis=1)
+            auroc, acc = scorer.score_weights(cands, base_order)
+            obj = _objective(auroc, acc, metric)
+            j = int(obj.argmax())
+            if obj[j] > best:
+                best, best_weights = obj[j], cands[j]
+                print(f"[exhaustive] k={k} {batch[j]}, auroc={auroc[j]:.4f} acc={acc[j]:.4f}")
+    return best_weights
+
+
+def load_dev_predictions(root_dir, dev_manifest, label_jsonl, num_workers=8):
+    manifest = ensemble_engine.load_manifest(dev_manifest)
+    members = ensemble_engine.resolve_members(manifest, root_dir)
+    assert len(members) >= 2, f'Need at least two prediction file, only {len(members)} is matched'
+    csv_list = [m[0] for m in members]
+    ids, probas = ensemble_engine.load_prediction_matrix(csv_list, num_workers=num_workers)
+
+    id2label = {}
+    with open(label_jsonl, 'r') as f:
+        for line in f:
+            anno = json.loads(line)
+            id2label[anno['id']] = anno['label']
+    labels = np.asarray([id2label[i] for i in ids.tolist()])
+    return csv_list, probas, labels
+
+
+def search(root_dir, dev_manifest, label_jsonl, strategy='greedy', metric='auroc',
+           max_size=10, max_k=3, step=0.25, out_manifest=None, test_name_map=None):
+    """
+    strategy: greedy / hill_climb (greedy followed by weight hill climbing) / exhaustive
+    out_manifest: write the selected members and weights as a ensemble_engine manifest,
+        member paths are relative to root_dir (as in dev_manifest).
+    test_name_map: json dict of {dev csv file name: test csv file name}, used to point
+        out_manifest to the test set prediction sitting next to each dev csv.
+    """
+    csv_list, probas, labels = load_dev_predictions(root_dir, dev_manifest, label_jsonl)
+    scorer = BatchScorer(probas, labels)
+
+    single_auroc, single_acc = scorer.score_weights(np.eye(len(csv_list)))
+    for path, a, c in zip(csv_list, single_auroc, single_acc):
+        print(f"[member] auroc={a:.4f} acc={c:.4f} {path}")
+
+    if strategy == 'greedy':
+        weights = greedy_forward(scorer, metric=metric, max_size=max_size)
+    elif strategy == 'hill_climb':
+        weights = greedy_forward(scorer, metric=metric, max_size=max_size)
+        weights = hill_climb(scorer, weights, metric=metric, step=step)
+    elif strategy == 'exhaustive':
+        weights = exhaustive(scorer, metric=metric, max_k=max_k)
+    else:
+        raise ValueError(f"Unknown strategy: {strategy}")
+
+    auroc, acc = scorer.score_weights(weights[None, :])
+    print(f"Best ensemble auroc={auroc[0]:.4f} acc={acc[0]:.4f}")
+    selected = [(p, float(w)) for p, w in zip(csv_list, weights) if w > 0]
+    for path, w in selected:
+        print(f"[{w:.2f}] {path}")
+
+    if out_manifest is not None and len(selected) < 2:
+        # NOTE: ensemble_engine.ensemble needs at least two members, a single model is not an ensemble.
+        print(f"Not writing {out_manifest}: only {len(selected)} member selected, use its prediction directly")
+    elif out_manifest is not None:
+        name_map = {}
+        if test_name_map is not None:
+            with open(test_name_map, 'r') as f:
+                name_map = json.load(f)
+        members = []
+        for path, w in selected:
+            name = os.path.basename(path)
+            path = os.path.join(os.path.dirname(path), name_map.get(name, name))
+            # NOTE: resolve_members joins root_dir to relative globs again, and `[`, `*` and `?`
+            # in file names must not be read as wildcards.
+            members.append({'glob': glob.escape(os.path.relpath(path, root_dir)), 'weight': w})
+        with open(out_manifest, 'w') as f:
+            json.dump({'method': 'weighted', 'members': members}, f, indent=4)
+    return selected
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'search': search,
+    })
@@ -0,0 +1,62 @@
+import numpy as np
+from spacy.attrs import ORTH
+
+
+class KeywordMatcher:
+    """
+    Batched version of:
+
+        any(token.similarity(kwt) > threshold for token in nlp(text) for kwt in keyword_tok)
+
+    Only word vectors are needed, so texts are only tokenized (every pipeline
+    component is disabled) and token-keyword cosine similarities of a whole
+    batch are computed with a single matrix product.
+    """
+
+    def __init__(self, nlp, keywords, threshold=0.6, batch_size=256):
+        self.nlp = nlp
+        self.threshold = threshold
+        self.batch_size = batch_size
+
+        kw_doc = nlp.make_doc(' '.join(keywords))
+        self.keyword_orth = kw_doc.to_array([ORTH]).reshape([-1]).astype(np.uint64)
+        self.keyword_mtx = self._normalized_vectors(self.keyword_orth)
+
+    def _normalized_vectors(self, orths):
+        vectors = self.nlp.vocab.vectors
+        rows = np.asarray(vectors.find(keys=orths.tolist()), dtype=np.int64).reshape([-1])
+        mtx = np.zeros([len(orths), vectors.shape[1]], dtype=np.float32)
+        found = rows >= 0
+        mtx[found] = vectors.data[rows[found]]
+
+        norm = np.linalg.norm(mtx, axis=1, keepdims=True)
+        # NOTE: Token.similarity is 0 if one of the tokens doesn't have a vector.
+        return np.divide(mtx, norm, out=np.zeros_like(mtx), where=norm > 0)
+
+    def _match_batch(self, docs):
+        orths = [doc.to_array([ORTH]).reshape([-1]).astype(np.uint64) for doc in docs]
+        doc_idx = np.repeat(np.arange(len(docs)), [len(o) for o in orths])
+        if len(doc_idx) == 0:
+            return np.zeros([len(docs)], dtype=bool)
+        orths = np.concatenate(orths)
+
+        sim = self._normalized_vectors(orths) @ self.keyword_mtx.T
+        # NOTE: Token.similarity also treats identical tokens as a perfect match.
+        token_hit = ((sim > self.threshold) | (orths[:, None] == self.keyword_orth[None, :])).any(axis=1)
+        return np.bincount(doc_idx, weights=token_hit, minlength=len(docs)) > 0
+
+    def match(self, texts):
+        """
+        Return np.bool (len(texts),), True if any token of the text is similar to any keyword.
+        """
+        result = []
+        batch = []
+        docs = self.nlp.pipe(texts, batch_size=self.batch_size, disable=self.nlp.pipe_names)
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == self.batch_size:
+                result.append(self._match_batch(batch))
+                batch = []
+        if batch:
+            result.append(self._match_batch(batch))
+        return np.concatenate(result) if result else np.zeros([0], dtype=bool)
@@ -0,0 +1,152 @@
+"""
+Dominant (HSV) color of face boxes, used by rasicm_det to double check the skin tone.
+
+Every image is decoded only once for all of its boxes, k-means runs a fixed
+number of iterations for all boxes of an image at the same time, and results
+are kept in a pickle cache keyed by image name + box coordinates, so re-running
+the ensemble only has to look at faces it hasn't seen before.
+"""
+import os
+import pickle
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+
+def face_crop_slices(bbox, imh, imw):
+    """
+    Shrink the (normalized) face box to half of its size around the center,
+    to get rid of hair and background.
+    """
+    center = [
+        (bbox['ymin'] + bbox['ymax']) / 2,
+        (bbox['xmin'] + bbox['xmax']) / 2,
+    ]
+    ymin = (bbox['ymin'] * 0.5 + center[0] * 0.5) * imh
+    ymax = (bbox['ymax'] * 0.5 + center[0] * 0.5) * imh
+    xmin = (bbox['xmin'] * 0.5 + center[1] * 0.5) * imw
+    xmax = (bbox['xmax'] * 0.5 + center[1] * 0.5) * imw
+    return slice(int(ymin), int(ymax)), slice(int(xmin), int(xmax))
+
+
+def batch_kmeans(pixels, seg, num_seg, k=5, iters=10):
+    """
+    Run k-means independently on every segment of `pixels`, all segments at once.
+
+    pixels: np.float32 (n, c)
+    seg: np.int64 (n,), segment id of each pixel, pixels of a segment must be contiguous
+    Return:
+        centers: np.float32 (num_seg, k, c)
+        hist: np.float32 (num_seg, k), fraction of pixels assigned to each center
+    """
+    counts = np.bincount(seg, minlength=num_seg)
+    starts = np.cumsum(counts) - counts
+    # NOTE: deterministic init, k pixels evenly spread (in raster order) over the segment.
+    init_idx = starts[:, None] + (np.arange(k)[None, :] * counts[:, None]) // k
+    centers = pixels[np.minimum(init_idx, len(pixels) - 1)].astype(np.float32)
+
+    flat_centers = centers.reshape([num_seg * k, -1])
+    for i in range(iters + 1):
+        dist = ((pixels[:, None, :] - centers[seg]) ** 2).sum(axis=-1)
+        label = seg * k + dist.argmin(axis=1)
+        cnt = np.bincount(label, minlength=num_seg * k)
+        if i == iters:
+            break
+        sums = np.stack([
+            np.bincount(label, weights=pixels[:, c], minlength=num_seg * k)
+            for c in range(pixels.shape[1])
+        ], axis=1)
+        upd = cnt > 0
+        flat_centers[upd] = sums[upd] / cnt[upd, None]
+
+    hist = cnt.reshape([num_seg, k]) / np.maximum(counts, 1)[:, None]
+    return centers, hist.astype(np.float32)
+
+
+def dominant_colors(im_hsv, boxes, k=5, iters=10, max_pixels=10000):
+    """
+    Return [(h, s, v, share) or None] for each box, None if the crop is empty.
+    """
+    imh, imw = im_hsv.shape[:2]
+    crops = []
+    for bbox in boxes:
+        yslice, xslice = face_crop_slices(bbox, imh, imw)
+        crop = im_hsv[yslice, xslice, ...].reshape([-1, 3])
+        if max_pixels and len(crop) > max_pixels:
+            crop = crop[::int(np.ceil(len(crop) / max_pixels))]
+        crops.append(crop)
+
+    valid = [i for i, c in enumerate(crops) if len(c) > 0]
+    result = [None] * len(boxes)
+    if not valid:
+        return result
+
+    pixels = np.concatenate([crops[i] for i in valid]).astype(np.float32)
+    seg = np.repeat(np.arange(len(valid)), [len(crops[i]) for i in valid])
+    centers, hist = batch_kmeans(pixels, seg, len(valid), k=k, iters=iters)
+    top1 = hist.argmax(axis=1)
+
+    for j, i in enumerate(valid):
+        h, s, v = centers[j, top1[j]].tolist()
+        result[i] = (h, s, v, float(hist[j, top1[j]]))
+    return result
+
+
+def _estimate_image(args):
+    img_path, boxes, k, iters, max_pixels = args
+    im = cv2.imread(img_path)
+    if im is None:
+        print(f"[skin_tone] Can't read image: {img_path}")
+        return [None] * len(boxes)
+    im_hsv = cv2.cvtColor(im, cv2.COLOR_BGR2HSV_FULL)
+    return dominant_colors(im_hsv, boxes, k=k, iters=iters, max_pixels=max_pixels)
+
+
+def _cache_key(img_name, bbox, k, iters, max_pixels):
+    coord = ','.join(f"{bbox[c]:.6f}" for c in ['ymin', 'xmin', 'ymax', 'xmax'])
+    return f"{img_name}|{k}|{iters}|{max_pixels}|{coord}"
+
+
+def estimate_face_tones(img_boxes, img_dir, cache_path=None, num_workers=8, k=5, iters=10, max_pixels=10000):
+    """
+    img_boxes: {img_name: [bbox, ...]}, bbox is a dict with normalized ymin, xmin, ymax, xmax
+    Return: {img_name: [(h, s, v, share) or None, ...]}, same order as the input boxes.
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as pf:
+            cache = pickle.load(pf)
+
+    todo = {}
+    for img_name, boxes in img_boxes.items():
+        missing = [b for b in boxes if _cache_key(img_name, b, k, iters, max_pixels) not in cache]
+        if missing:
+            todo[img_name] = missing
+    print(f"[skin_tone] {len(img_boxes) - len(todo)}/{len(img_boxes)} images found in cache")
+
+    if todo:
+        args = [
+            (os.path.join(img_dir, img_name), boxes, k, iters, max_pixels)
+            for img_name, boxes in todo.items()
+        ]
+        if num_workers > 1 and len(args) > 1:
+            with Pool(min(num_workers, len(args))) as pool:
+                results = pool.map(_estimate_image, args)
+        else:
+            results = [_estimate_image(a) for a in args]
+
+        for (img_name, boxes), colors in zip(todo.items(), results):
+            for bbox, color in zip(boxes, colors):
+                cache[_cache_key(img_name, bbox, k, iters, max_pixels)] = color
+
+        if cache_path is not None:
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as pf:
+                pickle.dump(cache, pf)
+            os.replace(tmp_path, cache_path)
+
+    return {
+        img_name: [cache[_cache_key(img_name, b, k, iters, max_pixels)] for b in boxes]
+        for img_name, boxes in img_boxes.items()
+    }